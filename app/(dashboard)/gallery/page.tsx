@@ -20,6 +20,15 @@ import {
   MoreVertical,
   RefreshCw,
 } from "lucide-react";
+import {
+  buildSrcSet,
+  pickVariant,
+  THUMBNAIL_VARIANT_WIDTH,
+  type ImageVariant,
+} from "@/lib/image-variants";
+
+// Rendered card width: one column on mobile, up to four on desktop
+const CARD_SIZES = "(min-width: 1280px) 25vw, (min-width: 768px) 33vw, 100vw";
 
 // ============================================================================
 // TYPES
@@ -28,6 +37,8 @@ import {
 interface GalleryImage {
   id: string;
   imageUrl: string;
+  variants?: ImageVariant[];
+  blurDataUrl?: string;
   originalPrompt: string;
   enhancedPrompt: string;
   aspectRatio: string;
@@ -158,16 +169,16 @@ export default function GalleryPage() {
 
   // Download image
   const handleDownload = async (img: GalleryImage) => {
-    const response = await fetch(img.imageUrl);
-    const blob = await response.blob();
-    const url = window.URL.createObjectURL(blob);
+    // Stream through the download proxy (handles CORS and resumable downloads)
+    const query = new URLSearchParams({
+      url: img.imageUrl,
+      filename: `imagecrafter-${img.id}.png`,
+    });
     const a = document.createElement("a");
-    a.href = url;
-    a.download = `imagecrafter-${img.id}.png`;
+    a.href = `/api/images/download?${query.toString()}`;
     document.body.appendChild(a);
     a.click();
     document.body.removeChild(a);
-    window.URL.revokeObjectURL(url);
   };
 
   // Copy prompt
@@ -303,13 +314,32 @@ export default function GalleryPage() {
                   className="relative overflow-hidden rounded-xl border border-white/10 bg-white/5 cursor-pointer"
                   onClick={() => setSelectedImage(img)}
                 >
-                  <img
-                    src={img.imageUrl}
-                    alt={img.originalPrompt}
-                    className={`w-full object-cover transition-transform duration-300 group-hover:scale-105 ${
-                      viewMode === "grid" ? "aspect-video" : ""
-                    }`}
-                  />
+                  <picture>
+                    <source
+                      type="image/avif"
+                      srcSet={buildSrcSet(img.variants, "avif")}
+                      sizes={CARD_SIZES}
+                    />
+                    <source
+                      type="image/webp"
+                      srcSet={buildSrcSet(img.variants, "webp")}
+                      sizes={CARD_SIZES}
+                    />
+                    <img
+                      src={pickVariant(img.variants, THUMBNAIL_VARIANT_WIDTH)?.url ?? img.imageUrl}
+                      alt={img.originalPrompt}
+                      loading="lazy"
+                      decoding="async"
+                      style={
+                        img.blurDataUrl
+                          ? { backgroundImage: `url(${img.blurDataUrl})`, backgroundSize: "cover" }
+                          : undefined
+                      }
+                      className={`w-full object-cover transition-transform duration-300 group-hover:scale-105 ${
+                        viewMode === "grid" ? "aspect-video" : ""
+                      }`}
+                    />
+                  </picture>
 
                   {/* Overlay */}
                   <div className="absolute inset-0 bg-gradient-to-t from-black/80 via-black/20 to-transparent opacity-0 group-hover:opacity-100 transition-opacity">
@@ -388,7 +418,7 @@ export default function GalleryPage() {
                 {/* Image */}
                 <div className="flex-1 flex items-center justify-center bg-black/50 p-4">
                   <img
-                    src={selectedImage.imageUrl}
+                    src={pickVariant(selectedImage.variants, 2048, "webp", false)?.url ?? selectedImage.imageUrl}
                     alt={selectedImage.originalPrompt}
                     className="max-w-full max-h-[60vh] lg:max-h-[80vh] object-contain rounded-lg"
                   />
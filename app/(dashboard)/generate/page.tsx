@@ -172,16 +172,16 @@ export default function GeneratePage() {
   const handleDownload = async () => {
     if (!generatedImage) return;
 
-    const response = await fetch(generatedImage.imageUrl);
-    const blob = await response.blob();
-    const url = window.URL.createObjectURL(blob);
+    // Stream through the download proxy (handles CORS and resumable downloads)
+    const query = new URLSearchParams({
+      url: generatedImage.imageUrl,
+      filename: `imagecraft-${generatedImage.id}.png`,
+    });
     const a = document.createElement("a");
-    a.href = url;
-    a.download = `imagecraft-${generatedImage.id}.png`;
+    a.href = `/api/images/download?${query.toString()}`;
     document.body.appendChild(a);
     a.click();
     document.body.removeChild(a);
-    window.URL.revokeObjectURL(url);
   };
 
   return (
@@ -1,6 +1,7 @@
 import { NextRequest, NextResponse } from "next/server";
 import { prisma } from "@/lib/prisma";
-import { deleteFromR2, extractR2Key, isR2Url } from "@/lib/r2";
+import { isR2Url } from "@/lib/r2";
+import { reapExpiredImages, type ReapOptions } from "@/lib/services/image-reaper";
 
 /**
  * Cron job to clean up expired images from R2 storage
@@ -14,8 +15,14 @@ import { deleteFromR2, extractR2Key, isR2Url } from "@/lib/r2";
  *   Authorization: Bearer <CRON_SECRET>
  *
  * Example cron schedule: 0 2 * * * (daily at 2 AM)
+ *
+ * Pages through every expired image within CLEANUP_TIME_BUDGET_MS; if the
+ * budget runs out, the response has complete: false and the next run resumes.
  */
 
+// Leave headroom above the default reaper time budget
+export const maxDuration = 300;
+
 export async function GET(request: NextRequest) {
   try {
     // Verify cron secret to prevent unauthorized access
@@ -27,79 +34,7 @@ export async function GET(request: NextRequest) {
       return NextResponse.json({ error: "Unauthorized" }, { status: 401 });
     }
 
-    const now = new Date();
-
-    // Find expired images
-    const expiredImages = await prisma.image.findMany({
-      where: {
-        expiresAt: {
-          lte: now,
-        },
-        status: "COMPLETED", // Only delete completed images
-        deletedAt: null, // Not already deleted
-      },
-      select: {
-        id: true,
-        imageUrl: true,
-        thumbnailUrl: true,
-        userId: true,
-      },
-      take: 100, // Process in batches to avoid timeout
-    });
-
-    console.log(`[Cleanup] Found ${expiredImages.length} expired images`);
-
-    let deleted = 0;
-    let failed = 0;
-    const errors: string[] = [];
-
-    for (const image of expiredImages) {
-      try {
-        // Delete from R2 if it's an R2 URL
-        if (image.imageUrl && isR2Url(image.imageUrl)) {
-          const key = extractR2Key(image.imageUrl);
-          const success = await deleteFromR2(key);
-          if (!success) {
-            console.warn(`[Cleanup] Failed to delete R2 object: ${key}`);
-          }
-        }
-
-        // Delete thumbnail from R2 if it exists
-        if (image.thumbnailUrl && isR2Url(image.thumbnailUrl)) {
-          const thumbKey = extractR2Key(image.thumbnailUrl);
-          await deleteFromR2(thumbKey);
-        }
-
-        // Mark as expired in database (soft delete)
-        await prisma.image.update({
-          where: { id: image.id },
-          data: {
-            status: "EXPIRED",
-            deletedAt: now,
-          },
-        });
-
-        deleted++;
-      } catch (error) {
-        console.error(`[Cleanup] Failed to delete image ${image.id}:`, error);
-        errors.push(
-          `${image.id}: ${error instanceof Error ? error.message : "Unknown error"}`
-        );
-        failed++;
-      }
-    }
-
-    // Log summary
-    console.log(`[Cleanup] Complete: ${deleted} deleted, ${failed} failed`);
-
-    return NextResponse.json({
-      success: true,
-      processed: expiredImages.length,
-      deleted,
-      failed,
-      errors: errors.length > 0 ? errors.slice(0, 10) : undefined, // Limit error details
-      timestamp: now.toISOString(),
-    });
+    return await runCleanup();
   } catch (error) {
     console.error("[Cleanup] Error:", error);
     return NextResponse.json(
@@ -112,6 +47,35 @@ export async function GET(request: NextRequest) {
   }
 }
 
+/**
+ * Reap expired images and report throughput
+ */
+async function runCleanup(options: ReapOptions = {}) {
+  const result = await reapExpiredImages(options);
+
+  // Log summary
+  console.log(
+    `[Cleanup] ${result.complete ? "Complete" : "Stopped early"}: ${result.deleted} deleted, ` +
+      `${result.skipped} skipped, ${result.objectsDeleted} objects removed ` +
+      `in ${result.durationMs}ms (${result.imagesPerSecond} images/s)`
+  );
+
+  return NextResponse.json({
+    success: true,
+    processed: result.scanned,
+    deleted: result.deleted,
+    failed: result.skipped,
+    complete: result.complete,
+    pages: result.pages,
+    objectsDeleted: result.objectsDeleted,
+    objectsFailed: result.objectsFailed,
+    durationMs: result.durationMs,
+    imagesPerSecond: result.imagesPerSecond,
+    errors: result.errors.length > 0 ? result.errors.slice(0, 10) : undefined, // Limit error details
+    timestamp: new Date().toISOString(),
+  });
+}
+
 /**
  * POST endpoint for manual trigger with options
  */
@@ -126,30 +90,31 @@ export async function POST(request: NextRequest) {
     }
 
     const body = await request.json().catch(() => ({}));
-    const { dryRun = false, limit = 100 } = body;
+    const { dryRun = false, limit, timeBudgetMs } = body;
 
-    const now = new Date();
+    if (dryRun) {
+      const now = new Date();
 
-    // Find expired images
-    const expiredImages = await prisma.image.findMany({
-      where: {
-        expiresAt: {
-          lte: now,
+      // Preview the oldest expired images
+      const expiredImages = await prisma.image.findMany({
+        where: {
+          expiresAt: {
+            lte: now,
+          },
+          status: "COMPLETED",
+          deletedAt: null,
         },
-        status: "COMPLETED",
-        deletedAt: null,
-      },
-      select: {
-        id: true,
-        imageUrl: true,
-        thumbnailUrl: true,
-        userId: true,
-        expiresAt: true,
-      },
-      take: Math.min(limit, 500), // Cap at 500
-    });
+        select: {
+          id: true,
+          imageUrl: true,
+          thumbnailUrl: true,
+          userId: true,
+          expiresAt: true,
+        },
+        orderBy: [{ expiresAt: "asc" }, { id: "asc" }],
+        take: Math.min(limit ?? 100, 500), // Cap at 500
+      });
 
-    if (dryRun) {
       return NextResponse.json({
         success: true,
         dryRun: true,
@@ -162,8 +127,10 @@ export async function POST(request: NextRequest) {
       });
     }
 
-    // Delegate to GET handler for actual cleanup
-    return GET(request);
+    return await runCleanup({
+      maxImages: typeof limit === "number" ? limit : undefined,
+      timeBudgetMs: typeof timeBudgetMs === "number" ? timeBudgetMs : undefined,
+    });
   } catch (error) {
     console.error("[Cleanup POST] Error:", error);
     return NextResponse.json(
@@ -3,12 +3,20 @@
  *
  * Batch image generation endpoint - generate up to 10 images at once
  * Requires Starter plan or higher
+ *
+ * The job is queued and processed by the batch worker; the response returns
+ * immediately with a batchId. Poll GET /api/images/batch?id=<batchId> for
+ * per-image progress.
+ *
+ * POST responses carry a Server-Timing header (auth, provision, credits, queue).
  */
 
 import { NextRequest, NextResponse } from "next/server";
 import { auth, currentUser } from "@clerk/nextjs/server";
-import { imageGenerationService, type BatchGenerateRequest } from "@/lib/services/image-generation";
+import { batchGenerate, getBatchJob } from "@/lib/services/image-generation";
 import { prisma } from "@/lib/prisma";
+import { getTemplate } from "@/lib/template-catalog";
+import { StageTimer, runWithTimer, timeStage } from "@/lib/timing";
 import { z } from "zod";
 
 // Request validation schema
@@ -20,13 +28,19 @@ const batchRequestSchema = z.object({
   aspectRatio: z.enum(["1:1", "16:9", "9:16", "4:3", "3:4"]).default("16:9"),
   resolution: z.enum(["1K", "2K", "4K"]).default("1K"),
   usePro: z.boolean().default(false),
-  styleHints: z.string().optional(),
 });
 
 export async function POST(request: NextRequest) {
+  const timer = new StageTimer();
+  const response = await runWithTimer(timer, () => handleBatch(request));
+  response.headers.set("Server-Timing", timer.toServerTiming());
+  return response;
+}
+
+async function handleBatch(request: NextRequest): Promise<NextResponse> {
   try {
     // Authenticate user
-    const { userId } = await auth();
+    const { userId } = await timeStage("auth", () => auth());
     if (!userId) {
       return NextResponse.json(
         { success: false, error: "Unauthorized" },
@@ -35,9 +49,11 @@ export async function POST(request: NextRequest) {
     }
 
     // Auto-provision user if they don't exist in database
-    const existingUser = await prisma.user.findUnique({
-      where: { id: userId },
-    });
+    const existingUser = await timeStage("provision", () =>
+      prisma.user.findUnique({
+        where: { id: userId },
+      })
+    );
 
     if (!existingUser) {
       const clerkUser = await currentUser();
@@ -102,50 +118,134 @@ export async function POST(request: NextRequest) {
       );
     }
 
-    const requestData: BatchGenerateRequest = {
-      userId,
-      ...validationResult.data,
-    };
+    const { prompts, projectId, templateSlug, presetSlug, resolution, aspectRatio } =
+      validationResult.data;
+
+    // Resolve template/preset slugs to IDs
+    const template = templateSlug ? await getTemplate(templateSlug) : null;
+    const preset = template?.presets.find((p) => p.slug === presetSlug);
 
-    // Generate the batch
-    const result = await imageGenerationService.generateBatch(requestData);
+    // Queue the batch
+    const result = await batchGenerate({
+      userId,
+      prompt: prompts[0],
+      prompts,
+      count: prompts.length,
+      resolution,
+      aspectRatio,
+      templateId: template?.id,
+      presetId: preset?.id,
+      projectId,
+    });
 
-    if (!result.success && result.completed === 0) {
-      const statusCode = result.errors[0]?.error?.includes("Insufficient") ? 429 :
-                         result.errors[0]?.error?.includes("requires") ? 403 :
+    if (!result.success) {
+      const statusCode = result.error?.includes("credits") ? 429 :
+                         result.error?.includes("requires") || result.error?.includes("Maximum") ? 403 :
                          500;
 
       return NextResponse.json(
         {
           success: false,
-          error: result.errors[0]?.error || "Batch generation failed",
+          error: result.error || "Batch generation failed",
         },
         { status: statusCode }
       );
     }
 
-    // Success response (may include partial failures)
+    return NextResponse.json(
+      {
+        success: true,
+        batchId: result.jobId,
+        status: "PENDING",
+        statusUrl: `/api/images/batch?id=${result.jobId}`,
+      },
+      { status: 202 }
+    );
+  } catch (error) {
+    console.error("Batch generation error:", error);
+    return NextResponse.json(
+      {
+        success: false,
+        error: "Internal server error",
+      },
+      { status: 500 }
+    );
+  }
+}
+
+/**
+ * GET /api/images/batch?id=<batchId>
+ *
+ * Per-image progress for a queued batch. Images are ordered by, and carry,
+ * the index of the prompt they were generated from; failed prompts are
+ * listed in errors by the same index.
+ */
+export async function GET(request: NextRequest) {
+  try {
+    const { userId } = await auth();
+    if (!userId) {
+      return NextResponse.json(
+        { success: false, error: "Unauthorized" },
+        { status: 401 }
+      );
+    }
+
+    const batchId = request.nextUrl.searchParams.get("id");
+    if (!batchId) {
+      return NextResponse.json(
+        { success: false, error: "id parameter required" },
+        { status: 400 }
+      );
+    }
+
+    const job = await getBatchJob(batchId, userId);
+    if (!job) {
+      return NextResponse.json(
+        { success: false, error: "Batch not found" },
+        { status: 404 }
+      );
+    }
+
+    const rows = job.imageIds.length
+      ? await prisma.image.findMany({
+          where: { id: { in: job.imageIds } },
+          select: {
+            id: true,
+            externalId: true,
+            imageUrl: true,
+            thumbnailUrl: true,
+            originalPrompt: true,
+            aspectRatio: true,
+          },
+        })
+      : [];
+
+    // imageIds are in completion order; imageIndexes maps each to its prompt
+    const rowsById = new Map(rows.map((row) => [row.id, row]));
+    const images = job.imageIds
+      .flatMap((imageId, i) => {
+        const row = rowsById.get(imageId);
+        return row ? [{ index: job.imageIndexes[i], ...row }] : [];
+      })
+      .sort((a, b) => a.index - b.index);
+
     return NextResponse.json({
       success: true,
-      batchId: result.batchId,
+      batchId: job.id,
+      status: job.status,
       summary: {
-        totalRequested: result.totalRequested,
-        completed: result.completed,
-        failed: result.failed,
+        totalRequested: job.totalImages,
+        completed: job.completedImages,
+        failed: job.failedImages,
+        pending: job.totalImages - job.completedImages - job.failedImages,
       },
-      images: result.images.map((img) => ({
-        id: img.id,
-        externalId: img.externalId,
-        imageUrl: img.imageUrl,
-        originalPrompt: img.originalPrompt,
-        enhancedPrompt: img.enhancedPrompt,
-        aspectRatio: img.aspectRatio,
-        isWatermarked: img.isWatermarked,
-      })),
-      errors: result.errors.length > 0 ? result.errors : undefined,
+      images,
+      errors: job.errors.length > 0 ? job.errors : undefined,
+      startedAt: job.startedAt,
+      completedAt: job.completedAt,
     });
   } catch (error) {
-    console.error("Batch generation error:", error);
+    console.error("Batch status error:", error);
     return NextResponse.json(
       {
         success: false,
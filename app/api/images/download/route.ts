@@ -1,16 +1,39 @@
 import { NextRequest, NextResponse } from "next/server";
 import { auth } from "@clerk/nextjs/server";
+import {
+  extractR2Key,
+  getR2ObjectStream,
+  isR2Available,
+  isR2Url,
+  type R2ObjectStream,
+} from "@/lib/r2";
+import {
+  collectStream,
+  computeETag,
+  downloadCache,
+  etagMatches,
+  parseRange,
+  type CachedObject,
+} from "@/lib/download-cache";
 
 /**
  * Image Download API
- * 
+ *
  * This endpoint proxies image downloads to handle CORS issues.
  * The browser can't download cross-origin images directly, so we
- * fetch the image server-side and return it.
- * 
+ * fetch the image server-side and stream it back.
+ *
+ * - R2 objects are read directly through the R2 client
+ * - Range and If-None-Match are supported (resumable downloads, 304s)
+ * - Recently downloaded images are served from an in-process byte cache
+ *
  * GET /api/images/download?url=<imageUrl>&filename=<filename>
  */
 
+// R2 keys are unique per image, so R2 downloads can be cached by the browser forever
+const IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable";
+const REVALIDATE_CACHE_CONTROL = "private, no-cache";
+
 export async function GET(request: NextRequest) {
   try {
     // Verify authentication
@@ -50,47 +73,98 @@ export async function GET(request: NextRequest) {
       );
     }
 
-    // Fetch the image
-    const response = await fetch(url, {
-      headers: {
-        Accept: "image/*",
-      },
-    });
+    const rangeHeader = request.headers.get("Range");
+    const ifNoneMatch = request.headers.get("If-None-Match");
+
+    const r2Key = isR2Available() && isR2Url(url) ? extractR2Key(url) : null;
+    const cacheKey = r2Key ? `r2:${r2Key}` : url;
+    const cacheControl = r2Key ? IMMUTABLE_CACHE_CONTROL : REVALIDATE_CACHE_CONTROL;
+
+    // Serve hot images from memory
+    const cached = downloadCache.get(cacheKey);
+    if (cached) {
+      return respondFromCache(cached, filename, cacheControl, rangeHeader, ifNoneMatch);
+    }
+
+    // Stream from R2 or the upstream URL
+    const upstream = r2Key
+      ? await getR2ObjectStream(r2Key, {
+          range: rangeHeader ?? undefined,
+          ifNoneMatch: ifNoneMatch ?? undefined,
+        })
+      : await fetchUpstream(url, rangeHeader, ifNoneMatch);
+
+    if (!upstream) {
+      return NextResponse.json({ error: "Failed to fetch image" }, { status: 502 });
+    }
+
+    if (upstream.status === 304) {
+      return new NextResponse(null, {
+        status: 304,
+        headers: {
+          ...(upstream.etag && { ETag: upstream.etag }),
+          "Cache-Control": cacheControl,
+        },
+      });
+    }
 
-    if (!response.ok) {
+    if (upstream.status === 416) {
+      return new NextResponse(null, {
+        status: 416,
+        headers: upstream.contentRange ? { "Content-Range": upstream.contentRange } : {},
+      });
+    }
+
+    if ((upstream.status !== 200 && upstream.status !== 206) || !upstream.body) {
       return NextResponse.json(
-        { error: `Failed to fetch image: ${response.status}` },
-        { status: response.status }
+        { error: `Failed to fetch image: ${upstream.status}` },
+        { status: upstream.status >= 400 ? upstream.status : 502 }
       );
     }
 
-    // Get the image data
-    const imageBuffer = await response.arrayBuffer();
-    const contentType = response.headers.get("Content-Type") || "image/png";
-
-    // Determine file extension
-    let extension = "png";
-    if (contentType.includes("jpeg") || contentType.includes("jpg")) {
-      extension = "jpg";
-    } else if (contentType.includes("webp")) {
-      extension = "webp";
-    } else if (contentType.includes("gif")) {
-      extension = "gif";
-    }
+    const contentType = upstream.contentType || "image/png";
+    let body = upstream.body;
 
-    // Ensure filename has correct extension
-    const finalFilename = filename.includes(".")
-      ? filename
-      : `${filename}.${extension}`;
+    // Fill the cache from full responses small enough to keep
+    const cacheable =
+      upstream.status === 200 &&
+      (upstream.contentLength === undefined ||
+        upstream.contentLength <= downloadCache.maxEntryBytes);
+
+    if (cacheable) {
+      const [clientBranch, cacheBranch] = body.tee();
+      body = clientBranch;
+
+      collectStream(cacheBranch, downloadCache.maxEntryBytes)
+        .then((bytes) => {
+          if (!bytes) return;
+          downloadCache.set(cacheKey, {
+            body: bytes,
+            contentType,
+            etag: upstream.etag || computeETag(bytes),
+            lastModified: upstream.lastModified,
+          });
+        })
+        .catch((error) => {
+          console.error("Download cache fill failed:", error);
+        });
+    }
 
-    // Return the image with download headers
-    return new NextResponse(imageBuffer, {
-      status: 200,
+    return new NextResponse(body, {
+      status: upstream.status,
       headers: {
         "Content-Type": contentType,
-        "Content-Disposition": `attachment; filename="${finalFilename}"`,
-        "Content-Length": imageBuffer.byteLength.toString(),
-        "Cache-Control": "no-cache",
+        "Content-Disposition": contentDisposition(filename, contentType),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": cacheControl,
+        ...(upstream.contentLength !== undefined && {
+          "Content-Length": upstream.contentLength.toString(),
+        }),
+        ...(upstream.contentRange && { "Content-Range": upstream.contentRange }),
+        ...(upstream.etag && { ETag: upstream.etag }),
+        ...(upstream.lastModified && {
+          "Last-Modified": upstream.lastModified.toUTCString(),
+        }),
       },
     });
   } catch (error) {
@@ -101,3 +175,114 @@ export async function GET(request: NextRequest) {
     );
   }
 }
+
+/**
+ * Fetch a non-R2 image, forwarding Range and If-None-Match
+ */
+async function fetchUpstream(
+  url: string,
+  range: string | null,
+  ifNoneMatch: string | null
+): Promise<R2ObjectStream> {
+  const response = await fetch(url, {
+    headers: {
+      Accept: "image/*",
+      ...(range && { Range: range }),
+      ...(ifNoneMatch && { "If-None-Match": ifNoneMatch }),
+    },
+  });
+
+  const contentLength = response.headers.get("Content-Length");
+  const lastModified = response.headers.get("Last-Modified");
+
+  return {
+    status: response.status,
+    body: response.body ?? undefined,
+    contentType: response.headers.get("Content-Type") ?? undefined,
+    contentLength: contentLength ? parseInt(contentLength, 10) : undefined,
+    contentRange: response.headers.get("Content-Range") ?? undefined,
+    etag: response.headers.get("ETag") ?? undefined,
+    lastModified: lastModified ? new Date(lastModified) : undefined,
+  };
+}
+
+/**
+ * Serve a cached image, honouring If-None-Match and Range
+ */
+function respondFromCache(
+  cached: CachedObject,
+  filename: string,
+  cacheControl: string,
+  rangeHeader: string | null,
+  ifNoneMatch: string | null
+): NextResponse {
+  const size = cached.body.byteLength;
+  const headers: Record<string, string> = {
+    "Content-Type": cached.contentType,
+    "Content-Disposition": contentDisposition(filename, cached.contentType),
+    "Accept-Ranges": "bytes",
+    "Cache-Control": cacheControl,
+    ETag: cached.etag,
+    ...(cached.lastModified && {
+      "Last-Modified": cached.lastModified.toUTCString(),
+    }),
+  };
+
+  if (etagMatches(ifNoneMatch, cached.etag)) {
+    return new NextResponse(null, {
+      status: 304,
+      headers: { ETag: cached.etag, "Cache-Control": cacheControl },
+    });
+  }
+
+  const range = parseRange(rangeHeader, size);
+
+  if (range === "unsatisfiable") {
+    return new NextResponse(null, {
+      status: 416,
+      headers: { "Content-Range": `bytes */${size}` },
+    });
+  }
+
+  if (range) {
+    const slice = cached.body.subarray(range.start, range.end + 1);
+    return new NextResponse(slice, {
+      status: 206,
+      headers: {
+        ...headers,
+        "Content-Range": `bytes ${range.start}-${range.end}/${size}`,
+        "Content-Length": slice.byteLength.toString(),
+      },
+    });
+  }
+
+  return new NextResponse(cached.body, {
+    status: 200,
+    headers: {
+      ...headers,
+      "Content-Length": size.toString(),
+    },
+  });
+}
+
+/**
+ * Attachment header with an extension matching the content type
+ */
+function contentDisposition(filename: string, contentType: string): string {
+  // Determine file extension
+  let extension = "png";
+  if (contentType.includes("jpeg") || contentType.includes("jpg")) {
+    extension = "jpg";
+  } else if (contentType.includes("webp")) {
+    extension = "webp";
+  } else if (contentType.includes("gif")) {
+    extension = "gif";
+  }
+
+  // Ensure filename has correct extension
+  const finalFilename = filename.includes(".")
+    ? filename
+    : `${filename}.${extension}`;
+
+  return `attachment; filename="${finalFilename}"`;
+}
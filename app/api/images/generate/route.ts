@@ -3,11 +3,20 @@
  *
  * Main image generation endpoint for ImageCraft
  * Handles both single image generation and provides enhanced prompts
+ *
+ * Every response carries a Server-Timing header with per-stage durations
+ * (auth, provision, credits, enhance, image_gen, db, usage).
  */
 
 import { NextRequest, NextResponse } from "next/server";
 import { auth, currentUser } from "@clerk/nextjs/server";
-import { imageGenerationService, type GenerateImageRequest } from "@/lib/services/image-generation";
+import { generateImage } from "@/lib/services/image-generation";
+import {
+  PromptEnhancementService,
+  type EnhancedPrompt,
+} from "@/lib/services/prompt-enhancement";
+import { getTemplate } from "@/lib/template-catalog";
+import { StageTimer, runWithTimer, timeStage } from "@/lib/timing";
 import { prisma } from "@/lib/prisma";
 import { z } from "zod";
 
@@ -24,10 +33,19 @@ const generateRequestSchema = z.object({
   skipEnhancement: z.boolean().default(false),
 });
 
+const promptEnhancer = new PromptEnhancementService();
+
 export async function POST(request: NextRequest) {
+  const timer = new StageTimer();
+  const response = await runWithTimer(timer, () => handleGenerate(request));
+  response.headers.set("Server-Timing", timer.toServerTiming());
+  return response;
+}
+
+async function handleGenerate(request: NextRequest): Promise<NextResponse> {
   try {
     // Authenticate user
-    const { userId } = await auth();
+    const { userId } = await timeStage("auth", () => auth());
     if (!userId) {
       return NextResponse.json(
         { success: false, error: "Unauthorized" },
@@ -37,9 +55,11 @@ export async function POST(request: NextRequest) {
 
     // Auto-provision user if they don't exist in database
     // This handles cases where the Clerk webhook hasn't fired yet
-    const existingUser = await prisma.user.findUnique({
-      where: { id: userId },
-    });
+    const existingUser = await timeStage("provision", () =>
+      prisma.user.findUnique({
+        where: { id: userId },
+      })
+    );
 
     if (!existingUser) {
       const clerkUser = await currentUser();
@@ -106,18 +126,56 @@ export async function POST(request: NextRequest) {
       );
     }
 
-    const requestData: GenerateImageRequest = {
+    const {
+      prompt,
+      projectId,
+      templateSlug,
+      presetSlug,
+      aspectRatio,
+      resolution,
+      styleHints,
+      skipEnhancement,
+    } = validationResult.data;
+
+    // Resolve template/preset slugs to IDs
+    const template = templateSlug ? await getTemplate(templateSlug) : null;
+    const preset = template?.presets.find((p) => p.slug === presetSlug);
+
+    // Generate the image. Enhancement (memoized; falls back locally if the
+    // gateway is down) runs only once the plan check and credit reservation
+    // have passed, so rejected requests don't spend gateway calls.
+    const enhancement: { result?: EnhancedPrompt } = {};
+    const result = await generateImage({
       userId,
-      ...validationResult.data,
-    };
-
-    // Generate the image
-    const result = await imageGenerationService.generateImage(requestData);
+      prompt,
+      resolution,
+      aspectRatio,
+      templateId: template?.id,
+      presetId: preset?.id,
+      projectId,
+      enhance: skipEnhancement
+        ? undefined
+        : async () => {
+            const enhanced = await timeStage("enhance", () =>
+              promptEnhancer.enhancePrompt({
+                userPrompt: prompt,
+                templateSlug,
+                presetSlug,
+                projectId,
+                aspectRatio,
+                styleHints,
+              })
+            );
+            enhancement.result = enhanced;
+            return { enhancedPrompt: enhanced.enhancedPrompt, aspectRatio: enhanced.aspectRatio };
+          },
+    });
+    const enhanced = enhancement.result;
 
     if (!result.success) {
       // Determine appropriate status code
-      const statusCode = result.error?.includes("limit") ? 429 : 
-                         result.error?.includes("requires") ? 403 : 
+      const statusCode = result.error?.includes("credits") ? 429 :
+                         result.error?.includes("requires") ? 403 :
                          500;
 
       return NextResponse.json(
@@ -133,18 +191,13 @@ export async function POST(request: NextRequest) {
     return NextResponse.json({
       success: true,
       image: {
-        id: result.image!.id,
-        externalId: result.image!.externalId,
-        imageUrl: result.image!.imageUrl,
-        originalPrompt: result.image!.originalPrompt,
-        enhancedPrompt: result.image!.enhancedPrompt,
-        aspectRatio: result.image!.aspectRatio,
-        resolution: result.image!.resolution,
-        isWatermarked: result.image!.isWatermarked,
-        createdAt: result.image!.generatedAt,
+        ...result.image!,
+        originalPrompt: prompt,
+        enhancedPrompt: enhanced?.enhancedPrompt ?? null,
+        aspectRatio: enhanced?.aspectRatio ?? aspectRatio,
       },
-      usageRemaining: result.usageRemaining,
-      recommendations: result.recommendations,
+      creditsRemaining: result.creditsRemaining,
+      recommendations: enhanced?.recommendations,
     });
   } catch (error) {
     console.error("Image generation error:", error);
@@ -0,0 +1,53 @@
+import { NextRequest, NextResponse } from "next/server";
+import { getImageIngestStats } from "@/lib/services/image-ingest";
+import { getDerivativePoolStats } from "@/lib/image-derivatives";
+import { getPromptEnhancementStats } from "@/lib/services/prompt-enhancement";
+import { getTemplateCatalogStats } from "@/lib/template-catalog";
+import { getUpstreamStats } from "@/lib/upstream";
+
+/**
+ * Operational metrics for background pipelines
+ *
+ * GET /api/metrics
+ *
+ * Headers:
+ *   Authorization: Bearer <METRICS_SECRET or CRON_SECRET>
+ *
+ * In production the endpoint is closed (401) until one of the secrets is set.
+ */
+
+export async function GET(request: NextRequest) {
+  try {
+    // Verify secret to prevent unauthorized access
+    const authHeader = request.headers.get("Authorization");
+    const secret = process.env.METRICS_SECRET || process.env.CRON_SECRET;
+
+    // Without a secret the endpoint is only open outside production
+    const authorized = secret
+      ? authHeader === `Bearer ${secret}`
+      : process.env.NODE_ENV !== "production";
+    if (!authorized) {
+      return NextResponse.json({ error: "Unauthorized" }, { status: 401 });
+    }
+
+    const r2Ingest = await getImageIngestStats();
+
+    return NextResponse.json({
+      r2Ingest,
+      derivativePool: getDerivativePoolStats(),
+      promptEnhancement: getPromptEnhancementStats(),
+      templateCatalog: getTemplateCatalogStats(),
+      upstreams: getUpstreamStats(),
+      timestamp: new Date().toISOString(),
+    });
+  } catch (error) {
+    console.error("[Metrics] Error:", error);
+    return NextResponse.json(
+      {
+        error: "Metrics unavailable",
+        message: error instanceof Error ? error.message : "Unknown error",
+      },
+      { status: 500 }
+    );
+  }
+}
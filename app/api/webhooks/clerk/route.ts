@@ -8,6 +8,7 @@ import { NextRequest, NextResponse } from "next/server";
 import { headers } from "next/headers";
 import { Webhook } from "svix";
 import { prisma } from "@/lib/prisma";
+import { invalidateSubscriptionView } from "@/lib/credits";
 
 const webhookSecret = process.env.CLERK_WEBHOOK_SECRET!;
 
@@ -114,6 +115,7 @@ async function handleUserCreated(userData: ClerkUserData) {
     },
   });
 
+  invalidateSubscriptionView(user.id);
   console.log(`Created user and free subscription: ${user.id}`);
 }
 
@@ -142,4 +144,6 @@ async function handleUserDeleted(userData: ClerkUserData) {
   await prisma.user.delete({
     where: { id: userData.id },
   });
+
+  invalidateSubscriptionView(userData.id);
 }
@@ -8,6 +8,7 @@ import { NextRequest, NextResponse } from "next/server";
 import { headers } from "next/headers";
 import Stripe from "stripe";
 import { prisma } from "@/lib/prisma";
+import { invalidateSubscriptionView } from "@/lib/credits";
 import type { PlanTier, SubscriptionStatus } from "@prisma/client";
 
 const stripe = new Stripe(process.env.STRIPE_SECRET_KEY!);
@@ -193,6 +194,8 @@ async function handleSubscriptionUpdated(subscription: Stripe.Subscription) {
       imagesUsedThisPeriod: 0,
     },
   });
+
+  invalidateSubscriptionView(user.id);
 }
 
 async function handleSubscriptionDeleted(subscription: Stripe.Subscription) {
@@ -213,6 +216,8 @@ async function handleSubscriptionDeleted(subscription: Stripe.Subscription) {
       ...PLAN_CONFIG.FREE,
     },
   });
+
+  invalidateSubscriptionView(user.id);
 }
 
 async function handleInvoicePaid(invoice: Stripe.Invoice) {
@@ -232,6 +237,8 @@ async function handleInvoicePaid(invoice: Stripe.Invoice) {
         imagesUsedThisPeriod: 0, // Reset counter for new period
       },
     });
+
+    invalidateSubscriptionView(subscription.userId);
   }
 }
 
@@ -251,4 +258,6 @@ async function handleInvoiceFailed(invoice: Stripe.Invoice) {
       stripeStatus: "PAST_DUE",
     },
   });
+
+  invalidateSubscriptionView(user.id);
 }
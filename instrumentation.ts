@@ -0,0 +1,22 @@
+/**
+ * Next.js instrumentation hook
+ *
+ * Runs once per server process at startup. Starts background workers that
+ * need a long-lived Node.js process (not available in the edge runtime).
+ */
+
+export async function register() {
+  if (process.env.NEXT_RUNTIME !== "nodejs") return;
+
+  // Batch job worker (set BATCH_WORKER_ENABLED=false on nodes that should only serve requests)
+  if (process.env.BATCH_WORKER_ENABLED !== "false") {
+    const { startBatchWorker } = await import("@/lib/services/batch-processor");
+    startBatchWorker();
+  }
+
+  // R2 ingest worker (no-op when R2 is not configured)
+  if (process.env.R2_INGEST_ENABLED !== "false") {
+    const { startImageIngestWorker } = await import("@/lib/services/image-ingest");
+    startImageIngestWorker();
+  }
+}
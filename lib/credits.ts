@@ -0,0 +1,242 @@
+/**
+ * Credit Ledger
+ *
+ * Race-free credit accounting for generations:
+ * - reserveCredits: one conditional UPDATE (remaining >= cost), so concurrent
+ *   requests can never overspend
+ * - commitCredits / refundCredits: settle a reservation (commit writes the
+ *   UsageRecord). Both take an optional transaction client so callers can
+ *   settle in the same transaction as their own writes
+ *
+ * Also provides a per-process, TTL-bounded cache of each user's plan and
+ * limits (getSubscriptionView). Webhooks that change a subscription call
+ * invalidateSubscriptionView; other nodes pick up changes when the TTL lapses.
+ */
+
+import type { Prisma } from "@prisma/client";
+import { prisma } from "@/lib/prisma";
+import type { PlanTier, Resolution } from "@/lib/plans";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+const SUBSCRIPTION_CACHE_TTL_MS = parseInt(
+  process.env.SUBSCRIPTION_CACHE_TTL_MS || "60000"
+);
+const SUBSCRIPTION_CACHE_MAX_ENTRIES = 10_000;
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+type Db = typeof prisma | Prisma.TransactionClient;
+
+/**
+ * Plan and limits for a user. Deliberately excludes creditsUsed, which
+ * changes on every generation and is only read through reservations.
+ */
+export interface SubscriptionView {
+  subscriptionId: string;
+  userId: string;
+  plan: PlanTier;
+  creditsLimit: number;
+  maxResolution: Resolution;
+  hasWatermark: boolean;
+}
+
+export interface CreditReservation {
+  subscriptionId: string;
+  userId: string;
+  amount: number;
+  remaining: number; // Credits left after this reservation
+}
+
+export interface UsageDetails {
+  resolution: Resolution;
+  imageId: string;
+  apiLatencyMs?: number; // Image-gen API round trip
+}
+
+// =============================================================================
+// SUBSCRIPTION VIEW CACHE
+// =============================================================================
+
+const subscriptionCache = new Map<
+  string,
+  { view: SubscriptionView; expiresAt: number }
+>();
+
+/**
+ * Get a user's plan and limits, from cache when fresh
+ * Returns null if the user has no subscription yet.
+ */
+export async function getSubscriptionView(
+  userId: string
+): Promise<SubscriptionView | null> {
+  const cached = subscriptionCache.get(userId);
+  if (cached && cached.expiresAt > Date.now()) {
+    return cached.view;
+  }
+
+  const subscription = await prisma.subscription.findUnique({
+    where: { userId },
+  });
+
+  if (!subscription) {
+    subscriptionCache.delete(userId);
+    return null;
+  }
+
+  const view: SubscriptionView = {
+    subscriptionId: subscription.id,
+    userId,
+    plan: subscription.plan as PlanTier,
+    creditsLimit: subscription.creditsLimit,
+    maxResolution: subscription.maxResolution as Resolution,
+    hasWatermark: subscription.hasWatermark,
+  };
+
+  // Bound memory: drop the oldest entry when full (Map keeps insertion order)
+  if (subscriptionCache.size >= SUBSCRIPTION_CACHE_MAX_ENTRIES) {
+    const oldest = subscriptionCache.keys().next().value;
+    if (oldest !== undefined) subscriptionCache.delete(oldest);
+  }
+
+  subscriptionCache.delete(userId);
+  subscriptionCache.set(userId, {
+    view,
+    expiresAt: Date.now() + SUBSCRIPTION_CACHE_TTL_MS,
+  });
+
+  return view;
+}
+
+/**
+ * Drop a cached subscription view (or all of them)
+ */
+export function invalidateSubscriptionView(userId?: string): void {
+  if (userId) {
+    subscriptionCache.delete(userId);
+  } else {
+    subscriptionCache.clear();
+  }
+}
+
+// =============================================================================
+// RESERVATIONS
+// =============================================================================
+
+/**
+ * Atomically reserve credits
+ *
+ * Succeeds only if the user has at least `amount` credits left. A monthly
+ * reset that is due is applied in the same statement.
+ * Returns null if there aren't enough credits (or no subscription).
+ */
+export async function reserveCredits(
+  userId: string,
+  amount: number,
+  db: Db = prisma
+): Promise<CreditReservation | null> {
+  const nextResetAt = getNextResetDate();
+
+  const rows = await db.$queryRaw<
+    Array<{ id: string; creditsLimit: number; creditsUsed: number }>
+  >`
+    UPDATE "Subscription"
+    SET "creditsUsed" = CASE
+          WHEN now() >= "creditsResetAt" THEN ${amount}
+          ELSE "creditsUsed" + ${amount}
+        END,
+        "creditsResetAt" = CASE
+          WHEN now() >= "creditsResetAt" THEN ${nextResetAt}
+          ELSE "creditsResetAt"
+        END
+    WHERE "userId" = ${userId}
+      AND (
+        (now() >= "creditsResetAt" AND "creditsLimit" >= ${amount})
+        OR "creditsLimit" - "creditsUsed" >= ${amount}
+      )
+    RETURNING "id", "creditsLimit", "creditsUsed"
+  `;
+
+  const row = rows[0];
+  if (!row) {
+    return null;
+  }
+
+  return {
+    subscriptionId: row.id,
+    userId,
+    amount,
+    remaining: row.creditsLimit - row.creditsUsed,
+  };
+}
+
+/**
+ * Settle (part of) a reservation as used, recording usage
+ */
+export async function commitCredits(
+  reservation: Pick<CreditReservation, "userId">,
+  amount: number,
+  usage: UsageDetails,
+  db: Db = prisma
+): Promise<void> {
+  await db.usageRecord.create({
+    data: buildUsageRecord(reservation.userId, amount, usage),
+  });
+}
+
+/**
+ * Return (part of) a reservation to the user's balance
+ */
+export async function refundCredits(
+  reservation: Pick<CreditReservation, "subscriptionId">,
+  amount: number,
+  db: Db = prisma
+): Promise<void> {
+  if (amount <= 0) return;
+
+  await db.$executeRaw`
+    UPDATE "Subscription"
+    SET "creditsUsed" = GREATEST("creditsUsed" - ${amount}, 0)
+    WHERE "id" = ${reservation.subscriptionId}
+  `;
+}
+
+// =============================================================================
+// HELPER FUNCTIONS
+// =============================================================================
+
+/**
+ * Usage record payload for a charged generation
+ */
+function buildUsageRecord(userId: string, credits: number, usage: UsageDetails) {
+  return {
+    userId,
+    action: "generate",
+    creditsUsed: credits,
+    resolution: usage.resolution,
+    imageId: usage.imageId,
+    estimatedCost: getEstimatedCost(usage.resolution),
+    apiLatencyMs: usage.apiLatencyMs,
+  };
+}
+
+export function getNextResetDate(): Date {
+  const now = new Date();
+  const nextMonth = new Date(now.getFullYear(), now.getMonth() + 1, 1);
+  return nextMonth;
+}
+
+function getEstimatedCost(resolution: Resolution): number {
+  switch (resolution) {
+    case "4K":
+      return 0.05;
+    case "2K":
+      return 0.025;
+    default:
+      return 0.01;
+  }
+}
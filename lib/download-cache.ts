@@ -0,0 +1,192 @@
+/**
+ * Download Cache
+ *
+ * Size-bounded, in-process LRU of recently downloaded image bytes.
+ * Serves repeat downloads of hot images (and their Range/ETag requests)
+ * without going back to R2 or the image-gen service.
+ */
+
+import { createHash } from "crypto";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+const MAX_BYTES =
+  parseInt(process.env.DOWNLOAD_CACHE_MAX_MB || "256") * 1024 * 1024;
+// Larger objects are streamed through but never cached
+const MAX_ENTRY_BYTES =
+  parseInt(process.env.DOWNLOAD_CACHE_MAX_ENTRY_MB || "16") * 1024 * 1024;
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+export interface CachedObject {
+  body: Uint8Array;
+  contentType: string;
+  etag: string;
+  lastModified?: Date;
+}
+
+// =============================================================================
+// LRU CACHE
+// =============================================================================
+
+class ByteLRUCache {
+  private entries = new Map<string, CachedObject>();
+  private bytes = 0;
+  private hits = 0;
+  private misses = 0;
+
+  constructor(
+    private maxBytes: number,
+    readonly maxEntryBytes: number
+  ) {}
+
+  get(key: string): CachedObject | undefined {
+    const entry = this.entries.get(key);
+    if (!entry) {
+      this.misses++;
+      return undefined;
+    }
+
+    // Re-insert to mark as most recently used
+    this.entries.delete(key);
+    this.entries.set(key, entry);
+    this.hits++;
+    return entry;
+  }
+
+  set(key: string, entry: CachedObject): void {
+    const size = entry.body.byteLength;
+    if (size > this.maxEntryBytes || size > this.maxBytes) return;
+
+    this.delete(key);
+    this.entries.set(key, entry);
+    this.bytes += size;
+
+    // Evict least recently used entries (Map iterates in insertion order)
+    for (const [oldestKey] of this.entries) {
+      if (this.bytes <= this.maxBytes) break;
+      this.delete(oldestKey);
+    }
+  }
+
+  delete(key: string): void {
+    const existing = this.entries.get(key);
+    if (existing) {
+      this.bytes -= existing.body.byteLength;
+      this.entries.delete(key);
+    }
+  }
+
+  stats() {
+    return {
+      entries: this.entries.size,
+      bytes: this.bytes,
+      maxBytes: this.maxBytes,
+      hits: this.hits,
+      misses: this.misses,
+    };
+  }
+}
+
+export const downloadCache = new ByteLRUCache(MAX_BYTES, MAX_ENTRY_BYTES);
+
+// =============================================================================
+// HELPER FUNCTIONS
+// =============================================================================
+
+/**
+ * Strong ETag from content, for upstreams that don't send one
+ */
+export function computeETag(body: Uint8Array): string {
+  return `"${createHash("sha1").update(body).digest("hex")}"`;
+}
+
+/**
+ * Check an If-None-Match header against an ETag (weak comparison)
+ */
+export function etagMatches(ifNoneMatch: string | null, etag: string): boolean {
+  if (!ifNoneMatch) return false;
+  if (ifNoneMatch.trim() === "*") return true;
+
+  const normalize = (tag: string) => tag.trim().replace(/^W\//, "");
+  const target = normalize(etag);
+  return ifNoneMatch.split(",").some((tag) => normalize(tag) === target);
+}
+
+/**
+ * Parse a single-range Range header against a known size
+ *
+ * Returns null when there is no usable range (serve the full body), or
+ * "unsatisfiable" when the range lies outside the object.
+ * Multi-range requests are served in full.
+ */
+export function parseRange(
+  header: string | null,
+  size: number
+): { start: number; end: number } | "unsatisfiable" | null {
+  if (!header) return null;
+
+  const match = /^bytes=(\d*)-(\d*)$/.exec(header.trim());
+  if (!match) return null;
+
+  const [, startStr, endStr] = match;
+  let start: number;
+  let end: number;
+
+  if (startStr === "") {
+    // Suffix range: last N bytes
+    if (endStr === "") return null;
+    const suffix = parseInt(endStr, 10);
+    if (suffix === 0) return "unsatisfiable";
+    start = Math.max(0, size - suffix);
+    end = size - 1;
+  } else {
+    start = parseInt(startStr, 10);
+    end = endStr === "" ? size - 1 : Math.min(parseInt(endStr, 10), size - 1);
+  }
+
+  if (start >= size) return "unsatisfiable";
+  if (start > end) return null;
+  return { start, end };
+}
+
+/**
+ * Read a stream into memory up to `limit` bytes.
+ * Returns null (and cancels the stream) if the limit is exceeded.
+ */
+export async function collectStream(
+  stream: ReadableStream<Uint8Array>,
+  limit: number
+): Promise<Uint8Array | null> {
+  const reader = stream.getReader();
+  const chunks: Uint8Array[] = [];
+  let total = 0;
+
+  try {
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+
+      total += value.byteLength;
+      if (total > limit) {
+        await reader.cancel();
+        return null;
+      }
+      chunks.push(value);
+    }
+  } catch {
+    return null;
+  }
+
+  const body = new Uint8Array(total);
+  let offset = 0;
+  for (const chunk of chunks) {
+    body.set(chunk, offset);
+    offset += chunk.byteLength;
+  }
+  return body;
+}
@@ -0,0 +1,305 @@
+/**
+ * Image Derivatives
+ *
+ * Builds responsive renditions (AVIF/WebP at VARIANT_WIDTHS) and a blur
+ * placeholder for each generated image:
+ * - Each source image is decoded once; all outputs come from that decode
+ * - Encoding runs in a worker-thread pool sized to the cores, never on the
+ *   request-serving event loop
+ * - Outputs are content-addressed (sha256 of the source), so duplicate
+ *   images reuse existing renditions instead of re-encoding
+ *
+ * The decoder needs the whole source in memory, so sources are buffered up to
+ * DERIVATIVE_MAX_SOURCE_BYTES; larger images are stored without renditions.
+ */
+
+import { Worker } from "worker_threads";
+import { availableParallelism } from "os";
+import { createHash } from "crypto";
+import { prisma } from "@/lib/prisma";
+import { uploadToR2 } from "@/lib/r2";
+import {
+  VARIANT_FORMATS,
+  VARIANT_WIDTHS,
+  type ImageVariant,
+  type VariantFormat,
+} from "@/lib/image-variants";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+const POOL_SIZE = parseInt(
+  process.env.DERIVATIVE_WORKERS || String(Math.max(1, availableParallelism() - 1))
+);
+const WEBP_QUALITY = 80;
+const AVIF_QUALITY = 55;
+// Largest source buffered for renditions (4K PNGs are typically 10-30MB)
+export const DERIVATIVE_MAX_SOURCE_BYTES = parseInt(
+  process.env.DERIVATIVE_MAX_SOURCE_BYTES || String(48 * 1024 * 1024)
+);
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+export class SourceTooLargeError extends Error {
+  constructor(limit: number) {
+    super(`Source image exceeds ${limit} bytes`);
+    this.name = "SourceTooLargeError";
+  }
+}
+
+export interface ImageDerivatives {
+  contentHash: string;
+  variants: ImageVariant[];
+  blurDataUrl: string;
+}
+
+interface WorkerOutput {
+  width: number;
+  height: number;
+  format: VariantFormat;
+  data: ArrayBuffer;
+}
+
+type WorkerResult =
+  | {
+      id: number;
+      ok: true;
+      width: number;
+      height: number;
+      blurDataUrl: string;
+      outputs: WorkerOutput[];
+    }
+  | { id: number; ok: false; error: string };
+
+interface PendingTask {
+  id: number;
+  buffer: ArrayBuffer;
+  resolve: (result: WorkerResult) => void;
+  reject: (error: Error) => void;
+}
+
+// =============================================================================
+// WORKER POOL
+// =============================================================================
+
+class DerivativePool {
+  private idle: Worker[] = [];
+  private busy = new Map<Worker, PendingTask>();
+  private queue: PendingTask[] = [];
+  private size = 0;
+  private nextId = 0;
+
+  constructor(private maxSize: number) {}
+
+  run(buffer: ArrayBuffer): Promise<WorkerResult> {
+    return new Promise((resolve, reject) => {
+      this.queue.push({ id: this.nextId++, buffer, resolve, reject });
+      this.dispatch();
+    });
+  }
+
+  stats() {
+    return {
+      size: this.size,
+      maxSize: this.maxSize,
+      busy: this.busy.size,
+      queued: this.queue.length,
+    };
+  }
+
+  private dispatch(): void {
+    while (this.queue.length > 0) {
+      const worker = this.idle.pop() ?? this.spawn();
+      if (!worker) return;
+
+      const task = this.queue.shift()!;
+      this.busy.set(worker, task);
+      worker.ref();
+      worker.postMessage(
+        {
+          id: task.id,
+          buffer: task.buffer,
+          widths: VARIANT_WIDTHS,
+          formats: VARIANT_FORMATS,
+          webpQuality: WEBP_QUALITY,
+          avifQuality: AVIF_QUALITY,
+        },
+        [task.buffer]
+      );
+    }
+  }
+
+  private spawn(): Worker | null {
+    if (this.size >= this.maxSize) return null;
+
+    const worker = new Worker(new URL("./workers/derivative-worker.mjs", import.meta.url));
+    this.size++;
+
+    worker.on("message", (result: WorkerResult) => {
+      const task = this.busy.get(worker);
+      this.busy.delete(worker);
+      // Don't keep short-lived processes (scripts) alive for an idle pool
+      worker.unref();
+      this.idle.push(worker);
+      task?.resolve(result);
+      this.dispatch();
+    });
+
+    worker.on("error", (error) => {
+      console.error("[Derivatives] Worker error:", error);
+      this.busy.get(worker)?.reject(error);
+      this.busy.delete(worker);
+    });
+
+    worker.on("exit", () => {
+      this.size--;
+      this.idle = this.idle.filter((w) => w !== worker);
+      const task = this.busy.get(worker);
+      if (task) {
+        this.busy.delete(worker);
+        task.reject(new Error("Derivative worker exited"));
+      }
+      this.dispatch();
+    });
+
+    return worker;
+  }
+}
+
+// Survive hot reloads in development (same pattern as lib/prisma.ts)
+const globalForDerivatives = globalThis as unknown as {
+  derivativePool: DerivativePool | undefined;
+};
+
+const pool =
+  globalForDerivatives.derivativePool ??
+  (globalForDerivatives.derivativePool = new DerivativePool(POOL_SIZE));
+
+// =============================================================================
+// PUBLIC API
+// =============================================================================
+
+/**
+ * Read an image stream into memory, hashing it incrementally as chunks arrive.
+ * Stops reading (and cancels the stream) once it exceeds `maxBytes`.
+ */
+export async function readImageStream(
+  stream: ReadableStream<Uint8Array>,
+  maxBytes: number = DERIVATIVE_MAX_SOURCE_BYTES
+): Promise<{ buffer: Buffer; contentHash: string }> {
+  const hash = createHash("sha256");
+  const chunks: Uint8Array[] = [];
+  const reader = stream.getReader();
+  let bytes = 0;
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    bytes += value.byteLength;
+    if (bytes > maxBytes) {
+      await reader.cancel();
+      throw new SourceTooLargeError(maxBytes);
+    }
+
+    hash.update(value);
+    chunks.push(value);
+  }
+
+  return { buffer: Buffer.concat(chunks), contentHash: hash.digest("hex") };
+}
+
+/**
+ * Build (or reuse) the renditions for an image and upload them to R2
+ *
+ * Does not update the Image row; callers store the result on
+ * contentHash / variants / blurDataUrl.
+ */
+export async function createImageDerivatives(
+  buffer: Buffer,
+  contentHash?: string
+): Promise<ImageDerivatives> {
+  const hash = contentHash ?? createHash("sha256").update(buffer).digest("hex");
+
+  // Identical bytes were already processed (retries, duplicate outputs). Only
+  // live images count: the reaper removes renditions no unexpired image uses.
+  const existing = await prisma.image.findFirst({
+    where: {
+      contentHash: hash,
+      blurDataUrl: { not: null }, // variants and blurDataUrl are always written together
+      deletedAt: null,
+      OR: [{ expiresAt: null }, { expiresAt: { gt: new Date() } }],
+    },
+    select: { variants: true, blurDataUrl: true },
+  });
+
+  if (existing) {
+    return {
+      contentHash: hash,
+      variants: existing.variants as unknown as ImageVariant[],
+      blurDataUrl: existing.blurDataUrl!,
+    };
+  }
+
+  // Hand the bytes to a worker (copied once into a transferable buffer)
+  const transferable = buffer.buffer.slice(
+    buffer.byteOffset,
+    buffer.byteOffset + buffer.byteLength
+  ) as ArrayBuffer;
+
+  const result = await pool.run(transferable);
+  if (!result.ok) {
+    throw new Error(`Derivative generation failed: ${result.error}`);
+  }
+
+  const variants = await Promise.all(
+    result.outputs.map(async (output) => {
+      const key = getVariantKey(hash, output.width, output.format);
+      const upload = await uploadToR2({
+        buffer: Buffer.from(output.data),
+        key,
+        contentType: `image/${output.format}`,
+        metadata: { type: "variant", contentHash: hash },
+      });
+
+      if (!upload.success) {
+        throw new Error(upload.error || `Failed to upload ${key}`);
+      }
+
+      return {
+        width: output.width,
+        height: output.height,
+        format: output.format,
+        url: upload.url!,
+      } satisfies ImageVariant;
+    })
+  );
+
+  return {
+    contentHash: hash,
+    variants,
+    blurDataUrl: result.blurDataUrl,
+  };
+}
+
+/**
+ * Pool utilisation, for metrics
+ */
+export function getDerivativePoolStats() {
+  return pool.stats();
+}
+
+/**
+ * Content-addressed R2 key for a rendition
+ * Structure: variants/{hash[0:2]}/{hash}/{width}w.{format}
+ */
+export function getVariantKey(
+  contentHash: string,
+  width: number,
+  format: VariantFormat
+): string {
+  return `variants/${contentHash.slice(0, 2)}/${contentHash}/${width}w.${format}`;
+}
@@ -0,0 +1,72 @@
+/**
+ * Image Variants
+ *
+ * Shared (client-safe) description of the responsive renditions produced by
+ * lib/image-derivatives.ts and stored on Image.variants.
+ */
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+// Rendition widths. Widths at or above the original are skipped.
+export const VARIANT_WIDTHS = [256, 512, 1024, 2048] as const;
+
+export const VARIANT_FORMATS = ["avif", "webp"] as const;
+
+// Width used for Image.thumbnailUrl (gallery cards)
+export const THUMBNAIL_VARIANT_WIDTH = 512;
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+export type VariantFormat = (typeof VARIANT_FORMATS)[number];
+
+export interface ImageVariant {
+  width: number;
+  height: number;
+  format: VariantFormat;
+  url: string;
+}
+
+// =============================================================================
+// HELPER FUNCTIONS
+// =============================================================================
+
+/**
+ * Smallest variant at least `minWidth` wide in the given format, falling
+ * back to the largest one available. With `allowSmaller` false there is no
+ * fallback: callers showing the image full size should use the original
+ * (renditions are only made below the source width).
+ */
+export function pickVariant(
+  variants: ImageVariant[] | null | undefined,
+  minWidth: number,
+  format: VariantFormat = "webp",
+  allowSmaller = true
+): ImageVariant | null {
+  const candidates = (variants ?? [])
+    .filter((v) => v.format === format)
+    .sort((a, b) => a.width - b.width);
+
+  if (candidates.length === 0) return null;
+  const match = candidates.find((v) => v.width >= minWidth);
+  if (match || !allowSmaller) return match ?? null;
+  return candidates[candidates.length - 1];
+}
+
+/**
+ * srcset attribute for one format, e.g. "a.webp 256w, b.webp 512w"
+ */
+export function buildSrcSet(
+  variants: ImageVariant[] | null | undefined,
+  format: VariantFormat
+): string | undefined {
+  const candidates = (variants ?? [])
+    .filter((v) => v.format === format)
+    .sort((a, b) => a.width - b.width);
+
+  if (candidates.length === 0) return undefined;
+  return candidates.map((v) => `${v.url} ${v.width}w`).join(", ");
+}
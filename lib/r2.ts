@@ -5,16 +5,19 @@
  * - Automatic CDN caching via Cloudflare
  * - Zero egress costs
  * - Thumbnail generation with Sharp
- * - Async upload support for non-blocking generation
+ * - Streaming multipart upload (used by the ingest worker)
  */
 
 import {
   S3Client,
   PutObjectCommand,
+  GetObjectCommand,
   DeleteObjectCommand,
+  DeleteObjectsCommand,
   HeadObjectCommand,
 } from "@aws-sdk/client-s3";
 import { Upload } from "@aws-sdk/lib-storage";
+import type { Readable } from "stream";
 
 // =============================================================================
 // CLIENT INITIALIZATION
@@ -30,6 +33,8 @@ export const r2Client = isR2Enabled
   ? new S3Client({
       region: "auto", // R2 uses "auto" region
       endpoint: process.env.R2_ENDPOINT!,
+      // Path-style addressing for local S3-compatible stores (e.g. the benchmark)
+      forcePathStyle: process.env.R2_FORCE_PATH_STYLE === "true",
       credentials: {
         accessKeyId: process.env.R2_ACCESS_KEY_ID!,
         secretAccessKey: process.env.R2_SECRET_ACCESS_KEY!,
@@ -39,6 +44,11 @@ export const r2Client = isR2Enabled
 
 const BUCKET_NAME = process.env.R2_BUCKET || "imagecrafter-prod";
 const PUBLIC_URL = process.env.R2_PUBLIC_URL || "";
+// DeleteObjects accepts at most 1000 keys per request
+const DELETE_BATCH_SIZE = 1000;
+
+// Object keys are unique per image, so stored objects never change
+export const R2_CACHE_CONTROL = "public, max-age=31536000, immutable";
 
 // =============================================================================
 // TYPES
@@ -51,13 +61,31 @@ export interface UploadImageParams {
   metadata?: Record<string, string>;
 }
 
+export interface UploadStreamParams {
+  body: Readable;
+  key: string;
+  contentType?: string;
+  metadata?: Record<string, string>;
+}
+
 export interface UploadImageResult {
   success: boolean;
   url?: string;
   key?: string;
+  bytes?: number;
   error?: string;
 }
 
+export interface R2ObjectStream {
+  status: number; // 200, 206, 304, 404 or 416
+  body?: ReadableStream<Uint8Array>;
+  contentType?: string;
+  contentLength?: number;
+  contentRange?: string;
+  etag?: string;
+  lastModified?: Date;
+}
+
 export interface ThumbnailOptions {
   maxWidth?: number;
   maxHeight?: number;
@@ -89,7 +117,7 @@ export async function uploadToR2(
       ContentType: params.contentType || "image/png",
       Metadata: params.metadata,
       // Make publicly accessible via CDN with 1 year cache
-      CacheControl: "public, max-age=31536000, immutable",
+      CacheControl: R2_CACHE_CONTROL,
     });
 
     await r2Client.send(command);
@@ -133,7 +161,7 @@ export async function uploadLargeImageToR2(
         Body: params.buffer,
         ContentType: params.contentType || "image/png",
         Metadata: params.metadata,
-        CacheControl: "public, max-age=31536000, immutable",
+        CacheControl: R2_CACHE_CONTROL,
       },
     });
 
@@ -155,12 +183,124 @@ export async function uploadLargeImageToR2(
   }
 }
 
+/**
+ * Upload a stream using multipart upload, without buffering the whole object
+ *
+ * Parts are sent as they fill, so memory use is bounded by
+ * partSize * queueSize regardless of image size.
+ */
+export async function uploadStreamToR2(
+  params: UploadStreamParams
+): Promise<UploadImageResult> {
+  if (!r2Client) {
+    return {
+      success: false,
+      error: "R2 storage is not configured",
+    };
+  }
+
+  try {
+    let bytes = 0;
+
+    const upload = new Upload({
+      client: r2Client,
+      queueSize: 2,
+      partSize: 5 * 1024 * 1024, // S3/R2 minimum part size
+      params: {
+        Bucket: BUCKET_NAME,
+        Key: params.key,
+        Body: params.body,
+        ContentType: params.contentType || "image/png",
+        Metadata: params.metadata,
+        CacheControl: R2_CACHE_CONTROL,
+      },
+    });
+
+    upload.on("httpUploadProgress", (progress) => {
+      bytes = progress.loaded ?? bytes;
+    });
+
+    await upload.done();
+
+    return {
+      success: true,
+      url: `${PUBLIC_URL}/${params.key}`,
+      key: params.key,
+      bytes,
+    };
+  } catch (error) {
+    console.error("R2 stream upload error:", error);
+    return {
+      success: false,
+      error: error instanceof Error ? error.message : "Upload failed",
+    };
+  }
+}
+
+// =============================================================================
+// IMAGE READ
+// =============================================================================
+
+/**
+ * Stream an object from R2 without buffering it
+ *
+ * Range and If-None-Match are passed through to R2, so partial and
+ * conditional reads cost only the bytes actually sent.
+ * Returns null if R2 is not configured.
+ */
+export async function getR2ObjectStream(
+  key: string,
+  options: { range?: string; ifNoneMatch?: string } = {}
+): Promise<R2ObjectStream | null> {
+  if (!r2Client) {
+    return null;
+  }
+
+  try {
+    const command = new GetObjectCommand({
+      Bucket: BUCKET_NAME,
+      Key: key,
+      Range: options.range,
+      IfNoneMatch: options.ifNoneMatch,
+    });
+
+    const response = await r2Client.send(command);
+
+    return {
+      status: response.ContentRange ? 206 : 200,
+      body: response.Body?.transformToWebStream() as
+        | ReadableStream<Uint8Array>
+        | undefined,
+      contentType: response.ContentType,
+      contentLength: response.ContentLength,
+      contentRange: response.ContentRange,
+      etag: response.ETag,
+      lastModified: response.LastModified,
+    };
+  } catch (error) {
+    // Not-modified, missing and unsatisfiable-range responses surface as errors
+    const status = (error as { $metadata?: { httpStatusCode?: number } })
+      .$metadata?.httpStatusCode;
+
+    if (status === 304 || status === 404 || status === 416) {
+      return { status };
+    }
+
+    console.error("R2 read error:", error);
+    throw error;
+  }
+}
+
 // =============================================================================
 // THUMBNAIL GENERATION
 // =============================================================================
 
 /**
  * Generate a thumbnail from an image buffer using Sharp
+ *
+ * Throws if the image can't be processed; callers decide whether to fall
+ * back (never substitute the full-size original as a "thumbnail").
+ * Generated images get full responsive renditions from lib/image-derivatives.ts.
  */
 export async function generateThumbnail(
   buffer: Buffer,
@@ -172,22 +312,23 @@ export async function generateThumbnail(
     quality = 80,
   } = options;
 
-  try {
-    // Dynamic import for sharp to avoid build issues
-    const sharp = (await import("sharp")).default;
-
-    return await sharp(buffer)
-      .resize(maxWidth, maxHeight, {
-        fit: "inside",
-        withoutEnlargement: true,
-      })
-      .jpeg({ quality })
-      .toBuffer();
-  } catch (error) {
-    console.error("Thumbnail generation error:", error);
-    // Return original buffer if thumbnail fails
-    return buffer;
-  }
+  const sharp = await loadSharp();
+
+  return sharp(buffer)
+    .resize(maxWidth, maxHeight, {
+      fit: "inside",
+      withoutEnlargement: true,
+    })
+    .jpeg({ quality })
+    .toBuffer();
+}
+
+// Dynamic import for sharp to avoid build issues, resolved once per process
+let sharpModule: Promise<typeof import("sharp")> | null = null;
+
+async function loadSharp() {
+  sharpModule ??= import("sharp");
+  return (await sharpModule).default;
 }
 
 // =============================================================================
@@ -216,6 +357,45 @@ export async function deleteFromR2(key: string): Promise<boolean> {
   }
 }
 
+/**
+ * Delete many objects from R2, up to 1000 keys per request
+ * Returns the keys that could not be deleted (missing keys count as deleted).
+ */
+export async function deleteManyFromR2(
+  keys: string[]
+): Promise<{ deleted: number; failed: string[] }> {
+  if (!r2Client) {
+    return { deleted: 0, failed: keys };
+  }
+
+  let deleted = 0;
+  const failed: string[] = [];
+
+  for (let i = 0; i < keys.length; i += DELETE_BATCH_SIZE) {
+    const chunk = keys.slice(i, i + DELETE_BATCH_SIZE);
+
+    try {
+      const command = new DeleteObjectsCommand({
+        Bucket: BUCKET_NAME,
+        Delete: {
+          Objects: chunk.map((Key) => ({ Key })),
+          Quiet: true, // Only errors are returned
+        },
+      });
+
+      const response = await r2Client.send(command);
+      const errors = (response.Errors ?? []).map((e) => e.Key!).filter(Boolean);
+      failed.push(...errors);
+      deleted += chunk.length - errors.length;
+    } catch (error) {
+      console.error("R2 bulk deletion error:", error);
+      failed.push(...chunk);
+    }
+  }
+
+  return { deleted, failed };
+}
+
 /**
  * Check if an object exists in R2
  */
@@ -244,13 +424,15 @@ export async function existsInR2(key: string): Promise<boolean> {
 /**
  * Generate a unique R2 key for an image
  * Structure: users/{userId}/{year}/{month}/{imageId}.{ext}
+ *
+ * Pass the image's own date when the key must be stable across runs.
  */
 export function generateImageKey(
   userId: string,
   imageId: string,
-  extension: string = "png"
+  extension: string = "png",
+  date: Date = new Date()
 ): string {
-  const date = new Date();
   const year = date.getFullYear();
   const month = String(date.getMonth() + 1).padStart(2, "0");
 
@@ -270,6 +452,13 @@ export function extractR2Key(url: string): string {
   }
 }
 
+/**
+ * Public URL for an R2 object key (inverse of extractR2Key)
+ */
+export function getR2PublicUrl(key: string): string {
+  return `${PUBLIC_URL}/${key}`;
+}
+
 /**
  * Check if R2 is enabled and configured
  */
@@ -285,7 +474,7 @@ export function isR2Url(url: string): boolean {
   return (
     url.includes("r2.cloudflarestorage.com") ||
     url.includes("r2.dev") ||
-    url.includes(PUBLIC_URL)
+    (!!PUBLIC_URL && url.includes(PUBLIC_URL))
   );
 }
 
@@ -312,101 +501,6 @@ export async function fetchImageBuffer(
   }
 }
 
-// =============================================================================
-// ASYNC R2 UPLOAD (Non-blocking)
-// =============================================================================
-
-/**
- * Upload image to R2 asynchronously (fire-and-forget)
- * Updates database record after upload completes
- */
-export async function uploadToR2Async(
-  imageId: string,
-  geminiImageUrl: string,
-  geminiThumbnailUrl: string | null,
-  userId: string
-): Promise<void> {
-  // Import prisma dynamically to avoid circular dependencies
-  const { prisma } = await import("@/lib/prisma");
-
-  try {
-    // Fetch the generated image from Gemini service
-    const imageData = await fetchImageBuffer(geminiImageUrl);
-    if (!imageData) {
-      console.error(`[R2 Async] Failed to fetch image ${imageId} from Gemini`);
-      return;
-    }
-
-    // Generate R2 key
-    const imageKey = generateImageKey(userId, imageId, "png");
-
-    // Upload main image to R2
-    const uploadResult = await uploadToR2({
-      buffer: imageData.buffer,
-      key: imageKey,
-      contentType: imageData.contentType,
-      metadata: {
-        userId,
-        originalUrl: geminiImageUrl.slice(0, 200), // Truncate for metadata limits
-      },
-    });
-
-    if (!uploadResult.success) {
-      console.error(
-        `[R2 Async] Failed to upload image ${imageId}:`,
-        uploadResult.error
-      );
-      return;
-    }
-
-    // Generate and upload thumbnail
-    let thumbnailUrl: string | null = null;
-    const shouldGenerateThumbnail =
-      process.env.R2_GENERATE_THUMBNAILS !== "false";
-
-    if (shouldGenerateThumbnail) {
-      try {
-        const thumbnailBuffer = await generateThumbnail(imageData.buffer);
-        const thumbnailKey = generateImageKey(userId, `${imageId}-thumb`, "jpg");
-
-        const thumbUploadResult = await uploadToR2({
-          buffer: thumbnailBuffer,
-          key: thumbnailKey,
-          contentType: "image/jpeg",
-          metadata: {
-            userId,
-            type: "thumbnail",
-          },
-        });
-
-        if (thumbUploadResult.success) {
-          thumbnailUrl = thumbUploadResult.url!;
-        }
-      } catch (thumbError) {
-        console.error(
-          `[R2 Async] Failed to generate thumbnail for ${imageId}:`,
-          thumbError
-        );
-      }
-    }
-
-    // Update database with R2 URLs
-    await prisma.image.update({
-      where: { id: imageId },
-      data: {
-        imageUrl: uploadResult.url!,
-        thumbnailUrl: thumbnailUrl || geminiThumbnailUrl,
-        // Optionally track storage provider
-        // storageProvider: "r2",
-      },
-    });
-
-    console.log(`[R2 Async] Successfully migrated image ${imageId} to R2`);
-  } catch (error) {
-    console.error(`[R2 Async] Error processing image ${imageId}:`, error);
-  }
-}
-
 // =============================================================================
 // EXPIRATION HELPERS
 // =============================================================================
@@ -0,0 +1,592 @@
+/**
+ * Batch Job Processor
+ *
+ * Executes queued BatchJob rows using Postgres as the queue:
+ * - Jobs are claimed with FOR UPDATE SKIP LOCKED, so any number of nodes
+ *   can run a worker without double-processing
+ * - Priority-queue plans (hasPriorityQueue) are claimed first
+ * - Concurrency is capped per node, per user, and per job
+ * - Credits are reserved once when the job is queued and settled per image
+ * - Leases are kept alive with a heartbeat; a crashed node's jobs are
+ *   reclaimed once the lease goes stale and resume at the unsettled images
+ */
+
+import { hostname } from "os";
+import { randomUUID } from "crypto";
+import type { Prisma } from "@prisma/client";
+import { prisma } from "@/lib/prisma";
+import { getCreditCost } from "@/lib/plans";
+import { commitCredits, refundCredits } from "@/lib/credits";
+import {
+  createGeneratedImage,
+  type BatchPromptItem,
+  type BatchSharedSettings,
+} from "@/lib/services/image-generation";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+// Jobs processed at once by this node
+const NODE_CONCURRENCY = parseInt(process.env.BATCH_WORKER_CONCURRENCY || "2");
+// Jobs processed at once for a single user, across all nodes
+const USER_CONCURRENCY = parseInt(process.env.BATCH_MAX_JOBS_PER_USER || "1");
+// Images generated in parallel within one job
+const IMAGE_CONCURRENCY = parseInt(process.env.BATCH_IMAGE_CONCURRENCY || "3");
+// How often idle workers look for new jobs
+const POLL_INTERVAL_MS = parseInt(process.env.BATCH_POLL_INTERVAL_MS || "2000");
+// A lease older than this is considered abandoned and can be reclaimed
+const LEASE_TIMEOUT_MS = parseInt(process.env.BATCH_LEASE_TIMEOUT_MS || "60000");
+// Give up on a job after this many claims (e.g. it keeps crashing nodes)
+const MAX_ATTEMPTS = parseInt(process.env.BATCH_MAX_ATTEMPTS || "3");
+// Candidates tried per claim when another node wins the per-user race
+const CLAIM_ATTEMPTS = 3;
+// Tries to record a generated image before leaving it to finalizeJob
+const SETTLE_ATTEMPTS = 3;
+const SETTLE_RETRY_MS = 500;
+
+const NODE_ID = `${hostname()}:${process.pid}:${randomUUID().slice(0, 8)}`;
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+interface BatchError {
+  index: number;
+  error: string;
+}
+
+type SettleOutcome =
+  | {
+      imageId: string;
+      resolution: BatchSharedSettings["resolution"];
+      apiLatencyMs?: number;
+    }
+  | { refundSubscriptionId: string };
+
+// An image that was generated but could not be recorded yet
+interface UnsettledImage {
+  index: number;
+  outcome: Extract<SettleOutcome, { imageId: string }>;
+}
+
+class LeaseLostError extends Error {
+  constructor(jobId: string) {
+    super(`Lost lease on batch job ${jobId}`);
+    this.name = "LeaseLostError";
+  }
+}
+
+interface WorkerState {
+  started: boolean;
+  polling: boolean;
+  timer: ReturnType<typeof setInterval> | null;
+  active: Map<string, Promise<void>>;
+}
+
+// Survive hot reloads in development (same pattern as lib/prisma.ts)
+const globalForWorker = globalThis as unknown as {
+  batchWorker: WorkerState | undefined;
+};
+
+const worker: WorkerState =
+  globalForWorker.batchWorker ??
+  (globalForWorker.batchWorker = {
+    started: false,
+    polling: false,
+    timer: null,
+    active: new Map(),
+  });
+
+// =============================================================================
+// WORKER LIFECYCLE
+// =============================================================================
+
+/**
+ * Start polling for batch jobs on this node
+ */
+export function startBatchWorker(): void {
+  if (worker.started) return;
+  worker.started = true;
+
+  worker.timer = setInterval(() => {
+    void poll();
+  }, POLL_INTERVAL_MS);
+  worker.timer.unref?.();
+
+  console.log(
+    `[Batch] Worker ${NODE_ID} started (jobs: ${NODE_CONCURRENCY}, per user: ${USER_CONCURRENCY}, images per job: ${IMAGE_CONCURRENCY})`
+  );
+  void poll();
+}
+
+/**
+ * Stop polling and wait for in-flight jobs to finish
+ */
+export async function stopBatchWorker(): Promise<void> {
+  worker.started = false;
+  if (worker.timer) {
+    clearInterval(worker.timer);
+    worker.timer = null;
+  }
+  await Promise.allSettled(worker.active.values());
+}
+
+/**
+ * Ask the local worker to look for jobs now instead of at the next poll
+ */
+export function kickBatchWorker(): void {
+  if (!worker.started) return;
+  setImmediate(() => {
+    void poll();
+  });
+}
+
+/**
+ * Snapshot of this node's worker
+ */
+export function getBatchWorkerStats() {
+  return {
+    nodeId: NODE_ID,
+    running: worker.started,
+    activeJobs: [...worker.active.keys()],
+    capacity: NODE_CONCURRENCY,
+  };
+}
+
+async function poll(): Promise<void> {
+  if (!worker.started || worker.polling) return;
+  worker.polling = true;
+
+  try {
+    while (worker.active.size < NODE_CONCURRENCY) {
+      const jobId = await claimNextJob();
+      if (!jobId) break;
+
+      const run = processBatchJob(jobId)
+        .catch((error) => {
+          console.error(`[Batch] Job ${jobId} crashed:`, error);
+        })
+        .finally(() => {
+          worker.active.delete(jobId);
+          kickBatchWorker();
+        });
+
+      worker.active.set(jobId, run);
+    }
+  } catch (error) {
+    console.error("[Batch] Poll failed:", error);
+  } finally {
+    worker.polling = false;
+  }
+}
+
+// =============================================================================
+// CLAIMING
+// =============================================================================
+
+/**
+ * Claim the next runnable job for this node.
+ *
+ * Runnable means PENDING, or PROCESSING with a stale lease (its node died).
+ * Users already at USER_CONCURRENCY live jobs are skipped so one large
+ * customer can't occupy every worker.
+ *
+ * The cap is enforced across nodes by serializing claims per user on an
+ * advisory lock: once it is held, every earlier claim for that user has
+ * committed, so the re-count sees it. The count in the candidate query is
+ * only a pre-filter (its snapshot can miss a concurrent claim).
+ */
+async function claimNextJob(): Promise<string | null> {
+  const leaseSeconds = LEASE_TIMEOUT_MS / 1000;
+
+  for (let attempt = 0; attempt < CLAIM_ATTEMPTS; attempt++) {
+    const claim = await prisma.$transaction(async (tx) => {
+      const [candidate] = await tx.$queryRaw<Array<{ id: string; userId: string }>>`
+        SELECT j."id", j."userId"
+        FROM "BatchJob" j
+        WHERE (
+          j."status" = 'PENDING'
+          OR (
+            j."status" = 'PROCESSING'
+            AND j."lockedAt" < now() - make_interval(secs => ${leaseSeconds})
+          )
+        )
+        AND (
+          SELECT count(*)
+          FROM "BatchJob" a
+          WHERE a."userId" = j."userId"
+            AND a."status" = 'PROCESSING'
+            AND a."lockedAt" >= now() - make_interval(secs => ${leaseSeconds})
+        ) < ${USER_CONCURRENCY}
+        ORDER BY j."priority" DESC, j."createdAt" ASC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+      `;
+      if (!candidate) return { done: true, jobId: null };
+
+      // Held until commit; other nodes claiming for this user wait here
+      await tx.$executeRaw`SELECT pg_advisory_xact_lock(hashtext(${candidate.userId}))`;
+
+      const [{ live }] = await tx.$queryRaw<Array<{ live: number }>>`
+        SELECT count(*)::int AS "live"
+        FROM "BatchJob"
+        WHERE "userId" = ${candidate.userId}
+          AND "id" <> ${candidate.id}
+          AND "status" = 'PROCESSING'
+          AND "lockedAt" >= now() - make_interval(secs => ${leaseSeconds})
+      `;
+      // Lost the race for this user; the next attempt's pre-filter skips them
+      if (live >= USER_CONCURRENCY) return { done: false, jobId: null };
+
+      await tx.$executeRaw`
+        UPDATE "BatchJob"
+        SET "status" = 'PROCESSING',
+            "lockedBy" = ${NODE_ID},
+            "lockedAt" = now(),
+            "startedAt" = COALESCE("startedAt", now()),
+            "attempts" = "attempts" + 1
+        WHERE "id" = ${candidate.id}
+      `;
+      return { done: true, jobId: candidate.id };
+    });
+
+    if (claim.done) return claim.jobId;
+  }
+
+  return null;
+}
+
+// =============================================================================
+// PROCESSING
+// =============================================================================
+
+/**
+ * Run a claimed job to completion, generating unsettled images in parallel
+ */
+async function processBatchJob(jobId: string): Promise<void> {
+  const job = await prisma.batchJob.findUnique({ where: { id: jobId } });
+  if (!job || job.lockedBy !== NODE_ID) return;
+
+  if (job.attempts > MAX_ATTEMPTS) {
+    console.error(`[Batch] Job ${jobId} exceeded ${MAX_ATTEMPTS} attempts`);
+    await finalizeJob(jobId, [{ index: -1, error: "Maximum attempts exceeded" }]);
+    return;
+  }
+
+  const user = await prisma.user.findUnique({
+    where: { id: job.userId },
+    include: { subscription: true },
+  });
+
+  if (!user?.subscription) {
+    await finalizeJob(jobId, [{ index: -1, error: "User not found" }]);
+    return;
+  }
+
+  const prompts = job.prompts as unknown as BatchPromptItem[];
+  const settings = job.sharedSettings as unknown as BatchSharedSettings;
+  const cost = getCreditCost(settings.resolution);
+  const settled = new Set(job.settledIndexes);
+  const pending = prompts
+    .map((_, index) => index)
+    .filter((index) => !settled.has(index));
+
+  if (settled.size > 0) {
+    console.log(
+      `[Batch] Resuming job ${jobId}: ${pending.length}/${prompts.length} images left`
+    );
+  }
+
+  const errors: BatchError[] = [];
+  const unsettledImages: UnsettledImage[] = [];
+  let leaseLost = false;
+
+  // Keep the lease alive while images are generating
+  const heartbeat = setInterval(() => {
+    prisma.batchJob
+      .updateMany({
+        where: { id: jobId, lockedBy: NODE_ID },
+        data: { lockedAt: new Date() },
+      })
+      .then((result) => {
+        if (result.count === 0) leaseLost = true;
+      })
+      .catch((error) => {
+        console.error(`[Batch] Heartbeat failed for job ${jobId}:`, error);
+      });
+  }, Math.max(1000, Math.floor(LEASE_TIMEOUT_MS / 3)));
+  heartbeat.unref?.();
+
+  try {
+    await runWithConcurrency(pending, IMAGE_CONCURRENCY, async (index) => {
+      if (leaseLost) return;
+
+      const item = prompts[index];
+
+      let image: Awaited<ReturnType<typeof createGeneratedImage>>;
+      try {
+        image = await createGeneratedImage(
+          {
+            userId: job.userId,
+            prompt: item.prompt,
+            enhancedPrompt: item.enhancedPrompt,
+            resolution: settings.resolution,
+            aspectRatio: settings.aspectRatio,
+            templateId: settings.templateId,
+            presetId: settings.presetId,
+            projectId: settings.projectId,
+          },
+          user.subscription
+        );
+      } catch (error) {
+        const message = error instanceof Error ? error.message : "Generation failed";
+        console.error(`[Batch] Job ${jobId} image ${index} failed:`, message);
+        errors.push({ index, error: message });
+
+        try {
+          await settleImage(jobId, job.userId, index, cost, {
+            refundSubscriptionId: user.subscription!.id,
+          });
+        } catch (settleError) {
+          if (settleError instanceof LeaseLostError) leaseLost = true;
+          else throw settleError;
+        }
+        return;
+      }
+
+      // The image exists now, so its credits are committed, never refunded
+      const outcome = {
+        imageId: image.id,
+        resolution: settings.resolution,
+        apiLatencyMs: image.generationTime ?? undefined,
+      };
+
+      try {
+        await settleGeneratedImage(jobId, job.userId, index, cost, outcome);
+      } catch (error) {
+        if (error instanceof LeaseLostError) {
+          leaseLost = true;
+          return;
+        }
+        // Keep generating; finalizeJob records it before refunding the rest
+        console.error(`[Batch] Job ${jobId} image ${index} could not be settled:`, error);
+        unsettledImages.push({ index, outcome });
+      }
+    });
+  } finally {
+    clearInterval(heartbeat);
+  }
+
+  if (leaseLost) {
+    console.warn(`[Batch] Job ${jobId} was reclaimed by another node, stopping`);
+    return;
+  }
+
+  await finalizeJob(jobId, errors, unsettledImages);
+}
+
+/**
+ * Commit a generated image's credits, retrying transient database errors.
+ * Lease loss is not retried.
+ */
+async function settleGeneratedImage(
+  jobId: string,
+  userId: string,
+  index: number,
+  cost: number,
+  outcome: UnsettledImage["outcome"]
+): Promise<void> {
+  for (let attempt = 1; ; attempt++) {
+    try {
+      await settleImage(jobId, userId, index, cost, outcome);
+      return;
+    } catch (error) {
+      if (error instanceof LeaseLostError || attempt >= SETTLE_ATTEMPTS) throw error;
+      await sleep(SETTLE_RETRY_MS * attempt);
+    }
+  }
+}
+
+/**
+ * Commit or refund one image's share of the reservation.
+ *
+ * Runs in a transaction guarded by the lease, so a node that lost its lease
+ * can never settle the same index twice.
+ */
+async function settleImage(
+  jobId: string,
+  userId: string,
+  index: number,
+  cost: number,
+  outcome: SettleOutcome
+): Promise<void> {
+  await prisma.$transaction((tx) => applySettlement(tx, jobId, userId, index, cost, outcome));
+}
+
+async function applySettlement(
+  tx: Prisma.TransactionClient,
+  jobId: string,
+  userId: string,
+  index: number,
+  cost: number,
+  outcome: SettleOutcome
+): Promise<void> {
+  const succeeded = "imageId" in outcome;
+
+  const updated = await tx.batchJob.updateMany({
+    where: {
+      id: jobId,
+      lockedBy: NODE_ID,
+      NOT: { settledIndexes: { has: index } },
+    },
+    data: {
+      settledIndexes: { push: index },
+      creditsSettled: { increment: cost },
+      lockedAt: new Date(),
+      ...(succeeded
+        ? {
+            completedImages: { increment: 1 },
+            imageIds: { push: outcome.imageId },
+            imageIndexes: { push: index },
+          }
+        : { failedImages: { increment: 1 } }),
+    },
+  });
+
+  if (updated.count === 0) {
+    // A retried settle whose earlier attempt committed after all
+    const current = await tx.batchJob.findUnique({
+      where: { id: jobId },
+      select: { lockedBy: true, settledIndexes: true },
+    });
+    if (current?.lockedBy === NODE_ID && current.settledIndexes.includes(index)) return;
+    throw new LeaseLostError(jobId);
+  }
+
+  if (succeeded) {
+    await commitCredits(
+      { userId },
+      cost,
+      {
+        resolution: outcome.resolution,
+        imageId: outcome.imageId,
+        apiLatencyMs: outcome.apiLatencyMs,
+      },
+      tx
+    );
+  } else {
+    await refundCredits({ subscriptionId: outcome.refundSubscriptionId }, cost, tx);
+  }
+}
+
+/**
+ * Mark the job finished, release the lease, and refund any credits that were
+ * reserved but never settled (e.g. the job was abandoned). Generated images
+ * that could not be settled earlier are committed first, so they are never
+ * part of the refund.
+ */
+async function finalizeJob(
+  jobId: string,
+  newErrors: BatchError[],
+  unsettledImages: UnsettledImage[] = []
+): Promise<void> {
+  await prisma.$transaction(async (tx) => {
+    const leased = await tx.batchJob.findUnique({ where: { id: jobId } });
+    if (!leased || leased.lockedBy !== NODE_ID) return;
+
+    const settings = leased.sharedSettings as unknown as BatchSharedSettings;
+    for (const { index, outcome } of unsettledImages) {
+      await applySettlement(
+        tx,
+        jobId,
+        leased.userId,
+        index,
+        getCreditCost(settings.resolution),
+        outcome
+      );
+    }
+
+    const job = unsettledImages.length
+      ? await tx.batchJob.findUniqueOrThrow({ where: { id: jobId } })
+      : leased;
+
+    const unsettled = job.creditsReserved - job.creditsSettled;
+    if (unsettled > 0) {
+      const subscription = await tx.subscription.findUnique({
+        where: { userId: job.userId },
+        select: { id: true },
+      });
+      if (subscription) {
+        await refundCredits({ subscriptionId: subscription.id }, unsettled, tx);
+      }
+    }
+
+    const errors = [
+      ...((job.errors as unknown as BatchError[] | null) ?? []),
+      ...newErrors,
+    ];
+
+    const status =
+      job.completedImages === job.totalImages
+        ? "COMPLETED"
+        : job.completedImages === 0
+          ? "FAILED"
+          : "PARTIAL_FAILURE";
+
+    await tx.batchJob.update({
+      where: { id: jobId },
+      data: {
+        status,
+        errors: errors.length > 0 ? (errors as unknown as Prisma.InputJsonValue) : undefined,
+        creditsSettled: job.creditsReserved,
+        lockedBy: null,
+        lockedAt: null,
+        completedAt: new Date(),
+      },
+    });
+
+    console.log(
+      `[Batch] Job ${jobId} ${status}: ${job.completedImages}/${job.totalImages} images`
+    );
+  });
+}
+
+// =============================================================================
+// HELPER FUNCTIONS
+// =============================================================================
+
+/**
+ * Run `fn` over `items` with at most `limit` calls in flight.
+ *
+ * If a call throws, no new items are started, but the ones already running
+ * are waited for before the first error is rethrown (callers release the
+ * job's lease afterwards, so nothing may still be generating by then).
+ */
+async function runWithConcurrency<T>(
+  items: T[],
+  limit: number,
+  fn: (item: T) => Promise<void>
+): Promise<void> {
+  let next = 0;
+  let failed = false;
+  const workers = Array.from({ length: Math.min(limit, items.length) }, async () => {
+    while (!failed && next < items.length) {
+      const item = items[next++];
+      try {
+        await fn(item);
+      } catch (error) {
+        failed = true;
+        throw error;
+      }
+    }
+  });
+
+  const results = await Promise.allSettled(workers);
+  const rejected = results.find((r): r is PromiseRejectedResult => r.status === "rejected");
+  if (rejected) throw rejected.reason;
+}
+
+function sleep(ms: number): Promise<void> {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
@@ -5,6 +5,7 @@
  * Wraps the Gemini API at image-gen.xencolabs.com
  */
 
+import type { Prisma } from "@prisma/client";
 import { prisma } from "@/lib/prisma";
 import {
   CREDIT_COSTS,
@@ -17,9 +18,19 @@ import {
 } from "@/lib/plans";
 import {
   isR2Available,
-  uploadToR2Async,
   calculateExpiration,
 } from "@/lib/r2";
+import {
+  commitCredits,
+  getNextResetDate,
+  getSubscriptionView,
+  refundCredits,
+  reserveCredits,
+  type SubscriptionView,
+} from "@/lib/credits";
+import { kickImageIngest } from "@/lib/services/image-ingest";
+import { upstreams } from "@/lib/upstream";
+import { timeStage } from "@/lib/timing";
 
 // =============================================================================
 // TYPES
@@ -36,6 +47,12 @@ export interface GenerateImageParams {
   projectId?: string;
   characterId?: string;
   seed?: number;
+  /**
+   * Prompt enhancement, run only after credits are reserved so requests that
+   * will be rejected never reach the AI gateway. Its result overrides
+   * enhancedPrompt and aspectRatio.
+   */
+  enhance?: () => Promise<{ enhancedPrompt?: string; aspectRatio?: string }>;
 }
 
 export interface GenerateImageResult {
@@ -63,6 +80,17 @@ export interface UserCredits {
   maxResolution: Resolution;
 }
 
+// Image-gen API response (older deployments return the image fields at the top level)
+interface ImageGenApiImage {
+  image_url?: string;
+  imageUrl?: string;
+  download_url?: string;
+  thumbnailUrl?: string;
+  model?: string;
+  external_id?: string;
+  id?: string;
+}
+
 // =============================================================================
 // CREDIT MANAGEMENT
 // =============================================================================
@@ -117,6 +145,24 @@ export async function getUserCredits(userId: string): Promise<UserCredits> {
   };
 }
 
+/**
+ * Get the cached plan view, creating the default subscription on first use
+ * Returns null if the user doesn't exist.
+ */
+async function getOrCreateSubscriptionView(
+  userId: string
+): Promise<SubscriptionView | null> {
+  const view = await getSubscriptionView(userId);
+  if (view) return view;
+
+  try {
+    await getUserCredits(userId);
+  } catch {
+    return null;
+  }
+  return getSubscriptionView(userId);
+}
+
 /**
  * Check if user can generate at a specific resolution
  */
@@ -147,51 +193,15 @@ export async function canGenerate(
   return { allowed: true, creditsNeeded: cost };
 }
 
-/**
- * Deduct credits after successful generation
- */
-async function deductCredits(
-  userId: string,
-  credits: number,
-  resolution: Resolution,
-  imageId: string
-): Promise<void> {
-  const user = await prisma.user.findUnique({
-    where: { id: userId },
-    include: { subscription: true },
-  });
-
-  if (!user?.subscription) {
-    throw new Error("No subscription found");
-  }
-
-  // Update subscription
-  await prisma.subscription.update({
-    where: { id: user.subscription.id },
-    data: {
-      creditsUsed: { increment: credits },
-    },
-  });
-
-  // Record usage
-  await prisma.usageRecord.create({
-    data: {
-      userId: user.id,
-      action: "generate",
-      creditsUsed: credits,
-      resolution,
-      imageId,
-      estimatedCost: getEstimatedCost(resolution),
-    },
-  });
-}
-
 // =============================================================================
 // IMAGE GENERATION
 // =============================================================================
 
 /**
  * Generate an image using the Gemini API
+ *
+ * Credits are reserved atomically before the API call and refunded if
+ * generation fails, so concurrent requests can't overspend.
  */
 export async function generateImage(
   params: GenerateImageParams
@@ -199,36 +209,130 @@ export async function generateImage(
   const {
     userId,
     prompt,
-    enhancedPrompt,
     resolution = "1K",
-    aspectRatio = "1:1",
     templateId,
     presetId,
-    projectId,
-    characterId,
-    seed,
   } = params;
 
-  // Check if user can generate
-  const canGen = await canGenerate(userId, resolution);
-  if (!canGen.allowed) {
+  // Plan and limits (cached per process)
+  const subscription = await timeStage("credits", () => getOrCreateSubscriptionView(userId));
+  if (!subscription) {
+    return { success: false, error: "User not found" };
+  }
+
+  // Check resolution access
+  if (!isResolutionAvailable(subscription.plan, resolution)) {
     return {
       success: false,
-      error: canGen.reason,
+      error: `${resolution} resolution requires ${getRequiredPlanForResolution(resolution)} plan or higher`,
     };
   }
 
-  // Get user and subscription
-  const user = await prisma.user.findUnique({
-    where: { id: userId },
-    include: { subscription: true },
-  });
+  // Reserve credits (single conditional update)
+  const creditsCost = getCreditCost(resolution);
+  const reservation = await timeStage("credits", () => reserveCredits(userId, creditsCost));
+  if (!reservation) {
+    const credits = await getUserCredits(userId);
+    return {
+      success: false,
+      error: `Not enough credits. Need ${creditsCost}, have ${credits.remaining}`,
+    };
+  }
 
-  if (!user) {
-    return { success: false, error: "User not found" };
+  let image;
+  let generation = params;
+  try {
+    if (params.enhance) {
+      generation = { ...params, ...(await params.enhance()) };
+    }
+    image = await createGeneratedImage(generation, subscription);
+  } catch (error) {
+    await refundCredits(reservation, creditsCost).catch((refundError) => {
+      console.error("Credit refund failed:", refundError);
+    });
+
+    console.error("Image generation failed:", error);
+    return {
+      success: false,
+      error: error instanceof Error ? error.message : "Generation failed",
+    };
+  }
+
+  try {
+    // Record usage for the reserved credits
+    await timeStage("usage", () =>
+      commitCredits(reservation, creditsCost, {
+        resolution,
+        imageId: image.id,
+        apiLatencyMs: image.generationTime ?? undefined,
+      })
+    );
+  } catch (error) {
+    // The image exists and credits are already deducted; don't fail the request
+    console.error("Usage record failed for image:", image.id, error);
   }
 
-  const subscription = user.subscription;
+  // Save to prompt history (not critical, don't wait on it)
+  prisma.promptHistory.upsert({
+    where: {
+      id: `${userId}-${prompt.slice(0, 100)}`, // Simplified unique key
+    },
+    create: {
+      id: `${userId}-${prompt.slice(0, 100)}`,
+      userId,
+      prompt,
+      enhancedPrompt: generation.enhancedPrompt,
+      templateId,
+      presetId,
+    },
+    update: {
+      timesUsed: { increment: 1 },
+      lastUsedAt: new Date(),
+    },
+  }).catch(() => {
+    // Silently fail on history - not critical
+  });
+
+  return {
+    success: true,
+    image: {
+      id: image.id,
+      imageUrl: image.imageUrl,
+      thumbnailUrl: image.thumbnailUrl || undefined,
+      width: image.width,
+      height: image.height,
+      resolution: image.resolution,
+      creditsCost,
+      hasWatermark: image.hasWatermark,
+    },
+    creditsRemaining: reservation.remaining,
+  };
+}
+
+/**
+ * Call the Gemini API and persist the resulting image row.
+ *
+ * Does no credit accounting: callers check and charge credits themselves
+ * (generateImage per request, the batch processor per reserved job).
+ * Throws on API or database errors.
+ */
+export async function createGeneratedImage(
+  params: GenerateImageParams,
+  subscription: Pick<SubscriptionView, "plan" | "hasWatermark"> | null
+) {
+  const {
+    userId,
+    prompt,
+    enhancedPrompt,
+    resolution = "1K",
+    aspectRatio = "1:1",
+    templateId,
+    presetId,
+    projectId,
+    characterId,
+    seed,
+  } = params;
+
   const hasWatermark = subscription?.hasWatermark ?? true;
 
   // Get dimensions based on aspect ratio and resolution
@@ -240,8 +344,9 @@ export async function generateImage(
 
   const startTime = Date.now();
 
-  try {
-    const response = await fetch(`${apiUrl}/api/v1/generate`, {
+  // Pooled, time-limited and circuit-broken (see lib/upstream.ts)
+  const response = await timeStage("image_gen", () =>
+    upstreams.imageGen.request(`${apiUrl}/api/v1/generate`, {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
@@ -255,38 +360,46 @@ export async function generateImage(
         // Add watermark parameter if needed
         watermark: hasWatermark,
       }),
-    });
-
-    if (!response.ok) {
-      const errorData = await response.json().catch(() => ({}));
-      throw new Error(errorData.error || `API error: ${response.status}`);
+    })
+  );
+
+  if (!response.ok) {
+    let errorData: { error?: string } = {};
+    try {
+      errorData = response.json();
+    } catch {
+      // Non-JSON error body
     }
+    throw new Error(errorData.error || `API error: ${response.status}`);
+  }
 
-    const responseData = await response.json();
-    const generationTime = Date.now() - startTime;
+  const responseData = response.json<ImageGenApiImage & { image?: ImageGenApiImage }>();
+  const generationTime = Date.now() - startTime;
 
-    // Parse the API response (new structure uses data.image.*)
-    const imageData = responseData.image || responseData;
-    const imageUrl = imageData.image_url || imageData.imageUrl;
-    const thumbnailUrl = imageData.download_url || imageData.thumbnailUrl || null;
-    const modelVersion = imageData.model || "gemini-2.0-flash";
-    const externalId = imageData.external_id || imageData.id || null;
+  // Parse the API response (new structure uses data.image.*)
+  const imageData = responseData.image || responseData;
+  const imageUrl = imageData.image_url || imageData.imageUrl;
+  const thumbnailUrl = imageData.download_url || imageData.thumbnailUrl || null;
+  const modelVersion = imageData.model || "gemini-2.0-flash";
+  const externalId = imageData.external_id || imageData.id || null;
 
-    if (!imageUrl) {
-      throw new Error("No image URL returned from API");
-    }
+  if (!imageUrl) {
+    throw new Error("No image URL returned from API");
+  }
 
-    // Calculate credit cost
-    const creditsCost = getCreditCost(resolution);
+  // Calculate credit cost
+  const creditsCost = getCreditCost(resolution);
 
-    // Calculate expiration for R2 storage based on plan
-    const plan = subscription?.plan || "FREE";
-    const expiresAt = isR2Available() ? calculateExpiration(plan) : null;
+  // Calculate expiration for R2 storage based on plan
+  const plan = subscription?.plan || "FREE";
+  const expiresAt = isR2Available() ? calculateExpiration(plan) : null;
 
-    // Save image to database (initially with Gemini URL)
-    const image = await prisma.image.create({
+  // Save image to database (initially with Gemini URL).
+  // The R2 copy is queued in the same insert so it survives a restart.
+  const image = await timeStage("db", () =>
+    prisma.image.create({
       data: {
-        userId: user.id,
+        userId,
         originalPrompt: prompt,
         enhancedPrompt: enhancedPrompt || null,
         imageUrl: imageUrl,
@@ -306,70 +419,25 @@ export async function generateImage(
         hasWatermark,
         expiresAt,
         externalId: externalId,
+        ...(isR2Available() && {
+          ingest: {
+            create: {
+              userId,
+              sourceUrl: imageUrl,
+              sourceThumbnailUrl: thumbnailUrl,
+            },
+          },
+        }),
       },
-    });
-
-    // Trigger async R2 upload (non-blocking)
-    // Image is returned immediately with Gemini URL, then migrated to R2 in background
-    if (isR2Available()) {
-      uploadToR2Async(
-        image.id,
-        imageUrl,
-        thumbnailUrl,
-        user.id
-      ).catch((err) => {
-        console.error("[R2] Async upload failed for image:", image.id, err);
-      });
-    }
-
-    // Deduct credits
-    await deductCredits(userId, creditsCost, resolution, image.id);
+    })
+  );
 
-    // Save to prompt history
-    await prisma.promptHistory.upsert({
-      where: {
-        id: `${user.id}-${prompt.slice(0, 100)}`, // Simplified unique key
-      },
-      create: {
-        id: `${user.id}-${prompt.slice(0, 100)}`,
-        userId: user.id,
-        prompt,
-        enhancedPrompt,
-        templateId,
-        presetId,
-      },
-      update: {
-        timesUsed: { increment: 1 },
-        lastUsedAt: new Date(),
-      },
-    }).catch(() => {
-      // Silently fail on history - not critical
-    });
-
-    // Get updated credits
-    const updatedCredits = await getUserCredits(userId);
-
-    return {
-      success: true,
-      image: {
-        id: image.id,
-        imageUrl: image.imageUrl,
-        thumbnailUrl: image.thumbnailUrl || undefined,
-        width: image.width,
-        height: image.height,
-        resolution: image.resolution,
-        creditsCost,
-        hasWatermark: image.hasWatermark,
-      },
-      creditsRemaining: updatedCredits.remaining,
-    };
-  } catch (error) {
-    console.error("Image generation failed:", error);
-    return {
-      success: false,
-      error: error instanceof Error ? error.message : "Generation failed",
-    };
+  // Image is returned immediately with Gemini URL, then copied to R2 by the ingest worker
+  if (isR2Available()) {
+    kickImageIngest();
   }
+
+  return image;
 }
 
 // =============================================================================
@@ -379,14 +447,37 @@ export async function generateImage(
 export interface BatchGenerateParams {
   userId: string;
   prompt: string;
+  /** Per-image prompts. When omitted, `prompt` is repeated `count` times. */
+  prompts?: string[];
   enhancedPrompt?: string;
   resolution?: Resolution;
   aspectRatio?: string;
   count: number;
   templateId?: string;
   presetId?: string;
+  projectId?: string;
+}
+
+export interface BatchPromptItem {
+  prompt: string;
+  enhancedPrompt?: string;
+}
+
+export interface BatchSharedSettings {
+  resolution: Resolution;
+  aspectRatio: string;
+  templateId?: string;
+  presetId?: string;
+  projectId?: string;
 }
 
+/**
+ * Queue a batch job.
+ *
+ * Credits for the whole batch are reserved up front and settled per image by
+ * the batch processor (committed on success, refunded on failure). The job is
+ * picked up by whichever node's worker claims it first.
+ */
 export async function batchGenerate(
   params: BatchGenerateParams
 ): Promise<{
@@ -394,11 +485,18 @@ export async function batchGenerate(
   jobId?: string;
   error?: string;
 }> {
-  const { userId, resolution = "1K", count } = params;
+  const { userId, resolution = "1K", aspectRatio = "1:1" } = params;
+  const prompts = params.prompts?.length
+    ? params.prompts
+    : Array.from({ length: params.count }, () => params.prompt);
+  const count = prompts.length;
 
   // Get user's plan
-  const credits = await getUserCredits(userId);
-  const plan = PLANS[credits.plan];
+  const subscription = await timeStage("credits", () => getOrCreateSubscriptionView(userId));
+  if (!subscription) {
+    return { success: false, error: "User not found" };
+  }
+  const plan = PLANS[subscription.plan];
 
   // Check batch access
   if (!plan.features.hasBatchMode) {
@@ -416,43 +514,66 @@ export async function batchGenerate(
     };
   }
 
+  // Check resolution access
+  if (!isResolutionAvailable(subscription.plan, resolution)) {
+    return {
+      success: false,
+      error: `${resolution} resolution requires ${getRequiredPlanForResolution(resolution)} plan or higher`,
+    };
+  }
+
   // Calculate total credits needed
   const creditPerImage = getCreditCost(resolution);
   const totalCredits = creditPerImage * count;
 
-  if (credits.remaining < totalCredits) {
+  const items: BatchPromptItem[] = prompts.map((prompt) => ({
+    prompt,
+    ...(params.enhancedPrompt && !params.prompts?.length
+      ? { enhancedPrompt: params.enhancedPrompt }
+      : {}),
+  }));
+
+  const sharedSettings: BatchSharedSettings = {
+    resolution,
+    aspectRatio,
+    templateId: params.templateId,
+    presetId: params.presetId,
+    projectId: params.projectId,
+  };
+
+  // Reserve credits and create the job atomically
+  const job = await timeStage("queue", () =>
+    prisma.$transaction(async (tx) => {
+      const reservation = await reserveCredits(userId, totalCredits, tx);
+      if (!reservation) {
+        return null;
+      }
+
+      return tx.batchJob.create({
+        data: {
+          userId,
+          totalImages: count,
+          prompts: items as unknown as Prisma.InputJsonValue,
+          sharedSettings: sharedSettings as unknown as Prisma.InputJsonValue,
+          creditsReserved: totalCredits,
+          priority: plan.features.hasPriorityQueue ? 1 : 0,
+          status: "PENDING",
+        },
+      });
+    })
+  );
+
+  if (!job) {
+    const credits = await getUserCredits(userId);
     return {
       success: false,
       error: `Not enough credits. Need ${totalCredits}, have ${credits.remaining}`,
     };
   }
 
-  // Get user
-  const user = await prisma.user.findUnique({
-    where: { id: userId },
-  });
-
-  if (!user) {
-    return { success: false, error: "User not found" };
-  }
-
-  // Create batch job
-  const job = await prisma.batchJob.create({
-    data: {
-      userId: user.id,
-      prompt: params.prompt,
-      templateId: params.templateId,
-      presetId: params.presetId,
-      resolution,
-      count,
-      creditsReserved: totalCredits,
-      status: "PENDING",
-    },
-  });
-
-  // TODO: Queue the batch job for processing
-  // For now, process synchronously (not ideal for production)
-  processBatchJob(job.id, params).catch(console.error);
+  // Wake the local worker so the job doesn't wait for the next poll
+  const { kickBatchWorker } = await import("@/lib/services/batch-processor");
+  kickBatchWorker();
 
   return {
     success: true,
@@ -460,22 +581,39 @@ export async function batchGenerate(
   };
 }
 
-async function processBatchJob(jobId: string, params: BatchGenerateParams) {
-  // Implementation would process images one by one
-  // and update the batch job status
-  // For production, use a job queue like Bull or similar
+/**
+ * Get batch job progress for its owner
+ */
+export async function getBatchJob(jobId: string, userId: string) {
+  const job = await prisma.batchJob.findFirst({
+    where: { id: jobId, userId },
+  });
+
+  if (!job) {
+    return null;
+  }
+
+  return {
+    id: job.id,
+    status: job.status,
+    totalImages: job.totalImages,
+    completedImages: job.completedImages,
+    failedImages: job.failedImages,
+    imageIds: job.imageIds,
+    imageIndexes: job.imageIndexes,
+    errors: (job.errors as Array<{ index: number; error: string }> | null) ?? [],
+    creditsReserved: job.creditsReserved,
+    creditsSettled: job.creditsSettled,
+    startedAt: job.startedAt,
+    completedAt: job.completedAt,
+    createdAt: job.createdAt,
+  };
 }
 
 // =============================================================================
 // HELPER FUNCTIONS
 // =============================================================================
 
-function getNextResetDate(): Date {
-  const now = new Date();
-  const nextMonth = new Date(now.getFullYear(), now.getMonth() + 1, 1);
-  return nextMonth;
-}
-
 function getRequiredPlanForResolution(resolution: Resolution): string {
   switch (resolution) {
     case "4K":
@@ -487,17 +625,6 @@ function getRequiredPlanForResolution(resolution: Resolution): string {
   }
 }
 
-function getEstimatedCost(resolution: Resolution): number {
-  switch (resolution) {
-    case "4K":
-      return 0.05;
-    case "2K":
-      return 0.025;
-    default:
-      return 0.01;
-  }
-}
-
 function calculateDimensions(
   resolution: Resolution,
   aspectRatio: string
@@ -534,25 +661,26 @@ function calculateDimensions(
 
 /**
  * Get a downloadable URL for an image
- * This fetches the image and returns it as a blob URL or base64
+ *
+ * Returns a same-origin URL on the download proxy, which streams the image
+ * (with Range/ETag support) instead of buffering it into a data URL.
  */
 export async function getDownloadableImage(
-  imageUrl: string
+  imageUrl: string,
+  filename?: string
 ): Promise<{ success: boolean; data?: string; error?: string }> {
   try {
-    const response = await fetch(imageUrl);
-    if (!response.ok) {
-      throw new Error(`Failed to fetch image: ${response.status}`);
-    }
+    // Validate early so callers get an error rather than a broken link
+    new URL(imageUrl);
 
-    const blob = await response.blob();
-    const arrayBuffer = await blob.arrayBuffer();
-    const base64 = Buffer.from(arrayBuffer).toString("base64");
-    const mimeType = blob.type || "image/png";
+    const query = new URLSearchParams({ url: imageUrl });
+    if (filename) {
+      query.set("filename", filename);
+    }
 
     return {
       success: true,
-      data: `data:${mimeType};base64,${base64}`,
+      data: `/api/images/download?${query.toString()}`,
     };
   } catch (error) {
     console.error("Download failed:", error);
@@ -0,0 +1,482 @@
+/**
+ * R2 Ingest Worker
+ *
+ * Copies generated images from the image-gen API to R2. Each image gets an
+ * ImageIngest row written in the same insert as the Image (an outbox), so the
+ * copy survives restarts. Workers on every node drain the outbox:
+ * - Tasks are claimed with FOR UPDATE SKIP LOCKED
+ * - At most R2_INGEST_CONCURRENCY copies run per node
+ * - The upstream body is piped into a multipart upload (never buffered)
+ * - A tee of the same bytes feeds the derivative pool (responsive renditions).
+ *   That branch is buffered for decoding, so sources over
+ *   DERIVATIVE_MAX_SOURCE_BYTES skip renditions; those images (and any whose
+ *   renditions fail) get the upstream thumbnail copied to R2 instead
+ * - Source fetches have a deadline (headers and body) shorter than the lease,
+ *   and the lease is kept alive with a heartbeat while the copy runs
+ * - Failures retry with jittered exponential backoff before giving up
+ * - Rows are deleted once the copy succeeds; only FAILED rows are kept
+ */
+
+import { hostname } from "os";
+import { randomUUID } from "crypto";
+import { Readable } from "stream";
+import type { ReadableStream as NodeReadableStream } from "stream/web";
+import type { Prisma } from "@prisma/client";
+import { prisma } from "@/lib/prisma";
+import {
+  generateImageKey,
+  isR2Available,
+  uploadStreamToR2,
+  uploadToR2,
+} from "@/lib/r2";
+import {
+  createImageDerivatives,
+  DERIVATIVE_MAX_SOURCE_BYTES,
+  readImageStream,
+  SourceTooLargeError,
+  type ImageDerivatives,
+} from "@/lib/image-derivatives";
+import { pickVariant, THUMBNAIL_VARIANT_WIDTH } from "@/lib/image-variants";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+const CONCURRENCY = parseInt(process.env.R2_INGEST_CONCURRENCY || "4");
+const POLL_INTERVAL_MS = parseInt(process.env.R2_INGEST_POLL_INTERVAL_MS || "1000");
+// A task still PROCESSING after this is assumed abandoned by a dead node
+const LEASE_TIMEOUT_MS = parseInt(process.env.R2_INGEST_LEASE_TIMEOUT_MS || "300000");
+// Deadline for downloading a source image, body included
+const FETCH_TIMEOUT_MS = Math.min(
+  parseInt(process.env.R2_INGEST_FETCH_TIMEOUT_MS || "120000"),
+  Math.floor(LEASE_TIMEOUT_MS / 2)
+);
+const MAX_ATTEMPTS = parseInt(process.env.R2_INGEST_MAX_ATTEMPTS || "8");
+const BACKOFF_BASE_MS = 5_000;
+const BACKOFF_MAX_MS = 10 * 60_000;
+
+const NODE_ID = `${hostname()}:${process.pid}:${randomUUID().slice(0, 8)}`;
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+interface IngestTask {
+  id: string;
+  imageId: string;
+  userId: string;
+  sourceUrl: string;
+  sourceThumbnailUrl: string | null;
+  attempts: number;
+}
+
+class PermanentIngestError extends Error {
+  constructor(message: string) {
+    super(message);
+    this.name = "PermanentIngestError";
+  }
+}
+
+interface IngestWorkerState {
+  started: boolean;
+  polling: boolean;
+  timer: ReturnType<typeof setInterval> | null;
+  inFlight: number;
+  completed: number;
+  failed: number;
+  retried: number;
+  bytesUploaded: number;
+  recentCompletions: number[]; // Timestamps within the throughput window
+}
+
+const THROUGHPUT_WINDOW_MS = 60_000;
+
+// Survive hot reloads in development (same pattern as lib/prisma.ts)
+const globalForIngest = globalThis as unknown as {
+  imageIngest: IngestWorkerState | undefined;
+};
+
+const worker: IngestWorkerState =
+  globalForIngest.imageIngest ??
+  (globalForIngest.imageIngest = {
+    started: false,
+    polling: false,
+    timer: null,
+    inFlight: 0,
+    completed: 0,
+    failed: 0,
+    retried: 0,
+    bytesUploaded: 0,
+    recentCompletions: [],
+  });
+
+// =============================================================================
+// WORKER LIFECYCLE
+// =============================================================================
+
+/**
+ * Start draining the ingest outbox on this node
+ */
+export function startImageIngestWorker(): void {
+  if (worker.started || !isR2Available()) return;
+  worker.started = true;
+
+  worker.timer = setInterval(() => {
+    void poll();
+  }, POLL_INTERVAL_MS);
+  worker.timer.unref?.();
+
+  console.log(`[R2 Ingest] Worker ${NODE_ID} started (concurrency: ${CONCURRENCY})`);
+  void poll();
+}
+
+/**
+ * Stop polling (in-flight copies finish, or are reclaimed after the lease)
+ */
+export function stopImageIngestWorker(): void {
+  worker.started = false;
+  if (worker.timer) {
+    clearInterval(worker.timer);
+    worker.timer = null;
+  }
+}
+
+/**
+ * Ask the local worker to look for tasks now instead of at the next poll
+ */
+export function kickImageIngest(): void {
+  if (!worker.started) return;
+  setImmediate(() => {
+    void poll();
+  });
+}
+
+async function poll(): Promise<void> {
+  if (!worker.started || worker.polling) return;
+  worker.polling = true;
+
+  try {
+    const free = CONCURRENCY - worker.inFlight;
+    if (free <= 0) return;
+
+    const tasks = await claimTasks(free);
+    for (const task of tasks) {
+      worker.inFlight++;
+      processTask(task)
+        .catch((error) => {
+          console.error(`[R2 Ingest] Task ${task.id} crashed:`, error);
+        })
+        .finally(() => {
+          worker.inFlight--;
+          kickImageIngest();
+        });
+    }
+  } catch (error) {
+    console.error("[R2 Ingest] Poll failed:", error);
+  } finally {
+    worker.polling = false;
+  }
+}
+
+// =============================================================================
+// CLAIMING
+// =============================================================================
+
+/**
+ * Claim up to `limit` due tasks: PENDING past their backoff, or PROCESSING
+ * with an expired lease
+ */
+async function claimTasks(limit: number): Promise<IngestTask[]> {
+  const leaseSeconds = LEASE_TIMEOUT_MS / 1000;
+
+  return prisma.$queryRaw<IngestTask[]>`
+    UPDATE "ImageIngest"
+    SET "status" = 'PROCESSING',
+        "lockedBy" = ${NODE_ID},
+        "lockedAt" = now(),
+        "attempts" = "attempts" + 1
+    WHERE "id" IN (
+      SELECT "id"
+      FROM "ImageIngest"
+      WHERE ("status" = 'PENDING' AND "nextAttemptAt" <= now())
+         OR ("status" = 'PROCESSING'
+             AND "lockedAt" < now() - make_interval(secs => ${leaseSeconds}))
+      ORDER BY "nextAttemptAt" ASC
+      LIMIT ${limit}
+      FOR UPDATE SKIP LOCKED
+    )
+    RETURNING "id", "imageId", "userId", "sourceUrl", "sourceThumbnailUrl", "attempts"
+  `;
+}
+
+// =============================================================================
+// PROCESSING
+// =============================================================================
+
+async function processTask(task: IngestTask): Promise<void> {
+  // Keep the lease alive while the copy runs (same pattern as batch-processor)
+  const heartbeat = setInterval(() => {
+    prisma.imageIngest
+      .updateMany({
+        where: { id: task.id, lockedBy: NODE_ID },
+        data: { lockedAt: new Date() },
+      })
+      .catch((error) => {
+        console.error(`[R2 Ingest] Heartbeat failed for task ${task.id}:`, error);
+      });
+  }, Math.max(1000, Math.floor(LEASE_TIMEOUT_MS / 3)));
+  heartbeat.unref?.();
+
+  try {
+    const { imageUrl, derivatives, bytes } = await copyToR2(task);
+    // Never store the upstream thumbnail URL itself; it expires
+    const thumbnailUrl = derivatives
+      ? (pickVariant(derivatives.variants, THUMBNAIL_VARIANT_WIDTH)?.url ?? null)
+      : await copyThumbnailToR2(task);
+
+    // Guarded by the lease: a node whose task was reclaimed must not overwrite
+    // the new owner's result. Interactive so the Image write can be skipped.
+    const owned = await prisma.$transaction(async (tx) => {
+      const { count } = await tx.imageIngest.deleteMany({
+        where: { id: task.id, lockedBy: NODE_ID },
+      });
+      if (count === 0) return false;
+
+      await tx.image.update({
+        where: { id: task.imageId },
+        data: {
+          imageUrl,
+          thumbnailUrl,
+          ...(derivatives && {
+            contentHash: derivatives.contentHash,
+            variants: derivatives.variants as unknown as Prisma.InputJsonValue,
+            blurDataUrl: derivatives.blurDataUrl,
+          }),
+        },
+      });
+      // The Image row now records the outcome; the outbox entry was dropped
+      // above so the table only holds outstanding and failed copies
+      return true;
+    });
+
+    if (!owned) {
+      console.warn(`[R2 Ingest] Lost the lease on task ${task.id}, discarding result`);
+      return;
+    }
+
+    worker.completed++;
+    worker.bytesUploaded += bytes;
+    recordCompletion();
+  } catch (error) {
+    const message = error instanceof Error ? error.message : "Ingest failed";
+    const permanent =
+      error instanceof PermanentIngestError || task.attempts >= MAX_ATTEMPTS;
+
+    if (permanent) {
+      worker.failed++;
+      console.error(`[R2 Ingest] Giving up on image ${task.imageId}: ${message}`);
+    } else {
+      worker.retried++;
+      console.warn(
+        `[R2 Ingest] Image ${task.imageId} attempt ${task.attempts} failed, retrying: ${message}`
+      );
+    }
+
+    // updateMany so a row reclaimed (or already finished) elsewhere is left alone
+    await prisma.imageIngest.updateMany({
+      where: { id: task.id, lockedBy: NODE_ID },
+      data: {
+        status: permanent ? "FAILED" : "PENDING",
+        nextAttemptAt: new Date(Date.now() + backoffDelay(task.attempts)),
+        lastError: message.slice(0, 1000),
+        lockedBy: null,
+        lockedAt: null,
+      },
+    });
+  } finally {
+    clearInterval(heartbeat);
+  }
+}
+
+/**
+ * Stream the source image into R2, building renditions from the same bytes
+ */
+async function copyToR2(task: IngestTask): Promise<{
+  imageUrl: string;
+  derivatives: ImageDerivatives | null;
+  bytes: number;
+}> {
+  const response = await fetch(task.sourceUrl, {
+    signal: AbortSignal.timeout(FETCH_TIMEOUT_MS),
+  });
+
+  if (!response.ok || !response.body) {
+    // Expired or missing source images will never succeed
+    if (response.status === 404 || response.status === 410) {
+      throw new PermanentIngestError(`Source image gone: ${response.status}`);
+    }
+    throw new Error(`Failed to fetch image: ${response.status}`);
+  }
+
+  const contentType = response.headers.get("Content-Type") || "image/png";
+  const contentLength = Number(response.headers.get("Content-Length")) || 0;
+  // Known-oversized sources aren't teed at all; unknown sizes are capped while reading
+  const shouldGenerateDerivatives =
+    process.env.R2_GENERATE_THUMBNAILS !== "false" &&
+    contentLength <= DERIVATIVE_MAX_SOURCE_BYTES;
+
+  const [uploadBranch, derivativeBranch] = shouldGenerateDerivatives
+    ? response.body.tee()
+    : [response.body, null];
+
+  const imageKey = generateImageKey(task.userId, task.imageId, "png");
+
+  const [uploadResult, derivatives] = await Promise.all([
+    uploadStreamToR2({
+      body: toNodeStream(uploadBranch),
+      key: imageKey,
+      contentType,
+      metadata: {
+        userId: task.userId,
+        originalUrl: task.sourceUrl.slice(0, 200), // Truncate for metadata limits
+      },
+    }),
+    derivativeBranch ? buildDerivatives(task, derivativeBranch) : Promise.resolve(null),
+  ]);
+
+  if (!uploadResult.success) {
+    throw new Error(uploadResult.error || "Upload failed");
+  }
+
+  return {
+    imageUrl: uploadResult.url!,
+    derivatives,
+    bytes: uploadResult.bytes ?? 0,
+  };
+}
+
+/**
+ * Rendition failures are logged but never fail the ingest
+ */
+async function buildDerivatives(
+  task: IngestTask,
+  stream: ReadableStream<Uint8Array>
+): Promise<ImageDerivatives | null> {
+  try {
+    const { buffer, contentHash } = await readImageStream(stream);
+    return await createImageDerivatives(buffer, contentHash);
+  } catch (error) {
+    if (error instanceof SourceTooLargeError) {
+      console.warn(`[R2 Ingest] Skipping renditions for ${task.imageId}: ${error.message}`);
+    } else {
+      console.error(`[R2 Ingest] Failed to build renditions for ${task.imageId}:`, error);
+    }
+    return null;
+  }
+}
+
+/**
+ * Copy the upstream thumbnail to R2 when there are no renditions to use.
+ * Returns null (no thumbnail; clients fall back to the original) on failure.
+ */
+async function copyThumbnailToR2(task: IngestTask): Promise<string | null> {
+  if (!task.sourceThumbnailUrl) return null;
+
+  try {
+    const response = await fetch(task.sourceThumbnailUrl, {
+      signal: AbortSignal.timeout(FETCH_TIMEOUT_MS),
+    });
+    if (!response.ok) {
+      throw new Error(`Failed to fetch thumbnail: ${response.status}`);
+    }
+
+    const contentType = response.headers.get("Content-Type") || "image/jpeg";
+    const extension = contentType.split("/")[1]?.split(";")[0] || "jpg";
+    const upload = await uploadToR2({
+      buffer: Buffer.from(await response.arrayBuffer()),
+      key: generateImageKey(task.userId, `${task.imageId}-thumb`, extension),
+      contentType,
+      metadata: { userId: task.userId, type: "thumbnail" },
+    });
+
+    if (!upload.success) throw new Error(upload.error || "Upload failed");
+    return upload.url!;
+  } catch (error) {
+    console.error(`[R2 Ingest] Failed to copy thumbnail for ${task.imageId}:`, error);
+    return null;
+  }
+}
+
+// =============================================================================
+// METRICS
+// =============================================================================
+
+/**
+ * Queue depth, lag and throughput for the ingest pipeline
+ *
+ * Queue figures are global (from the outbox table); throughput and
+ * counters are for this node since it started.
+ */
+export async function getImageIngestStats() {
+  const [pending, processing, failed, oldestPending] = await Promise.all([
+    prisma.imageIngest.count({ where: { status: "PENDING" } }),
+    prisma.imageIngest.count({ where: { status: "PROCESSING" } }),
+    prisma.imageIngest.count({ where: { status: "FAILED" } }),
+    prisma.imageIngest.findFirst({
+      where: { status: { in: ["PENDING", "PROCESSING"] } },
+      orderBy: { createdAt: "asc" },
+      select: { createdAt: true },
+    }),
+  ]);
+
+  pruneCompletions();
+
+  return {
+    queueDepth: pending + processing,
+    pending,
+    processing,
+    failed,
+    lagSeconds: oldestPending
+      ? Math.round((Date.now() - oldestPending.createdAt.getTime()) / 1000)
+      : 0,
+    node: {
+      nodeId: NODE_ID,
+      running: worker.started,
+      inFlight: worker.inFlight,
+      concurrency: CONCURRENCY,
+      completed: worker.completed,
+      failed: worker.failed,
+      retried: worker.retried,
+      bytesUploaded: worker.bytesUploaded,
+      imagesPerMinute: worker.recentCompletions.length,
+    },
+  };
+}
+
+// =============================================================================
+// HELPER FUNCTIONS
+// =============================================================================
+
+function toNodeStream(stream: ReadableStream<Uint8Array>): Readable {
+  return Readable.fromWeb(stream as unknown as NodeReadableStream<Uint8Array>);
+}
+
+/**
+ * Exponential backoff with jitter
+ */
+function backoffDelay(attempt: number): number {
+  const ceiling = Math.min(BACKOFF_MAX_MS, BACKOFF_BASE_MS * 2 ** (attempt - 1));
+  return Math.round(ceiling / 2 + Math.random() * (ceiling / 2));
+}
+
+function recordCompletion(): void {
+  worker.recentCompletions.push(Date.now());
+  pruneCompletions();
+}
+
+function pruneCompletions(): void {
+  const cutoff = Date.now() - THROUGHPUT_WINDOW_MS;
+  while (worker.recentCompletions.length && worker.recentCompletions[0] < cutoff) {
+    worker.recentCompletions.shift();
+  }
+}
@@ -0,0 +1,256 @@
+/**
+ * Expired Image Reaper
+ *
+ * Deletes expired images from R2 and soft-deletes their rows:
+ * - Expired rows are paged by keyset on the (status, deletedAt, expiresAt, id)
+ *   index. Reaped and deleted rows fall outside the live prefix
+ *   (status = COMPLETED, deletedAt IS NULL), so each page is an index range
+ *   scan no matter how many images have been reaped before
+ * - Each page's objects are removed with DeleteObjects (up to 1000 keys per
+ *   request) and its rows updated with a single updateMany
+ * - Up to CLEANUP_CONCURRENCY pages are in flight at once; no new pages are
+ *   started once the time budget is spent, so a run always returns in time
+ *   and the next run picks up where this one stopped
+ *
+ * Renditions are content-addressed and can be shared by several images with
+ * the same contentHash; they are only deleted once no unexpired image
+ * still uses them.
+ */
+
+import { prisma } from "@/lib/prisma";
+import { deleteManyFromR2, extractR2Key, isR2Url } from "@/lib/r2";
+import type { ImageVariant } from "@/lib/image-variants";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+const PAGE_SIZE = parseInt(process.env.CLEANUP_PAGE_SIZE || "500");
+const CONCURRENCY = parseInt(process.env.CLEANUP_CONCURRENCY || "4");
+const TIME_BUDGET_MS = parseInt(process.env.CLEANUP_TIME_BUDGET_MS || "240000");
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+export interface ReapOptions {
+  pageSize?: number;
+  concurrency?: number;
+  timeBudgetMs?: number;
+  maxImages?: number; // Stop after this many rows (default: no limit)
+}
+
+export interface ReapResult {
+  scanned: number;
+  deleted: number; // Rows soft-deleted
+  skipped: number; // Rows left for the next run (their object could not be deleted)
+  objectsDeleted: number;
+  objectsFailed: number;
+  pages: number;
+  complete: boolean; // False if the run stopped on the time budget or maxImages
+  durationMs: number;
+  imagesPerSecond: number;
+  errors: string[];
+}
+
+interface ExpiredImage {
+  id: string;
+  expiresAt: Date;
+  imageUrl: string;
+  thumbnailUrl: string | null;
+  contentHash: string | null;
+  variants: ImageVariant[] | null;
+}
+
+// =============================================================================
+// REAPER
+// =============================================================================
+
+/**
+ * Reap expired images until none are left or the time budget is spent
+ */
+export async function reapExpiredImages(options: ReapOptions = {}): Promise<ReapResult> {
+  const pageSize = options.pageSize ?? PAGE_SIZE;
+  const concurrency = options.concurrency ?? CONCURRENCY;
+  const timeBudgetMs = options.timeBudgetMs ?? TIME_BUDGET_MS;
+  const maxImages = options.maxImages ?? Infinity;
+
+  const startedAt = Date.now();
+  const now = new Date(startedAt);
+
+  const result: ReapResult = {
+    scanned: 0,
+    deleted: 0,
+    skipped: 0,
+    objectsDeleted: 0,
+    objectsFailed: 0,
+    pages: 0,
+    complete: false,
+    durationMs: 0,
+    imagesPerSecond: 0,
+    errors: [],
+  };
+
+  const inFlight = new Set<Promise<void>>();
+  let cursor: { expiresAt: Date; id: string } | null = null;
+
+  while (Date.now() - startedAt < timeBudgetMs && result.scanned < maxImages) {
+    const take = Math.min(pageSize, maxImages - result.scanned);
+    const page = await fetchExpiredPage(now, cursor, take);
+
+    result.scanned += page.length;
+    if (page.length === 0) {
+      result.complete = true;
+      break;
+    }
+
+    const last = page[page.length - 1];
+    cursor = { expiresAt: last.expiresAt, id: last.id };
+    result.pages++;
+
+    const task = reapPage(page, now, result)
+      .catch((error) => {
+        console.error("[Cleanup] Page failed:", error);
+        result.skipped += page.length;
+        result.errors.push(error instanceof Error ? error.message : "Page failed");
+      })
+      .finally(() => {
+        inFlight.delete(task);
+      });
+    inFlight.add(task);
+
+    if (inFlight.size >= concurrency) {
+      await Promise.race(inFlight);
+    }
+
+    // A short page means nothing expired is left after it
+    if (page.length < take) {
+      result.complete = true;
+      break;
+    }
+  }
+
+  await Promise.all(inFlight);
+
+  result.durationMs = Date.now() - startedAt;
+  result.imagesPerSecond =
+    result.durationMs > 0
+      ? Math.round((result.deleted / result.durationMs) * 1000 * 10) / 10
+      : 0;
+
+  return result;
+}
+
+/**
+ * Next page of expired rows after `cursor`, in (expiresAt, id) order.
+ * The status / deletedAt filters are the index prefix; keep them in sync
+ * with the @@index on Image.
+ */
+async function fetchExpiredPage(
+  now: Date,
+  cursor: { expiresAt: Date; id: string } | null,
+  take: number
+): Promise<ExpiredImage[]> {
+  if (cursor) {
+    return prisma.$queryRaw<ExpiredImage[]>`
+      SELECT "id", "expiresAt", "imageUrl", "thumbnailUrl", "contentHash", "variants"
+      FROM "Image"
+      WHERE "expiresAt" <= ${now}
+        AND ("expiresAt", "id") > (${cursor.expiresAt}, ${cursor.id})
+        AND "status" = 'COMPLETED'
+        AND "deletedAt" IS NULL
+      ORDER BY "expiresAt" ASC, "id" ASC
+      LIMIT ${take}
+    `;
+  }
+
+  return prisma.$queryRaw<ExpiredImage[]>`
+    SELECT "id", "expiresAt", "imageUrl", "thumbnailUrl", "contentHash", "variants"
+    FROM "Image"
+    WHERE "expiresAt" <= ${now}
+      AND "status" = 'COMPLETED'
+      AND "deletedAt" IS NULL
+    ORDER BY "expiresAt" ASC, "id" ASC
+    LIMIT ${take}
+  `;
+}
+
+/**
+ * Delete one page's objects, then soft-delete the rows whose original was
+ * removed (the rest stay expired and are retried on the next run)
+ */
+async function reapPage(page: ExpiredImage[], now: Date, result: ReapResult): Promise<void> {
+  const sharedHashes = await findSharedHashes(page, now);
+
+  const keys = new Set<string>();
+  const originalKeys = new Map<string, string>(); // image id -> key of its original
+
+  for (const image of page) {
+    if (isR2Url(image.imageUrl)) {
+      const key = extractR2Key(image.imageUrl);
+      keys.add(key);
+      originalKeys.set(image.id, key);
+    }
+
+    // Renditions (the thumbnail is usually one of them) may be shared
+    const keepShared = !!image.contentHash && sharedHashes.has(image.contentHash);
+    const renditionUrls = [image.thumbnailUrl, ...(image.variants ?? []).map((v) => v.url)];
+
+    for (const url of renditionUrls) {
+      if (!url || !isR2Url(url)) continue;
+      const key = extractR2Key(url);
+      if (keepShared && key.startsWith("variants/")) continue;
+      keys.add(key);
+    }
+  }
+
+  const { deleted, failed } =
+    keys.size > 0 ? await deleteManyFromR2([...keys]) : { deleted: 0, failed: [] };
+
+  result.objectsDeleted += deleted;
+  result.objectsFailed += failed.length;
+
+  const failedKeys = new Set(failed);
+  const reapable = page.filter((image) => {
+    const key = originalKeys.get(image.id);
+    return !key || !failedKeys.has(key);
+  });
+
+  if (failed.length > 0) {
+    result.errors.push(`${failed.length} objects could not be deleted (e.g. ${failed[0]})`);
+  }
+
+  if (reapable.length > 0) {
+    const updated = await prisma.image.updateMany({
+      where: { id: { in: reapable.map((image) => image.id) }, deletedAt: null },
+      data: { status: "EXPIRED", deletedAt: now },
+    });
+    result.deleted += updated.count;
+  }
+
+  result.skipped += page.length - reapable.length;
+}
+
+/**
+ * Content hashes in this page that an unexpired image outside the page still
+ * uses; their renditions must be kept
+ */
+async function findSharedHashes(page: ExpiredImage[], now: Date): Promise<Set<string>> {
+  const hashes = [
+    ...new Set(page.map((image) => image.contentHash).filter((h): h is string => !!h)),
+  ];
+  if (hashes.length === 0) return new Set();
+
+  const users = await prisma.image.findMany({
+    where: {
+      contentHash: { in: hashes },
+      id: { notIn: page.map((image) => image.id) },
+      deletedAt: null,
+      OR: [{ expiresAt: null }, { expiresAt: { gt: now } }],
+    },
+    select: { contentHash: true },
+    distinct: ["contentHash"],
+  });
+
+  return new Set(users.map((image) => image.contentHash!));
+}
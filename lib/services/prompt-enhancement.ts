@@ -14,8 +14,16 @@
  * - Model flexibility (Claude, GPT, Grok, etc.)
  */
 
+import { createHash } from "crypto";
 import { prisma } from "@/lib/prisma";
 import type { CharacterProfile, Template, TemplatePreset } from "@prisma/client";
+import {
+  getTemplate,
+  recordTemplateUsage,
+  reloadTemplateCatalog,
+} from "@/lib/template-catalog";
+import { CircuitOpenError, upstreams } from "@/lib/upstream";
+import { timeStage } from "@/lib/timing";
 
 // ============================================================================
 // AI GATEWAY CONFIGURATION
@@ -27,6 +35,14 @@ const AI_GATEWAY_KEY = process.env.AI_GATEWAY_API_KEY || process.env.DEVMAESTRO_
 const AI_MODEL = process.env.AI_MODEL || "claude-3-5-sonnet";
 // Enable fallback mode when AI gateway is unavailable
 const AI_ENHANCEMENT_REQUIRED = process.env.AI_ENHANCEMENT_REQUIRED === "true";
+// Character analysis (vision) is slower than text enhancement
+const AI_VISION_TIMEOUT_MS = parseInt(process.env.AI_VISION_TIMEOUT_MS || "60000");
+
+// Gateway enhancements are memoized per process on their normalized inputs
+const ENHANCEMENT_CACHE_MAX_ENTRIES = parseInt(
+  process.env.PROMPT_CACHE_MAX_ENTRIES || "5000"
+);
+const ENHANCEMENT_CACHE_TTL_MS = parseInt(process.env.PROMPT_CACHE_TTL_MS || "3600000");
 
 interface AIGatewayResponse {
   id: string;
@@ -89,6 +105,141 @@ export interface CharacterAnalysisResult {
   styleNotes: string;
 }
 
+// ============================================================================
+// ENHANCEMENT CACHE
+// ============================================================================
+
+interface EnhancementCacheState {
+  entries: Map<string, { prompt: string; expiresAt: number }>;
+  inFlight: Map<string, Promise<string | null>>;
+  hits: number;
+  misses: number;
+  coalesced: number;
+}
+
+// Survive hot reloads in development (same pattern as lib/prisma.ts)
+const globalForEnhancement = globalThis as unknown as {
+  enhancementCache: EnhancementCacheState | undefined;
+};
+
+const enhancementCache: EnhancementCacheState =
+  globalForEnhancement.enhancementCache ??
+  (globalForEnhancement.enhancementCache = {
+    entries: new Map(),
+    inFlight: new Map(),
+    hits: 0,
+    misses: 0,
+    coalesced: 0,
+  });
+
+/**
+ * Return a cached enhancement, join an identical in-flight gateway call, or
+ * start a new one. Only successful gateway responses are cached; fallbacks
+ * (null) are retried on the next request.
+ */
+function memoizeEnhancement(
+  key: string,
+  call: () => Promise<string | null>
+): Promise<string | null> {
+  const cached = enhancementCache.entries.get(key);
+  if (cached && cached.expiresAt > Date.now()) {
+    // Move to the back of the Map (most recently used)
+    enhancementCache.entries.delete(key);
+    enhancementCache.entries.set(key, cached);
+    enhancementCache.hits++;
+    return Promise.resolve(cached.prompt);
+  }
+  if (cached) enhancementCache.entries.delete(key);
+
+  const pending = enhancementCache.inFlight.get(key);
+  if (pending) {
+    enhancementCache.coalesced++;
+    return pending;
+  }
+
+  enhancementCache.misses++;
+  const request = call()
+    .then((prompt) => {
+      if (prompt) {
+        if (enhancementCache.entries.size >= ENHANCEMENT_CACHE_MAX_ENTRIES) {
+          const oldest = enhancementCache.entries.keys().next().value;
+          if (oldest !== undefined) enhancementCache.entries.delete(oldest);
+        }
+        enhancementCache.entries.set(key, {
+          prompt,
+          expiresAt: Date.now() + ENHANCEMENT_CACHE_TTL_MS,
+        });
+      }
+      return prompt;
+    })
+    .finally(() => {
+      enhancementCache.inFlight.delete(key);
+    });
+
+  enhancementCache.inFlight.set(key, request);
+  return request;
+}
+
+/**
+ * Cache key for everything that shapes the gateway request. Free text is
+ * normalized (whitespace) so trivially different requests share an entry;
+ * template and character versions are included so edits invalidate.
+ */
+function getEnhancementCacheKey(params: {
+  model: string;
+  userPrompt: string;
+  template: Template | null;
+  preset: TemplatePreset | null;
+  characterProfile: CharacterProfile | null;
+  aspectRatio: string;
+  styleHints: string | null;
+}): string {
+  const { model, userPrompt, template, preset, characterProfile, aspectRatio, styleHints } =
+    params;
+
+  return createHash("sha256")
+    .update(
+      JSON.stringify([
+        model,
+        normalizeText(userPrompt),
+        template ? `${template.id}:${template.updatedAt.getTime()}` : null,
+        preset ? [preset.id, preset.styleOverrides, preset.promptSuffix] : null,
+        aspectRatio,
+        styleHints ? normalizeText(styleHints) : null,
+        characterProfile
+          ? `${characterProfile.id}:${characterProfile.updatedAt.getTime()}`
+          : null,
+      ])
+    )
+    .digest("hex");
+}
+
+/**
+ * Whitespace only: case can matter (e.g. text rendered in the image), and the
+ * cached enhancement carries the casing of the request that produced it
+ */
+function normalizeText(text: string): string {
+  return text.trim().replace(/\s+/g, " ");
+}
+
+/**
+ * Enhancement cache effectiveness, for metrics
+ */
+export function getPromptEnhancementStats() {
+  const lookups = enhancementCache.hits + enhancementCache.misses + enhancementCache.coalesced;
+  return {
+    entries: enhancementCache.entries.size,
+    inFlight: enhancementCache.inFlight.size,
+    hits: enhancementCache.hits,
+    misses: enhancementCache.misses,
+    coalesced: enhancementCache.coalesced,
+    hitRate:
+      lookups > 0
+        ? Math.round(((enhancementCache.hits + enhancementCache.coalesced) / lookups) * 1000) / 1000
+        : 0,
+  };
+}
+
 // ============================================================================
 // PROMPT ENHANCEMENT SERVICE
 // ============================================================================
@@ -126,8 +277,10 @@ export class PromptEnhancementService {
     }
 
     try {
-      const response = await fetch(this.gatewayUrl, {
+      // Completions have no side effects, so failed attempts may be retried
+      const response = await upstreams.aiGateway.request(this.gatewayUrl, {
         method: "POST",
+        idempotent: true,
         headers: {
           Authorization: `Bearer ${this.apiKey}`,
           "Content-Type": "application/json",
@@ -144,7 +297,7 @@ export class PromptEnhancementService {
       });
 
       if (!response.ok) {
-        const errorText = await response.text();
+        const errorText = response.text();
         console.error("AI Gateway error:", response.status, errorText);
 
         // If enhancement is required, throw the error
@@ -157,9 +310,14 @@ export class PromptEnhancementService {
         return null;
       }
 
-      const data = (await response.json()) as AIGatewayResponse;
+      const data = response.json<AIGatewayResponse>();
       return data.choices[0]?.message?.content || null;
     } catch (error) {
+      // Gateway known to be down: fall back immediately, without log noise
+      if (error instanceof CircuitOpenError && !AI_ENHANCEMENT_REQUIRED) {
+        return null;
+      }
+
       console.error("AI Gateway call failed:", error);
 
       // If enhancement is required, re-throw the error
@@ -179,15 +337,12 @@ export class PromptEnhancementService {
   async enhancePrompt(request: PromptEnhancementRequest): Promise<EnhancedPrompt> {
     const { userPrompt, templateSlug, presetSlug, projectId, aspectRatio, styleHints } = request;
 
-    // 1. Load template if specified
+    // 1. Load template if specified (from the in-memory catalog)
     let template: (Template & { presets: TemplatePreset[] }) | null = null;
     let preset: TemplatePreset | null = null;
 
     if (templateSlug) {
-      template = await prisma.template.findUnique({
-        where: { slug: templateSlug },
-        include: { presets: true },
-      });
+      template = await getTemplate(templateSlug);
 
       if (template && presetSlug) {
         preset = template.presets.find((p) => p.slug === presetSlug) || null;
@@ -212,12 +367,9 @@ export class PromptEnhancementService {
       styleHints,
     });
 
-    // 4. Update template usage count
+    // 4. Count template usage (flushed to the database in bulk)
     if (template) {
-      await prisma.template.update({
-        where: { id: template.id },
-        data: { usageCount: { increment: 1 } },
-      });
+      recordTemplateUsage(template.id);
     }
 
     return enhanced;
@@ -251,6 +403,16 @@ export class PromptEnhancementService {
     }
 
     // Construct the prompt enhancement request
+    const cacheKey = getEnhancementCacheKey({
+      model: this.model,
+      userPrompt,
+      template,
+      preset,
+      characterProfile,
+      aspectRatio: finalAspectRatio,
+      styleHints: finalStyleHints,
+    });
+
     const systemPrompt = this.buildSystemPrompt(template, preset, characterProfile);
 
     const userMessage = `Transform this user request into an optimized Gemini image prompt:
@@ -263,8 +425,10 @@ ${characterProfile ? `CHARACTER TO INCLUDE: ${characterProfile.name}` : ""}
 
 Respond with ONLY the optimized prompt text, nothing else. Keep it 20-50 words.`;
 
-    // Try AI enhancement, fall back to user prompt if unavailable
-    const aiEnhancedPrompt = await this.callAIGateway(systemPrompt, userMessage, 1024);
+    // Try AI enhancement (memoized), fall back to user prompt if unavailable
+    const aiEnhancedPrompt = await timeStage("ai_gateway", () =>
+      memoizeEnhancement(cacheKey, () => this.callAIGateway(systemPrompt, userMessage, 1024))
+    );
 
     // Use AI-enhanced prompt if available, otherwise use original with basic enhancement
     let enhancedPrompt: string;
@@ -385,8 +549,10 @@ Format your response as JSON:
 }`;
 
     // Use OpenAI-compatible vision format through the gateway
-    const response = await fetch(this.gatewayUrl, {
+    const response = await upstreams.aiGateway.request(this.gatewayUrl, {
       method: "POST",
+      idempotent: true,
+      timeoutMs: AI_VISION_TIMEOUT_MS,
       headers: {
         Authorization: `Bearer ${this.apiKey}`,
         "Content-Type": "application/json",
@@ -416,12 +582,12 @@ Format your response as JSON:
     });
 
     if (!response.ok) {
-      const errorText = await response.text();
+      const errorText = response.text();
       console.error("AI Gateway vision error:", response.status, errorText);
       throw new Error(`AI Gateway error: ${response.status} - ${errorText}`);
     }
 
-    const data = (await response.json()) as AIGatewayResponse;
+    const data = response.json<AIGatewayResponse>();
     const content = data.choices[0]?.message?.content || "";
 
     // Parse the JSON response
@@ -875,5 +1041,7 @@ export async function seedTemplates() {
     });
   }
 
+  await reloadTemplateCatalog();
+
   console.log(`Seeded ${TEMPLATE_DEFINITIONS.length} templates`);
 }
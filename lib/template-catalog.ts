@@ -0,0 +1,195 @@
+/**
+ * Template Catalog
+ *
+ * In-process copy of Template/TemplatePreset. The catalog only changes when
+ * templates are seeded, so lookups are served from memory:
+ * - Loaded once on first use; concurrent first lookups share one query
+ * - reloadTemplateCatalog() swaps in a fresh copy (seedTemplates calls it);
+ *   other nodes pick up changes after TEMPLATE_CATALOG_MAX_AGE_MS
+ *
+ * Also buffers template usage counts in memory and writes them in one bulk
+ * UPDATE every TEMPLATE_USAGE_FLUSH_INTERVAL_MS. Counts buffered since the
+ * last flush are lost if the process dies; usageCount is a popularity
+ * signal, not billing data.
+ */
+
+import type { Template, TemplatePreset } from "@prisma/client";
+import { prisma } from "@/lib/prisma";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+// Refresh in the background once the catalog is older than this
+const CATALOG_MAX_AGE_MS = parseInt(process.env.TEMPLATE_CATALOG_MAX_AGE_MS || "600000");
+const USAGE_FLUSH_INTERVAL_MS = parseInt(
+  process.env.TEMPLATE_USAGE_FLUSH_INTERVAL_MS || "10000"
+);
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+export type CatalogTemplate = Template & { presets: TemplatePreset[] };
+
+interface Catalog {
+  bySlug: Map<string, CatalogTemplate>;
+  byId: Map<string, CatalogTemplate>;
+  loadedAt: number;
+}
+
+interface CatalogState {
+  catalog: Catalog | null;
+  loading: Promise<Catalog> | null;
+  pendingUsage: Map<string, number>;
+  flushTimer: ReturnType<typeof setInterval> | null;
+  flushing: boolean;
+}
+
+// Survive hot reloads in development (same pattern as lib/prisma.ts)
+const globalForCatalog = globalThis as unknown as {
+  templateCatalog: CatalogState | undefined;
+};
+
+const state: CatalogState =
+  globalForCatalog.templateCatalog ??
+  (globalForCatalog.templateCatalog = {
+    catalog: null,
+    loading: null,
+    pendingUsage: new Map(),
+    flushTimer: null,
+    flushing: false,
+  });
+
+// =============================================================================
+// CATALOG
+// =============================================================================
+
+/**
+ * Look up a template (with its presets) by slug
+ */
+export async function getTemplate(slug: string): Promise<CatalogTemplate | null> {
+  const catalog = await getCatalog();
+  return catalog.bySlug.get(slug) ?? null;
+}
+
+/**
+ * Look up a template (with its presets) by id
+ */
+export async function getTemplateById(id: string): Promise<CatalogTemplate | null> {
+  const catalog = await getCatalog();
+  return catalog.byId.get(id) ?? null;
+}
+
+/**
+ * Replace the in-memory catalog with a fresh copy from the database
+ */
+export async function reloadTemplateCatalog(): Promise<void> {
+  state.loading = null;
+  await loadCatalog();
+}
+
+async function getCatalog(): Promise<Catalog> {
+  const catalog = state.catalog;
+  if (!catalog) {
+    return loadCatalog();
+  }
+
+  // Serve the current copy while a refresh runs
+  if (Date.now() - catalog.loadedAt > CATALOG_MAX_AGE_MS) {
+    loadCatalog().catch((error) => {
+      console.error("[Templates] Catalog refresh failed:", error);
+    });
+  }
+
+  return catalog;
+}
+
+function loadCatalog(): Promise<Catalog> {
+  if (state.loading) return state.loading;
+
+  const loading = prisma.template
+    .findMany({ include: { presets: { orderBy: { sortOrder: "asc" } } } })
+    .then((templates) => {
+      const catalog: Catalog = {
+        bySlug: new Map(templates.map((t) => [t.slug, t])),
+        byId: new Map(templates.map((t) => [t.id, t])),
+        loadedAt: Date.now(),
+      };
+      // A newer reload may have started while this one ran
+      if (state.loading === loading) state.catalog = catalog;
+      return catalog;
+    })
+    .finally(() => {
+      if (state.loading === loading) state.loading = null;
+    });
+
+  state.loading = loading;
+  return loading;
+}
+
+// =============================================================================
+// USAGE COUNTERS
+// =============================================================================
+
+/**
+ * Count one use of a template (written on the next flush)
+ */
+export function recordTemplateUsage(templateId: string): void {
+  state.pendingUsage.set(templateId, (state.pendingUsage.get(templateId) ?? 0) + 1);
+
+  if (!state.flushTimer) {
+    state.flushTimer = setInterval(() => {
+      void flushTemplateUsage();
+    }, USAGE_FLUSH_INTERVAL_MS);
+    state.flushTimer.unref?.();
+  }
+}
+
+/**
+ * Write buffered usage counts in a single UPDATE
+ */
+export async function flushTemplateUsage(): Promise<void> {
+  if (state.flushing || state.pendingUsage.size === 0) return;
+  state.flushing = true;
+
+  const batch = state.pendingUsage;
+  state.pendingUsage = new Map();
+
+  try {
+    const ids = [...batch.keys()];
+    const counts = [...batch.values()];
+
+    await prisma.$executeRaw`
+      UPDATE "Template" AS t
+      SET "usageCount" = t."usageCount" + u."count"
+      FROM unnest(${ids}::text[], ${counts}::int[]) AS u("id", "count")
+      WHERE t."id" = u."id"
+    `;
+  } catch (error) {
+    console.error("[Templates] Usage flush failed, will retry:", error);
+    // Put the counts back so the next flush includes them
+    for (const [id, count] of batch) {
+      state.pendingUsage.set(id, (state.pendingUsage.get(id) ?? 0) + count);
+    }
+  } finally {
+    state.flushing = false;
+  }
+}
+
+/**
+ * Catalog size and buffered counters, for metrics
+ */
+export function getTemplateCatalogStats() {
+  let pendingUses = 0;
+  for (const count of state.pendingUsage.values()) pendingUses += count;
+
+  return {
+    templates: state.catalog?.byId.size ?? 0,
+    ageSeconds: state.catalog
+      ? Math.round((Date.now() - state.catalog.loadedAt) / 1000)
+      : null,
+    pendingUsageTemplates: state.pendingUsage.size,
+    pendingUses,
+  };
+}
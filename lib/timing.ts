@@ -0,0 +1,81 @@
+/**
+ * Stage Timing
+ *
+ * Records how long each stage of a request takes (auth, credits, image-gen,
+ * database writes, ...). A StageTimer is bound to the request with
+ * runWithTimer; code anywhere below it wraps work in timeStage() without
+ * having to pass the timer around. With no timer bound, timeStage just runs
+ * the work.
+ *
+ * Routes emit the result as a Server-Timing header; the benchmark harness
+ * (scripts/bench) aggregates the same stages into percentiles.
+ */
+
+import { AsyncLocalStorage } from "async_hooks";
+import { performance } from "perf_hooks";
+
+// =============================================================================
+// TIMER
+// =============================================================================
+
+export class StageTimer {
+  private readonly startedAt = performance.now();
+  private readonly stages = new Map<string, number>();
+
+  /**
+   * Time an async stage; repeated stages accumulate
+   */
+  async time<T>(stage: string, fn: () => Promise<T>): Promise<T> {
+    const start = performance.now();
+    try {
+      return await fn();
+    } finally {
+      this.record(stage, performance.now() - start);
+    }
+  }
+
+  record(stage: string, durationMs: number): void {
+    this.stages.set(stage, (this.stages.get(stage) ?? 0) + durationMs);
+  }
+
+  /**
+   * Stage durations in the order they were first recorded
+   */
+  entries(): Array<[stage: string, durationMs: number]> {
+    return [...this.stages.entries()];
+  }
+
+  elapsedMs(): number {
+    return performance.now() - this.startedAt;
+  }
+
+  /**
+   * Server-Timing header value, e.g. "credits;dur=4.1, image_gen;dur=812.5, total;dur=840.2"
+   */
+  toServerTiming(): string {
+    return [...this.entries(), ["total", this.elapsedMs()] as const]
+      .map(([stage, ms]) => `${stage};dur=${ms.toFixed(1)}`)
+      .join(", ");
+  }
+}
+
+// =============================================================================
+// REQUEST CONTEXT
+// =============================================================================
+
+const timerStorage = new AsyncLocalStorage<StageTimer>();
+
+/**
+ * Run `fn` with `timer` collecting every timeStage() below it
+ */
+export function runWithTimer<T>(timer: StageTimer, fn: () => Promise<T>): Promise<T> {
+  return timerStorage.run(timer, fn);
+}
+
+/**
+ * Time a stage against the current request's timer (if any)
+ */
+export function timeStage<T>(stage: string, fn: () => Promise<T>): Promise<T> {
+  const timer = timerStorage.getStore();
+  return timer ? timer.time(stage, fn) : fn();
+}
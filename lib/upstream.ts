@@ -0,0 +1,474 @@
+/**
+ * Upstream HTTP Client
+ *
+ * Shared client for the JSON APIs we depend on (image-gen API, AI gateway):
+ * - Keep-alive connection pool per host, so requests reuse TLS connections
+ * - Per-attempt timeout
+ * - Concurrency ceiling per upstream; excess requests queue (bounded), and
+ *   fail fast once the queue is full instead of piling up handlers
+ * - Jittered exponential retries, only when repeating the request is safe;
+ *   a request that hit a pooled socket the server had just closed (reset
+ *   before the request was flushed, or right after reuse) is resent at once
+ *   on a fresh one
+ * - Circuit breaker: after repeated failures calls fail immediately with
+ *   CircuitOpenError until a probe request succeeds
+ * - Latency, saturation and breaker metrics (getUpstreamStats)
+ *
+ * Built on node:http/https agents; responses are buffered, so this is meant
+ * for API calls, not for streaming image bytes.
+ */
+
+import http from "http";
+import https from "https";
+
+// =============================================================================
+// CONFIGURATION
+// =============================================================================
+
+const LATENCY_SAMPLES = 512; // Per upstream, for percentiles
+const RETRY_BASE_MS = 200;
+const RETRY_MAX_MS = 5_000;
+// Idle keep-alive sockets are closed after this. Must stay below the
+// upstreams' own keep-alive timeout (Node servers default to 5s), or a request
+// can be written to a socket the server is closing.
+const IDLE_SOCKET_TIMEOUT_MS = parseInt(process.env.UPSTREAM_IDLE_SOCKET_TIMEOUT_MS || "4000");
+// A reset this soon after reusing a socket came from the server's idle close,
+// not from the server processing the request
+const STALE_SOCKET_WINDOW_MS = 5;
+
+// Status codes that mean "try again later" rather than "this request is wrong"
+const RETRYABLE_STATUS = new Set([429, 502, 503, 504]);
+
+// =============================================================================
+// TYPES
+// =============================================================================
+
+export interface UpstreamConfig {
+  name: string;
+  timeoutMs: number;
+  maxConcurrent: number;
+  maxQueued: number;
+  maxRetries: number;
+  // Consecutive failures that open the circuit
+  breakerThreshold: number;
+  // How long the circuit stays open before a probe is let through
+  breakerCooldownMs: number;
+}
+
+export interface UpstreamRequest {
+  method?: string;
+  headers?: Record<string, string>;
+  body?: string;
+  timeoutMs?: number;
+  // Safe to send twice (no side effects). GET/HEAD are always idempotent.
+  idempotent?: boolean;
+}
+
+export interface UpstreamResponse {
+  status: number;
+  ok: boolean;
+  headers: http.IncomingHttpHeaders;
+  text(): string;
+  json<T = unknown>(): T;
+}
+
+type BreakerState = "CLOSED" | "OPEN" | "HALF_OPEN";
+
+export class CircuitOpenError extends Error {
+  constructor(upstream: string) {
+    super(`${upstream} is unavailable (circuit open)`);
+    this.name = "CircuitOpenError";
+  }
+}
+
+export class UpstreamSaturatedError extends Error {
+  constructor(upstream: string) {
+    super(`${upstream} is saturated (too many queued requests)`);
+    this.name = "UpstreamSaturatedError";
+  }
+}
+
+export class UpstreamTimeoutError extends Error {
+  constructor(upstream: string, timeoutMs: number) {
+    super(`${upstream} timed out after ${timeoutMs}ms`);
+    this.name = "UpstreamTimeoutError";
+  }
+}
+
+// =============================================================================
+// CLIENT
+// =============================================================================
+
+export class Upstream {
+  private agents = new Map<string, http.Agent>();
+  private inFlight = 0;
+  private waiters: Array<() => void> = [];
+
+  private breakerState: BreakerState = "CLOSED";
+  private consecutiveFailures = 0;
+  private openedAt = 0;
+  private probing = false;
+
+  private latencies: number[] = [];
+  private latencyIndex = 0;
+  private counters = {
+    requests: 0,
+    failures: 0,
+    retries: 0,
+    staleSockets: 0,
+    timeouts: 0,
+    rejectedOpen: 0,
+    rejectedSaturated: 0,
+  };
+
+  constructor(readonly config: UpstreamConfig) {}
+
+  /**
+   * Send a request, retrying safe failures. Resolves with any HTTP response
+   * (check `ok`); rejects on network errors, timeouts, an open circuit or a
+   * full queue.
+   */
+  async request(url: string, init: UpstreamRequest = {}): Promise<UpstreamResponse> {
+    const method = (init.method ?? "GET").toUpperCase();
+    const idempotent = init.idempotent ?? (method === "GET" || method === "HEAD");
+
+    for (let attempt = 0; ; attempt++) {
+      const probe = this.checkBreaker();
+      try {
+        await this.acquire();
+      } catch (error) {
+        if (probe) this.probing = false;
+        throw error;
+      }
+
+      const startedAt = Date.now();
+      let response: UpstreamResponse | null = null;
+      let error: unknown = null;
+
+      try {
+        response = await this.send(url, method, init);
+      } catch (e) {
+        error = e;
+      } finally {
+        this.release();
+      }
+
+      this.counters.requests++;
+
+      // Not the upstream's fault: no latency sample, no effect on the breaker
+      const staleSocket = error !== null && isStaleSocketError(error);
+      if (staleSocket) {
+        this.counters.staleSockets++;
+        if (probe) this.probing = false;
+      } else {
+        this.recordLatency(Date.now() - startedAt);
+
+        const failed = error !== null || response!.status >= 500 || response!.status === 429;
+        if (failed) {
+          this.counters.failures++;
+          this.onFailure();
+        } else {
+          this.onSuccess();
+        }
+      }
+
+      const retryable =
+        attempt < this.config.maxRetries &&
+        (error !== null
+          ? idempotent || staleSocket || isConnectError(error)
+          : idempotent && RETRYABLE_STATUS.has(response!.status));
+
+      if (!retryable) {
+        if (error !== null) throw error;
+        return response!;
+      }
+
+      this.counters.retries++;
+      if (!staleSocket) await sleep(retryDelay(attempt));
+    }
+  }
+
+  /**
+   * Latency percentiles, saturation and breaker state
+   */
+  stats() {
+    const sorted = [...this.latencies].sort((a, b) => a - b);
+
+    return {
+      breaker: this.breakerState,
+      inFlight: this.inFlight,
+      queued: this.waiters.length,
+      maxConcurrent: this.config.maxConcurrent,
+      saturation: Math.round((this.inFlight / this.config.maxConcurrent) * 100) / 100,
+      latencyMs: {
+        p50: percentile(sorted, 0.5),
+        p95: percentile(sorted, 0.95),
+        p99: percentile(sorted, 0.99),
+      },
+      ...this.counters,
+    };
+  }
+
+  // ---------------------------------------------------------------------------
+  // Transport
+  // ---------------------------------------------------------------------------
+
+  private send(url: string, method: string, init: UpstreamRequest): Promise<UpstreamResponse> {
+    const target = new URL(url);
+    const transport = target.protocol === "http:" ? http : https;
+    const timeoutMs = init.timeoutMs ?? this.config.timeoutMs;
+
+    return new Promise((resolve, reject) => {
+      const req = transport.request(
+        target,
+        {
+          method,
+          agent: this.getAgent(target),
+          headers: {
+            ...init.headers,
+            ...(init.body !== undefined && {
+              "Content-Length": String(Buffer.byteLength(init.body)),
+            }),
+          },
+        },
+        (res) => {
+          const chunks: Buffer[] = [];
+          res.on("data", (chunk: Buffer) => chunks.push(chunk));
+          res.on("error", reject);
+          res.on("end", () => {
+            clearTimeout(timer);
+            const body = Buffer.concat(chunks).toString("utf8");
+            const status = res.statusCode ?? 0;
+            resolve({
+              status,
+              ok: status >= 200 && status < 300,
+              headers: res.headers,
+              text: () => body,
+              json: <T>() => JSON.parse(body) as T,
+            });
+          });
+        }
+      );
+
+      // When the pooled socket was handed over, and whether the whole request
+      // has been flushed to it (after that the server may have acted on it)
+      let socketAssignedAt = 0;
+      let flushed = false;
+      req.on("socket", () => {
+        socketAssignedAt = Date.now();
+      });
+      req.on("finish", () => {
+        flushed = true;
+      });
+
+      // Covers connect, time to first byte and body download
+      const timer = setTimeout(() => {
+        this.counters.timeouts++;
+        req.destroy(new UpstreamTimeoutError(this.config.name, timeoutMs));
+      }, timeoutMs);
+
+      req.on("error", (error: NodeJS.ErrnoException) => {
+        clearTimeout(timer);
+        // A reused socket reset before the request was flushed, or right
+        // after reuse: the server closed it while idle, so the request was
+        // never processed. Later resets may follow a processed request.
+        if (
+          req.reusedSocket &&
+          error.code === "ECONNRESET" &&
+          (!flushed || Date.now() - socketAssignedAt <= STALE_SOCKET_WINDOW_MS)
+        ) {
+          staleSocketErrors.add(error);
+        }
+        reject(error);
+      });
+
+      if (init.body !== undefined) req.write(init.body);
+      req.end();
+    });
+  }
+
+  private getAgent(target: URL): http.Agent {
+    let agent = this.agents.get(target.origin);
+    if (!agent) {
+      const options: http.AgentOptions = {
+        keepAlive: true,
+        maxSockets: this.config.maxConcurrent,
+        maxFreeSockets: this.config.maxConcurrent,
+        // Close idle sockets before the server's keep-alive timeout does
+        timeout: IDLE_SOCKET_TIMEOUT_MS,
+        scheduling: "lifo",
+      };
+      agent = target.protocol === "http:" ? new http.Agent(options) : new https.Agent(options);
+      this.agents.set(target.origin, agent);
+    }
+    return agent;
+  }
+
+  // ---------------------------------------------------------------------------
+  // Concurrency ceiling
+  // ---------------------------------------------------------------------------
+
+  private async acquire(): Promise<void> {
+    if (this.inFlight < this.config.maxConcurrent) {
+      this.inFlight++;
+      return;
+    }
+    if (this.waiters.length >= this.config.maxQueued) {
+      this.counters.rejectedSaturated++;
+      throw new UpstreamSaturatedError(this.config.name);
+    }
+    // The slot is handed over directly by release()
+    await new Promise<void>((resolve) => this.waiters.push(resolve));
+  }
+
+  private release(): void {
+    const next = this.waiters.shift();
+    if (next) next();
+    else this.inFlight--;
+  }
+
+  // ---------------------------------------------------------------------------
+  // Circuit breaker
+  // ---------------------------------------------------------------------------
+
+  /**
+   * Throws if the circuit is open; returns true if this call is the probe
+   */
+  private checkBreaker(): boolean {
+    if (this.breakerState === "CLOSED") return false;
+
+    if (
+      this.breakerState === "OPEN" &&
+      Date.now() - this.openedAt >= this.config.breakerCooldownMs
+    ) {
+      this.breakerState = "HALF_OPEN";
+    }
+
+    // Half-open lets a single probe through; everything else fails fast
+    if (this.breakerState === "HALF_OPEN" && !this.probing) {
+      this.probing = true;
+      return true;
+    }
+
+    this.counters.rejectedOpen++;
+    throw new CircuitOpenError(this.config.name);
+  }
+
+  private onSuccess(): void {
+    this.consecutiveFailures = 0;
+    if (this.breakerState !== "CLOSED") {
+      console.log(`[Upstream] ${this.config.name} recovered, closing circuit`);
+    }
+    this.breakerState = "CLOSED";
+    this.probing = false;
+  }
+
+  private onFailure(): void {
+    this.consecutiveFailures++;
+    const tripped =
+      this.breakerState === "HALF_OPEN" ||
+      (this.breakerState === "CLOSED" &&
+        this.consecutiveFailures >= this.config.breakerThreshold);
+
+    if (tripped) {
+      console.warn(
+        `[Upstream] ${this.config.name} failing, opening circuit for ${this.config.breakerCooldownMs}ms`
+      );
+      this.breakerState = "OPEN";
+      this.openedAt = Date.now();
+    }
+    this.probing = false;
+  }
+
+  private recordLatency(ms: number): void {
+    this.latencies[this.latencyIndex] = ms;
+    this.latencyIndex = (this.latencyIndex + 1) % LATENCY_SAMPLES;
+  }
+}
+
+// =============================================================================
+// SHARED UPSTREAMS
+// =============================================================================
+
+function createUpstreams() {
+  return {
+    imageGen: new Upstream({
+      name: "image-gen",
+      timeoutMs: parseInt(process.env.IMAGE_GEN_TIMEOUT_MS || "120000"),
+      maxConcurrent: parseInt(process.env.IMAGE_GEN_MAX_CONCURRENCY || "32"),
+      maxQueued: parseInt(process.env.IMAGE_GEN_MAX_QUEUED || "128"),
+      // Generation is billed upstream; only connection failures are retried
+      maxRetries: 2,
+      breakerThreshold: 5,
+      breakerCooldownMs: 30_000,
+    }),
+    aiGateway: new Upstream({
+      name: "ai-gateway",
+      timeoutMs: parseInt(process.env.AI_GATEWAY_TIMEOUT_MS || "20000"),
+      maxConcurrent: parseInt(process.env.AI_GATEWAY_MAX_CONCURRENCY || "16"),
+      maxQueued: parseInt(process.env.AI_GATEWAY_MAX_QUEUED || "64"),
+      maxRetries: 2,
+      breakerThreshold: 5,
+      breakerCooldownMs: 30_000,
+    }),
+  };
+}
+
+// Survive hot reloads in development (same pattern as lib/prisma.ts)
+const globalForUpstreams = globalThis as unknown as {
+  upstreams: ReturnType<typeof createUpstreams> | undefined;
+};
+
+export const upstreams =
+  globalForUpstreams.upstreams ?? (globalForUpstreams.upstreams = createUpstreams());
+
+/**
+ * Per-upstream metrics
+ */
+export function getUpstreamStats() {
+  return Object.fromEntries(
+    Object.entries(upstreams).map(([key, upstream]) => [key, upstream.stats()])
+  );
+}
+
+// =============================================================================
+// HELPER FUNCTIONS
+// =============================================================================
+
+/**
+ * Errors where the request never reached the server, so even a
+ * non-idempotent request is safe to send again
+ */
+function isConnectError(error: unknown): boolean {
+  const code = (error as NodeJS.ErrnoException | null)?.code;
+  return code === "ECONNREFUSED" || code === "EAI_AGAIN";
+}
+
+const staleSocketErrors = new WeakSet<object>();
+
+/**
+ * A pooled keep-alive socket was closed by the server just as it was reused,
+ * before the request could have been processed. Safe to resend even a
+ * non-idempotent request (the pattern the Node docs recommend for keep-alive
+ * agents); other resets on reused sockets are ordinary errors.
+ */
+function isStaleSocketError(error: unknown): boolean {
+  return typeof error === "object" && error !== null && staleSocketErrors.has(error);
+}
+
+/**
+ * Exponential backoff with full jitter
+ */
+function retryDelay(attempt: number): number {
+  const ceiling = Math.min(RETRY_MAX_MS, RETRY_BASE_MS * 2 ** attempt);
+  return Math.round(Math.random() * ceiling);
+}
+
+function percentile(sorted: number[], p: number): number | null {
+  if (sorted.length === 0) return null;
+  return sorted[Math.min(sorted.length - 1, Math.floor(p * sorted.length))];
+}
+
+function sleep(ms: number): Promise<void> {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
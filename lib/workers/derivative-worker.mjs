@@ -0,0 +1,76 @@
+/**
+ * Derivative worker (runs in a worker thread, see lib/image-derivatives.ts)
+ *
+ * Decodes the source image once to raw pixels, then encodes every
+ * rendition and the blur placeholder from that single decode.
+ */
+
+import { parentPort } from "node:worker_threads";
+import sharp from "sharp";
+
+// Parallelism comes from the pool; keep each worker to one libvips thread
+sharp.concurrency(1);
+
+const BLUR_SIZE = 16;
+
+parentPort.on("message", async (task) => {
+  try {
+    // Single decode (EXIF orientation applied)
+    const { data: pixels, info } = await sharp(Buffer.from(task.buffer), {
+      failOn: "none",
+    })
+      .rotate()
+      .raw()
+      .toBuffer({ resolveWithObject: true });
+
+    const raw = { width: info.width, height: info.height, channels: info.channels };
+
+    let widths = task.widths.filter((width) => width < info.width);
+    if (widths.length === 0) widths = [info.width];
+
+    const outputs = [];
+    for (const width of widths) {
+      for (const format of task.formats) {
+        const pipeline = sharp(pixels, { raw }).resize({ width });
+        const encoded =
+          format === "avif"
+            ? pipeline.avif({ quality: task.avifQuality, effort: 4 })
+            : pipeline.webp({ quality: task.webpQuality });
+
+        const { data, info: outInfo } = await encoded.toBuffer({
+          resolveWithObject: true,
+        });
+
+        outputs.push({
+          width: outInfo.width,
+          height: outInfo.height,
+          format,
+          data: data.buffer.slice(data.byteOffset, data.byteOffset + data.byteLength),
+        });
+      }
+    }
+
+    const blur = await sharp(pixels, { raw })
+      .resize(BLUR_SIZE, BLUR_SIZE, { fit: "inside" })
+      .webp({ quality: 40 })
+      .toBuffer();
+
+    parentPort.postMessage(
+      {
+        id: task.id,
+        ok: true,
+        width: info.width,
+        height: info.height,
+        blurDataUrl: `data:image/webp;base64,${blur.toString("base64")}`,
+        outputs,
+      },
+      outputs.map((output) => output.data)
+    );
+  } catch (error) {
+    parentPort.postMessage({
+      id: task.id,
+      ok: false,
+      error: error instanceof Error ? error.message : String(error),
+    });
+  }
+});
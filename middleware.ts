@@ -5,6 +5,7 @@ const isPublicRoute = createRouteMatcher([
   "/sign-in(.*)",
   "/sign-up(.*)",
   "/api/webhooks/(.*)",
+  "/api/metrics", // Uses its own bearer secret
 ]);
 
 export default clerkMiddleware(async (auth, request) => {
@@ -0,0 +1,85 @@
+/**
+ * Stand-in for the OpenAI-compatible AI gateway
+ *
+ * Any POST returns a chat completion after the injected latency (or a 503 at
+ * --gateway-error-rate). The completion echoes the user's request so
+ * enhanced prompts stay distinct per input.
+ */
+
+import http from "http";
+import { randomUUID } from "crypto";
+import type { AddressInfo } from "net";
+import type { MockServer } from "./mock-image-gen";
+import { readBody, sleep, withJitter } from "./util";
+
+export interface MockGatewayOptions {
+  latencyMs: number;
+  jitter: number;
+  errorRate: number;
+}
+
+export async function startMockGateway(options: MockGatewayOptions): Promise<MockServer> {
+  const stats = { completions: 0, failed: 0 };
+
+  const server = http.createServer(async (req, res) => {
+    if (req.method !== "POST") {
+      res.writeHead(404);
+      res.end();
+      return;
+    }
+
+    const body = JSON.parse((await readBody(req)).toString("utf8") || "{}") as {
+      model?: string;
+      messages?: Array<{ role: string; content: unknown }>;
+    };
+    await sleep(withJitter(options.latencyMs, options.jitter));
+
+    if (Math.random() < options.errorRate) {
+      stats.failed++;
+      res.writeHead(503, { "Content-Type": "application/json" });
+      res.end(JSON.stringify({ error: "Injected failure" }));
+      return;
+    }
+
+    stats.completions++;
+    const userMessage = body.messages?.find((m) => m.role === "user")?.content;
+    const request =
+      typeof userMessage === "string"
+        ? (userMessage.match(/USER REQUEST: "([\s\S]*?)"/)?.[1] ?? userMessage)
+        : "an image";
+
+    res.writeHead(200, { "Content-Type": "application/json" });
+    res.end(
+      JSON.stringify({
+        id: `chatcmpl-${randomUUID()}`,
+        object: "chat.completion",
+        created: Math.floor(Date.now() / 1000),
+        model: body.model ?? "mock",
+        choices: [
+          {
+            index: 0,
+            message: {
+              role: "assistant",
+              content: `${request}, editorial photography, soft diffused light, shallow depth of field`,
+            },
+            finish_reason: "stop",
+          },
+        ],
+        usage: { prompt_tokens: 400, completion_tokens: 40, total_tokens: 440 },
+      })
+    );
+  });
+
+  await new Promise<void>((resolve) => server.listen(0, "127.0.0.1", resolve));
+  const url = `http://127.0.0.1:${(server.address() as AddressInfo).port}`;
+
+  return {
+    url,
+    close: () =>
+      new Promise((resolve) => {
+        server.close(() => resolve());
+        server.closeAllConnections(); // The app's keep-alive agents hold sockets open
+      }),
+    stats: () => ({ ...stats }),
+  };
+}
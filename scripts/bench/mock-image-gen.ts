@@ -0,0 +1,97 @@
+/**
+ * Stand-in for the image-gen API
+ *
+ * POST /api/v1/generate  -> JSON in the image-gen response shape, after the
+ *                           injected latency (or a 503 at --gen-error-rate)
+ * GET  /images/{id}.png  -> a PNG of the configured size
+ */
+
+import http from "http";
+import { randomUUID } from "crypto";
+import type { AddressInfo } from "net";
+import { PngFactory } from "./png";
+import { readBody, sleep, withJitter } from "./util";
+
+export interface MockImageGenOptions {
+  latencyMs: number;
+  jitter: number; // +/- fraction of latencyMs
+  errorRate: number; // 0..1
+  pngBytes: number;
+}
+
+export interface MockServer {
+  url: string;
+  close(): Promise<void>;
+  stats(): Record<string, number>;
+}
+
+export async function startMockImageGen(options: MockImageGenOptions): Promise<MockServer> {
+  const png = new PngFactory(options.pngBytes);
+  const stats = { generated: 0, failed: 0, downloads: 0, bytesServed: 0 };
+  let baseUrl = "";
+
+  const server = http.createServer(async (req, res) => {
+    const url = new URL(req.url ?? "/", baseUrl);
+
+    if (req.method === "POST" && url.pathname === "/api/v1/generate") {
+      await readBody(req);
+      await sleep(withJitter(options.latencyMs, options.jitter));
+
+      if (Math.random() < options.errorRate) {
+        stats.failed++;
+        res.writeHead(503, { "Content-Type": "application/json" });
+        res.end(JSON.stringify({ error: "Injected failure" }));
+        return;
+      }
+
+      stats.generated++;
+      const id = randomUUID();
+      const imageUrl = `${baseUrl}/images/${id}.png`;
+
+      res.writeHead(200, { "Content-Type": "application/json" });
+      res.end(
+        JSON.stringify({
+          success: true,
+          image: {
+            id,
+            external_id: id,
+            image_url: imageUrl,
+            download_url: imageUrl,
+            model: "mock-image-gen",
+          },
+        })
+      );
+      return;
+    }
+
+    const match = url.pathname.match(/^\/images\/([\w-]+)\.png$/);
+    if (req.method === "GET" && match) {
+      const body = png.encode(match[1]);
+      stats.downloads++;
+      stats.bytesServed += body.length;
+
+      res.writeHead(200, {
+        "Content-Type": "image/png",
+        "Content-Length": body.length,
+      });
+      res.end(body);
+      return;
+    }
+
+    res.writeHead(404);
+    res.end();
+  });
+
+  await new Promise<void>((resolve) => server.listen(0, "127.0.0.1", resolve));
+  baseUrl = `http://127.0.0.1:${(server.address() as AddressInfo).port}`;
+
+  return {
+    url: baseUrl,
+    close: () =>
+      new Promise((resolve) => {
+        server.close(() => resolve());
+        server.closeAllConnections(); // The app's keep-alive agents hold sockets open
+      }),
+    stats: () => ({ ...stats, width: png.width, height: png.height }),
+  };
+}
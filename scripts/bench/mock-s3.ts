@@ -0,0 +1,267 @@
+/**
+ * In-memory S3-compatible store
+ *
+ * Implements just the path-style S3 operations lib/r2.ts uses: PutObject,
+ * GetObject (with Range), HeadObject, DeleteObject, DeleteObjects and
+ * multipart uploads. Signatures are not checked. Bodies sent with the SDK's
+ * aws-chunked encoding are decoded before they are stored.
+ */
+
+import http from "http";
+import { createHash, randomUUID } from "crypto";
+import type { AddressInfo } from "net";
+import type { MockServer } from "./mock-image-gen";
+import { readBody } from "./util";
+
+interface StoredObject {
+  body: Buffer;
+  contentType: string;
+  etag: string;
+  lastModified: Date;
+  metadata: Record<string, string>;
+}
+
+interface MultipartUpload {
+  key: string;
+  contentType: string;
+  metadata: Record<string, string>;
+  parts: Map<number, Buffer>;
+}
+
+function etagOf(body: Buffer): string {
+  return `"${createHash("md5").update(body).digest("hex")}"`;
+}
+
+function xmlEscape(value: string): string {
+  return value.replace(/&/g, "&amp;").replace(/</g, "&lt;").replace(/>/g, "&gt;");
+}
+
+function xmlUnescape(value: string): string {
+  return value
+    .replace(/&lt;/g, "<")
+    .replace(/&gt;/g, ">")
+    .replace(/&quot;/g, '"')
+    .replace(/&apos;/g, "'")
+    .replace(/&amp;/g, "&");
+}
+
+/**
+ * Strip aws-chunked framing: "<hex-size>[;chunk-signature=...]\r\n<data>\r\n"
+ * repeated until a zero-size chunk, followed by optional trailers
+ */
+function decodeAwsChunked(raw: Buffer): Buffer {
+  const chunks: Buffer[] = [];
+  let offset = 0;
+
+  while (offset < raw.length) {
+    const lineEnd = raw.indexOf("\r\n", offset);
+    if (lineEnd === -1) break;
+    const size = parseInt(raw.subarray(offset, lineEnd).toString("ascii").split(";")[0], 16);
+    if (!size) break;
+    const start = lineEnd + 2;
+    chunks.push(raw.subarray(start, start + size));
+    offset = start + size + 2;
+  }
+
+  return Buffer.concat(chunks);
+}
+
+function isAwsChunked(req: http.IncomingMessage): boolean {
+  const encoding = String(req.headers["content-encoding"] ?? "");
+  const sha = String(req.headers["x-amz-content-sha256"] ?? "");
+  return encoding.includes("aws-chunked") || sha.startsWith("STREAMING-");
+}
+
+function metadataOf(req: http.IncomingMessage): Record<string, string> {
+  const metadata: Record<string, string> = {};
+  for (const [name, value] of Object.entries(req.headers)) {
+    if (name.startsWith("x-amz-meta-") && typeof value === "string") {
+      metadata[name] = value;
+    }
+  }
+  return metadata;
+}
+
+export async function startMockS3(): Promise<MockServer> {
+  const objects = new Map<string, StoredObject>();
+  const uploads = new Map<string, MultipartUpload>();
+  const stats = { puts: 0, gets: 0, heads: 0, deletes: 0, multipartUploads: 0 };
+  let baseUrl = "";
+
+  const sendError = (res: http.ServerResponse, status: number, code: string, head = false) => {
+    res.writeHead(status, { "Content-Type": "application/xml" });
+    res.end(head ? undefined : `<?xml version="1.0" encoding="UTF-8"?><Error><Code>${code}</Code></Error>`);
+  };
+
+  const sendXml = (res: http.ServerResponse, xml: string) => {
+    res.writeHead(200, { "Content-Type": "application/xml" });
+    res.end(`<?xml version="1.0" encoding="UTF-8"?>${xml}`);
+  };
+
+  const server = http.createServer(async (req, res) => {
+    const url = new URL(req.url ?? "/", baseUrl);
+    const [, bucket = "", ...rest] = url.pathname.split("/");
+    const key = decodeURIComponent(rest.join("/"));
+    const objectId = `${bucket}/${key}`;
+    const query = url.searchParams;
+
+    let body = await readBody(req);
+    if (isAwsChunked(req)) body = decodeAwsChunked(body);
+
+    // Multipart: upload part
+    if (req.method === "PUT" && query.has("uploadId")) {
+      const upload = uploads.get(query.get("uploadId")!);
+      if (!upload) return sendError(res, 404, "NoSuchUpload");
+      upload.parts.set(parseInt(query.get("partNumber") ?? "1", 10), body);
+      res.writeHead(200, { ETag: etagOf(body) });
+      res.end();
+      return;
+    }
+
+    if (req.method === "PUT") {
+      stats.puts++;
+      const etag = etagOf(body);
+      objects.set(objectId, {
+        body,
+        contentType: String(req.headers["content-type"] ?? "application/octet-stream"),
+        etag,
+        lastModified: new Date(),
+        metadata: metadataOf(req),
+      });
+      res.writeHead(200, { ETag: etag });
+      res.end();
+      return;
+    }
+
+    // Multipart: initiate
+    if (req.method === "POST" && query.has("uploads")) {
+      const uploadId = randomUUID();
+      uploads.set(uploadId, {
+        key: objectId,
+        contentType: String(req.headers["content-type"] ?? "application/octet-stream"),
+        metadata: metadataOf(req),
+        parts: new Map(),
+      });
+      return sendXml(
+        res,
+        `<InitiateMultipartUploadResult><Bucket>${xmlEscape(bucket)}</Bucket>` +
+          `<Key>${xmlEscape(key)}</Key><UploadId>${uploadId}</UploadId></InitiateMultipartUploadResult>`
+      );
+    }
+
+    // Multipart: complete
+    if (req.method === "POST" && query.has("uploadId")) {
+      const uploadId = query.get("uploadId")!;
+      const upload = uploads.get(uploadId);
+      if (!upload) return sendError(res, 404, "NoSuchUpload");
+
+      const parts = [...upload.parts.entries()].sort(([a], [b]) => a - b).map(([, part]) => part);
+      const data = Buffer.concat(parts);
+      const etag = etagOf(data);
+      objects.set(upload.key, {
+        body: data,
+        contentType: upload.contentType,
+        etag,
+        lastModified: new Date(),
+        metadata: upload.metadata,
+      });
+      uploads.delete(uploadId);
+      stats.multipartUploads++;
+
+      return sendXml(
+        res,
+        `<CompleteMultipartUploadResult><Location>${baseUrl}/${xmlEscape(objectId)}</Location>` +
+          `<Bucket>${xmlEscape(bucket)}</Bucket><Key>${xmlEscape(key)}</Key>` +
+          `<ETag>${xmlEscape(etag)}</ETag></CompleteMultipartUploadResult>`
+      );
+    }
+
+    // DeleteObjects
+    if (req.method === "POST" && query.has("delete")) {
+      const keys = [...body.toString("utf8").matchAll(/<Key>([\s\S]*?)<\/Key>/g)].map((m) =>
+        xmlUnescape(m[1])
+      );
+      for (const deleted of keys) objects.delete(`${bucket}/${deleted}`);
+      stats.deletes += keys.length;
+
+      return sendXml(
+        res,
+        `<DeleteResult>${keys
+          .map((deleted) => `<Deleted><Key>${xmlEscape(deleted)}</Key></Deleted>`)
+          .join("")}</DeleteResult>`
+      );
+    }
+
+    if (req.method === "DELETE") {
+      if (query.has("uploadId")) {
+        uploads.delete(query.get("uploadId")!);
+      } else {
+        objects.delete(objectId);
+        stats.deletes++;
+      }
+      res.writeHead(204);
+      res.end();
+      return;
+    }
+
+    if (req.method === "GET" || req.method === "HEAD") {
+      const head = req.method === "HEAD";
+      if (head) stats.heads++;
+      else stats.gets++;
+
+      const object = objects.get(objectId);
+      if (!object) return sendError(res, 404, "NoSuchKey", head);
+
+      if (req.headers["if-none-match"] === object.etag) {
+        res.writeHead(304, { ETag: object.etag });
+        res.end();
+        return;
+      }
+
+      let data = object.body;
+      let status = 200;
+      const headers: http.OutgoingHttpHeaders = {
+        "Content-Type": object.contentType,
+        ETag: object.etag,
+        "Last-Modified": object.lastModified.toUTCString(),
+        "Accept-Ranges": "bytes",
+        ...object.metadata,
+      };
+
+      const range = String(req.headers.range ?? "").match(/^bytes=(\d*)-(\d*)$/);
+      if (range && (range[1] || range[2])) {
+        const size = object.body.length;
+        const start = range[1] ? parseInt(range[1], 10) : size - parseInt(range[2], 10);
+        const end = range[1] && range[2] ? Math.min(parseInt(range[2], 10), size - 1) : size - 1;
+        if (start >= size || start > end) return sendError(res, 416, "InvalidRange", head);
+        data = object.body.subarray(start, end + 1);
+        status = 206;
+        headers["Content-Range"] = `bytes ${start}-${end}/${size}`;
+      }
+
+      headers["Content-Length"] = data.length;
+      res.writeHead(status, headers);
+      res.end(head ? undefined : data);
+      return;
+    }
+
+    sendError(res, 405, "MethodNotAllowed");
+  });
+
+  await new Promise<void>((resolve) => server.listen(0, "127.0.0.1", resolve));
+  baseUrl = `http://127.0.0.1:${(server.address() as AddressInfo).port}`;
+
+  return {
+    url: baseUrl,
+    close: () =>
+      new Promise((resolve) => {
+        server.close(() => resolve());
+        server.closeAllConnections(); // The app's keep-alive agents hold sockets open
+      }),
+    stats: () => ({
+      ...stats,
+      objects: objects.size,
+      bytesStored: [...objects.values()].reduce((sum, object) => sum + object.body.length, 0),
+    }),
+  };
+}
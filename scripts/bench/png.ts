@@ -0,0 +1,78 @@
+/**
+ * Minimal PNG encoder for the benchmark stand-ins
+ *
+ * Produces valid RGB PNGs of roughly a requested size. Pixel data is random
+ * and stored uncompressed, so the file size is predictable and the derivative
+ * pool has real work to do when decoding it.
+ */
+
+import { createHash, randomBytes } from "crypto";
+import { deflateSync } from "zlib";
+
+const SIGNATURE = Buffer.from([0x89, 0x50, 0x4e, 0x47, 0x0d, 0x0a, 0x1a, 0x0a]);
+
+const CRC_TABLE = (() => {
+  const table = new Uint32Array(256);
+  for (let n = 0; n < 256; n++) {
+    let c = n;
+    for (let k = 0; k < 8; k++) c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+    table[n] = c >>> 0;
+  }
+  return table;
+})();
+
+function crc32(buffer: Buffer): number {
+  let crc = 0xffffffff;
+  for (const byte of buffer) crc = CRC_TABLE[(crc ^ byte) & 0xff] ^ (crc >>> 8);
+  return (crc ^ 0xffffffff) >>> 0;
+}
+
+function chunk(type: string, data: Buffer): Buffer {
+  const length = Buffer.alloc(4);
+  length.writeUInt32BE(data.length);
+  const body = Buffer.concat([Buffer.from(type, "ascii"), data]);
+  const crc = Buffer.alloc(4);
+  crc.writeUInt32BE(crc32(body));
+  return Buffer.concat([length, body, crc]);
+}
+
+/**
+ * Encodes PNGs of a fixed size. Each call to encode() varies the first
+ * pixels by `seed`, so every image has a distinct content hash.
+ */
+export class PngFactory {
+  readonly width: number;
+  readonly height: number;
+  private readonly raw: Buffer;
+
+  constructor(targetBytes: number) {
+    // 3 bytes per pixel plus one filter byte per row
+    this.width = Math.max(16, Math.round(Math.sqrt(targetBytes / 3)));
+    this.height = this.width;
+
+    const stride = this.width * 3 + 1;
+    this.raw = randomBytes(stride * this.height);
+    for (let y = 0; y < this.height; y++) this.raw[y * stride] = 0; // Filter: none
+  }
+
+  encode(seed: string): Buffer {
+    const raw = Buffer.from(this.raw);
+    createHash("sha256").update(seed).digest().copy(raw, 1);
+
+    const header = Buffer.alloc(13);
+    header.writeUInt32BE(this.width, 0);
+    header.writeUInt32BE(this.height, 4);
+    header[8] = 8; // Bit depth
+    header[9] = 2; // Colour type: RGB
+    header[10] = 0; // Compression
+    header[11] = 0; // Filter
+    header[12] = 0; // Interlace
+
+    return Buffer.concat([
+      SIGNATURE,
+      chunk("IHDR", header),
+      chunk("IDAT", deflateSync(raw, { level: 0 })),
+      chunk("IEND", Buffer.alloc(0)),
+    ]);
+  }
+}
@@ -0,0 +1,670 @@
+/**
+ * Generation benchmark
+ *
+ * Drives generateImage (the single-image path) and batchGenerate (the queued
+ * batch path) under configurable concurrency against local stand-ins:
+ * - an image-gen API that returns PNGs of a chosen size
+ * - an OpenAI-compatible AI gateway with injected latency
+ * - an in-memory S3-compatible store behind lib/r2.ts
+ *
+ * Reports p50/p95/p99 per stage (the same stages routes emit as
+ * Server-Timing headers) plus overall throughput.
+ *
+ * Run with: DATABASE_URL=... npx tsx scripts/bench/run.ts
+ *
+ * The database must be disposable (schema pushed with `prisma db push`).
+ * Bench users are created per run and deleted afterwards (with their images,
+ * usage records and batch jobs) unless --keep-data is passed.
+ *
+ * Options:
+ *   --mode=single|batch|both  Which path to drive (default: both)
+ *   --requests=N              Single-image requests (default: 200)
+ *   --concurrency=N           Requests (or batch submissions) in flight (default: 16)
+ *   --users=N                 Bench users requests are spread over (default: 8)
+ *   --batches=N               Batch jobs to submit (default: 10)
+ *   --batch-size=N            Images per batch job (default: 10)
+ *   --batch-timeout-ms=N      How long to wait for batch jobs to finish (default: 300000)
+ *   --resolution=1K|2K|4K     Requested resolution (default: 1K)
+ *   --png-kb=N                Size of generated PNGs in KB (default: 512)
+ *   --gen-latency-ms=N        Image-gen API latency (default: 800)
+ *   --gateway-latency-ms=N    AI gateway latency (default: 300)
+ *   --jitter=F                +/- latency jitter as a fraction (default: 0.2)
+ *   --gen-error-rate=F        Fraction of image-gen calls that fail (default: 0)
+ *   --gateway-error-rate=F    Fraction of gateway calls that fail (default: 0)
+ *   --unique-prompts=N        Distinct prompts cycled through (default: one per
+ *                             request); lower it to exercise the enhancement cache
+ *   --no-enhance              Skip prompt enhancement
+ *   --no-ingest               Leave R2 unconfigured (no ingest worker or uploads)
+ *   --ingest-timeout-ms=N     How long to wait for ingest to drain (default: 120000)
+ *   --json=PATH               Also write the report as JSON
+ *   --keep-data               Don't delete bench users and their data
+ */
+
+import { writeFileSync } from "fs";
+import { randomUUID } from "crypto";
+import { performance } from "perf_hooks";
+import { startMockImageGen, type MockServer } from "./mock-image-gen";
+import { startMockGateway } from "./mock-gateway";
+import { startMockS3 } from "./mock-s3";
+import { percentile, sleep } from "./util";
+
+const BUCKET = "bench";
+const POLL_INTERVAL_MS = 250;
+
+// =============================================================================
+// OPTIONS
+// =============================================================================
+
+interface BenchOptions {
+  mode: "single" | "batch" | "both";
+  requests: number;
+  concurrency: number;
+  users: number;
+  batches: number;
+  batchSize: number;
+  resolution: "1K" | "2K" | "4K";
+  pngKb: number;
+  genLatencyMs: number;
+  gatewayLatencyMs: number;
+  jitter: number;
+  genErrorRate: number;
+  gatewayErrorRate: number;
+  uniquePrompts: number | null;
+  enhance: boolean;
+  ingest: boolean;
+  ingestTimeoutMs: number;
+  batchTimeoutMs: number;
+  jsonPath: string | null;
+  keepData: boolean;
+}
+
+function parseArgs(): BenchOptions {
+  const args = process.argv.slice(2);
+  const options: BenchOptions = {
+    mode: "both",
+    requests: 200,
+    concurrency: 16,
+    users: 8,
+    batches: 10,
+    batchSize: 10,
+    resolution: "1K",
+    pngKb: 512,
+    genLatencyMs: 800,
+    gatewayLatencyMs: 300,
+    jitter: 0.2,
+    genErrorRate: 0,
+    gatewayErrorRate: 0,
+    uniquePrompts: null,
+    enhance: true,
+    ingest: true,
+    ingestTimeoutMs: 120_000,
+    batchTimeoutMs: 300_000,
+    jsonPath: null,
+    keepData: false,
+  };
+
+  for (const arg of args) {
+    const value = arg.split("=")[1];
+    if (arg === "--no-enhance") {
+      options.enhance = false;
+    } else if (arg === "--no-ingest") {
+      options.ingest = false;
+    } else if (arg === "--keep-data") {
+      options.keepData = true;
+    } else if (arg.startsWith("--mode=")) {
+      if (value !== "single" && value !== "batch" && value !== "both") {
+        throw new Error(`Unknown mode: ${value}`);
+      }
+      options.mode = value;
+    } else if (arg.startsWith("--requests=")) {
+      options.requests = Math.max(1, parseInt(value, 10));
+    } else if (arg.startsWith("--concurrency=")) {
+      options.concurrency = Math.max(1, parseInt(value, 10));
+    } else if (arg.startsWith("--users=")) {
+      options.users = Math.max(1, parseInt(value, 10));
+    } else if (arg.startsWith("--batches=")) {
+      options.batches = Math.max(1, parseInt(value, 10));
+    } else if (arg.startsWith("--batch-size=")) {
+      options.batchSize = Math.max(1, parseInt(value, 10));
+    } else if (arg.startsWith("--resolution=")) {
+      if (value !== "1K" && value !== "2K" && value !== "4K") {
+        throw new Error(`Unknown resolution: ${value}`);
+      }
+      options.resolution = value;
+    } else if (arg.startsWith("--png-kb=")) {
+      options.pngKb = Math.max(1, parseInt(value, 10));
+    } else if (arg.startsWith("--gen-latency-ms=")) {
+      options.genLatencyMs = Math.max(0, parseInt(value, 10));
+    } else if (arg.startsWith("--gateway-latency-ms=")) {
+      options.gatewayLatencyMs = Math.max(0, parseInt(value, 10));
+    } else if (arg.startsWith("--jitter=")) {
+      options.jitter = Math.min(1, Math.max(0, parseFloat(value)));
+    } else if (arg.startsWith("--gen-error-rate=")) {
+      options.genErrorRate = Math.min(1, Math.max(0, parseFloat(value)));
+    } else if (arg.startsWith("--gateway-error-rate=")) {
+      options.gatewayErrorRate = Math.min(1, Math.max(0, parseFloat(value)));
+    } else if (arg.startsWith("--unique-prompts=")) {
+      options.uniquePrompts = Math.max(1, parseInt(value, 10));
+    } else if (arg.startsWith("--ingest-timeout-ms=")) {
+      options.ingestTimeoutMs = Math.max(0, parseInt(value, 10));
+    } else if (arg.startsWith("--batch-timeout-ms=")) {
+      options.batchTimeoutMs = Math.max(0, parseInt(value, 10));
+    } else if (arg.startsWith("--json=")) {
+      options.jsonPath = value;
+    } else {
+      throw new Error(`Unknown option: ${arg}`);
+    }
+  }
+
+  return options;
+}
+
+// =============================================================================
+// MEASUREMENTS
+// =============================================================================
+
+interface StageSummary {
+  count: number;
+  p50: number;
+  p95: number;
+  p99: number;
+  mean: number;
+  max: number;
+}
+
+interface PhaseReport {
+  name: string;
+  wallMs: number;
+  succeeded: number;
+  failed: number;
+  imagesPerSecond: number;
+  stages: Record<string, StageSummary>;
+  errors: Record<string, number>;
+}
+
+class Recorder {
+  private readonly samples = new Map<string, number[]>();
+  private readonly errors = new Map<string, number>();
+  succeeded = 0;
+  failed = 0;
+
+  record(stage: string, durationMs: number): void {
+    const samples = this.samples.get(stage) ?? [];
+    samples.push(durationMs);
+    this.samples.set(stage, samples);
+  }
+
+  fail(error: string): void {
+    this.failed++;
+    this.errors.set(error, (this.errors.get(error) ?? 0) + 1);
+  }
+
+  report(name: string, wallMs: number, images: number): PhaseReport {
+    const stages: Record<string, StageSummary> = {};
+    for (const [stage, samples] of this.samples) {
+      const sorted = [...samples].sort((a, b) => a - b);
+      stages[stage] = {
+        count: sorted.length,
+        p50: percentile(sorted, 0.5),
+        p95: percentile(sorted, 0.95),
+        p99: percentile(sorted, 0.99),
+        mean: sorted.reduce((sum, ms) => sum + ms, 0) / sorted.length,
+        max: sorted[sorted.length - 1],
+      };
+    }
+
+    return {
+      name,
+      wallMs,
+      succeeded: this.succeeded,
+      failed: this.failed,
+      imagesPerSecond: wallMs > 0 ? images / (wallMs / 1000) : 0,
+      stages,
+      errors: Object.fromEntries(this.errors),
+    };
+  }
+}
+
+/**
+ * Run `tasks` with at most `concurrency` in flight
+ */
+async function runPool(count: number, concurrency: number, task: (index: number) => Promise<void>) {
+  let next = 0;
+  const workers = Array.from({ length: Math.min(concurrency, count) }, async () => {
+    while (next < count) {
+      await task(next++);
+    }
+  });
+  await Promise.all(workers);
+}
+
+const SUBJECTS = ["a lighthouse", "a ceramic mug", "a mountain cabin", "a red bicycle", "a city skyline"];
+const SETTINGS = ["at dawn", "on a marble table", "in heavy snow", "against a brick wall", "at night"];
+
+function promptFor(index: number, options: BenchOptions): string {
+  const n = options.uniquePrompts ? index % options.uniquePrompts : index;
+  return `${SUBJECTS[n % SUBJECTS.length]} ${SETTINGS[Math.floor(n / SUBJECTS.length) % SETTINGS.length]} (#${n})`;
+}
+
+// =============================================================================
+// ENVIRONMENT
+// =============================================================================
+
+interface Stubs {
+  imageGen: MockServer;
+  gateway: MockServer;
+  s3: MockServer;
+}
+
+async function startStubs(options: BenchOptions): Promise<Stubs> {
+  const [imageGen, gateway, s3] = await Promise.all([
+    startMockImageGen({
+      latencyMs: options.genLatencyMs,
+      jitter: options.jitter,
+      errorRate: options.genErrorRate,
+      pngBytes: options.pngKb * 1024,
+    }),
+    startMockGateway({
+      latencyMs: options.gatewayLatencyMs,
+      jitter: options.jitter,
+      errorRate: options.gatewayErrorRate,
+    }),
+    startMockS3(),
+  ]);
+
+  // Must be set before the services are imported (they read config at load)
+  process.env.IMAGE_GEN_API_URL = imageGen.url;
+  process.env.IMAGE_GEN_API_KEY = "bench";
+  process.env.AI_GATEWAY_URL = `${gateway.url}/v1/chat/completions`;
+  process.env.AI_GATEWAY_API_KEY = "bench";
+  process.env.BATCH_POLL_INTERVAL_MS ||= String(POLL_INTERVAL_MS);
+  process.env.R2_INGEST_POLL_INTERVAL_MS ||= String(POLL_INTERVAL_MS);
+
+  if (options.ingest) {
+    process.env.R2_ENDPOINT = s3.url;
+    process.env.R2_ACCESS_KEY_ID = "bench";
+    process.env.R2_SECRET_ACCESS_KEY = "bench";
+    process.env.R2_BUCKET = BUCKET;
+    process.env.R2_PUBLIC_URL = `${s3.url}/${BUCKET}`;
+    process.env.R2_FORCE_PATH_STYLE = "true";
+  } else {
+    for (const name of ["R2_ENDPOINT", "R2_ACCESS_KEY_ID", "R2_SECRET_ACCESS_KEY", "R2_PUBLIC_URL"]) {
+      delete process.env[name];
+    }
+  }
+
+  return { imageGen, gateway, s3 };
+}
+
+async function loadServices() {
+  const [prismaModule, generation, enhancement, ingest, batch, timing, credits, upstream] =
+    await Promise.all([
+      import("../../lib/prisma"),
+      import("../../lib/services/image-generation"),
+      import("../../lib/services/prompt-enhancement"),
+      import("../../lib/services/image-ingest"),
+      import("../../lib/services/batch-processor"),
+      import("../../lib/timing"),
+      import("../../lib/credits"),
+      import("../../lib/upstream"),
+    ]);
+
+  return {
+    prisma: prismaModule.prisma,
+    ...generation,
+    ...enhancement,
+    ...ingest,
+    ...batch,
+    ...timing,
+    ...credits,
+    ...upstream,
+  };
+}
+
+type Services = Awaited<ReturnType<typeof loadServices>>;
+
+/**
+ * Bench users on the top plan with effectively unlimited credits
+ */
+async function createUsers(services: Services, runId: string, count: number): Promise<string[]> {
+  const { prisma } = services;
+  const userIds = Array.from({ length: count }, (_, i) => `bench_${runId}_${i}`);
+
+  for (const id of userIds) {
+    await prisma.user.create({ data: { id, email: `${id}@bench.invalid` } });
+    await services.getUserCredits(id); // Creates the subscription
+    await prisma.subscription.update({
+      where: { userId: id },
+      data: {
+        plan: "TEAM",
+        creditsLimit: 1_000_000,
+        creditsUsed: 0,
+        maxResolution: "4K",
+        hasWatermark: false,
+      },
+    });
+    services.invalidateSubscriptionView(id);
+  }
+
+  return userIds;
+}
+
+async function deleteUsers(services: Services, userIds: string[]): Promise<void> {
+  const { prisma } = services;
+  // Batch jobs have no relation to User, so they aren't cascaded
+  await prisma.batchJob.deleteMany({ where: { userId: { in: userIds } } });
+  await prisma.user.deleteMany({ where: { id: { in: userIds } } });
+}
+
+// =============================================================================
+// SINGLE-IMAGE PATH
+// =============================================================================
+
+async function benchSingle(
+  services: Services,
+  options: BenchOptions,
+  userIds: string[]
+): Promise<{ report: PhaseReport; imageIds: string[] }> {
+  const recorder = new Recorder();
+  const enhancer = new services.PromptEnhancementService();
+  const imageIds: string[] = [];
+
+  console.log(
+    `\n▶ Single: ${options.requests} requests, concurrency ${options.concurrency}, ${options.resolution}`
+  );
+
+  const started = performance.now();
+  await runPool(options.requests, options.concurrency, async (index) => {
+    const userId = userIds[index % userIds.length];
+    const prompt = promptFor(index, options);
+    const timer = new services.StageTimer();
+
+    try {
+      // Same ordering as POST /api/images/generate: enhance after the reservation
+      const result = await services.runWithTimer(timer, () =>
+        services.generateImage({
+          userId,
+          prompt,
+          resolution: options.resolution,
+          aspectRatio: "1:1",
+          enhance: options.enhance
+            ? () =>
+                services.timeStage("enhance", () =>
+                  enhancer.enhancePrompt({ userPrompt: prompt, aspectRatio: "1:1" })
+                )
+            : undefined,
+        })
+      );
+
+      if (result.success && result.image) {
+        recorder.succeeded++;
+        imageIds.push(result.image.id);
+      } else {
+        recorder.fail(result.error ?? "Unknown error");
+      }
+    } catch (error) {
+      recorder.fail(error instanceof Error ? error.message : String(error));
+    }
+
+    for (const [stage, ms] of timer.entries()) recorder.record(stage, ms);
+    recorder.record("total", timer.elapsedMs());
+  });
+  const wallMs = performance.now() - started;
+
+  return { report: recorder.report("single", wallMs, recorder.succeeded), imageIds };
+}
+
+/**
+ * Wait for the ingest outbox to drain for `imageIds` and report how long
+ * each copy to the store took. Outbox rows are deleted on success, so a copy
+ * counts as done when its row is gone (resolution: one poll interval).
+ */
+async function benchIngest(
+  services: Services,
+  options: BenchOptions,
+  imageIds: string[]
+): Promise<PhaseReport> {
+  const { prisma } = services;
+  const recorder = new Recorder();
+  const started = performance.now();
+  const deadline = Date.now() + options.ingestTimeoutMs;
+
+  console.log(`\n▶ Ingest: waiting for ${imageIds.length} copies to the store`);
+
+  // The outbox row is written with the Image, so generatedAt is when it was queued
+  const images = await prisma.image.findMany({
+    where: { id: { in: imageIds } },
+    select: { id: true, generatedAt: true },
+  });
+  const queuedAt = new Map(images.map((image) => [image.id, image.generatedAt.getTime()]));
+
+  let outstanding: Array<{ imageId: string; status: string; lastError: string | null }> = [];
+  while (true) {
+    outstanding = await prisma.imageIngest.findMany({
+      where: { imageId: { in: [...queuedAt.keys()] } },
+      select: { imageId: true, status: true, lastError: true },
+    });
+
+    const remaining = new Set(outstanding.map((task) => task.imageId));
+    const now = Date.now();
+    for (const [imageId, queued] of queuedAt) {
+      if (remaining.has(imageId)) continue;
+      recorder.succeeded++;
+      recorder.record("ingest", now - queued);
+      queuedAt.delete(imageId);
+    }
+
+    const pending = outstanding.filter((t) => t.status === "PENDING" || t.status === "PROCESSING");
+    if (pending.length === 0 || now > deadline) break;
+    await sleep(POLL_INTERVAL_MS);
+  }
+  const wallMs = performance.now() - started;
+
+  for (const task of outstanding) {
+    if (task.status === "FAILED") {
+      recorder.fail(task.lastError ?? "Ingest failed");
+    } else {
+      recorder.fail("Timed out waiting for ingest");
+    }
+  }
+
+  return recorder.report("ingest", wallMs, recorder.succeeded);
+}
+
+// =============================================================================
+// BATCH PATH
+// =============================================================================
+
+async function benchBatch(
+  services: Services,
+  options: BenchOptions,
+  userIds: string[]
+): Promise<PhaseReport> {
+  const { prisma } = services;
+  const recorder = new Recorder();
+  const jobIds: string[] = [];
+
+  console.log(
+    `\n▶ Batch: ${options.batches} jobs × ${options.batchSize} images, ` +
+      `submission concurrency ${options.concurrency}`
+  );
+
+  const started = performance.now();
+  await runPool(options.batches, options.concurrency, async (index) => {
+    const prompts = Array.from({ length: options.batchSize }, (_, i) =>
+      promptFor(index * options.batchSize + i, options)
+    );
+    const timer = new services.StageTimer();
+
+    const result = await services.runWithTimer(timer, () =>
+      services.batchGenerate({
+        userId: userIds[index % userIds.length],
+        prompt: prompts[0],
+        prompts,
+        count: prompts.length,
+        resolution: options.resolution,
+        aspectRatio: "1:1",
+      })
+    );
+
+    for (const [stage, ms] of timer.entries()) recorder.record(`submit.${stage}`, ms);
+    recorder.record("submit.total", timer.elapsedMs());
+
+    if (result.success && result.jobId) {
+      jobIds.push(result.jobId);
+    } else {
+      recorder.fail(result.error ?? "Unknown error");
+    }
+  });
+
+  // Wait for the workers to finish every job
+  const deadline = Date.now() + options.batchTimeoutMs;
+  const isRunning = (job: { status: string }) =>
+    job.status === "PENDING" || job.status === "PROCESSING";
+
+  let jobs: Awaited<ReturnType<typeof prisma.batchJob.findMany>> = [];
+  while (true) {
+    jobs = await prisma.batchJob.findMany({ where: { id: { in: jobIds } } });
+    if (!jobs.some(isRunning) || Date.now() > deadline) break;
+    await sleep(POLL_INTERVAL_MS);
+  }
+  const wallMs = performance.now() - started;
+
+  let images = 0;
+  const imageIds: string[] = [];
+  for (const job of jobs) {
+    if (isRunning(job)) {
+      recorder.fail("Timed out waiting for batch");
+      continue;
+    }
+
+    images += job.completedImages;
+    imageIds.push(...job.imageIds);
+    if (job.failedImages > 0) recorder.fail(`${job.failedImages} image(s) failed in job`);
+    if (job.status === "COMPLETED") recorder.succeeded++;
+
+    if (job.startedAt) recorder.record("job.queue_wait", job.startedAt.getTime() - job.createdAt.getTime());
+    if (job.startedAt && job.completedAt) {
+      recorder.record("job.run", job.completedAt.getTime() - job.startedAt.getTime());
+    }
+    if (job.completedAt) recorder.record("job.total", job.completedAt.getTime() - job.createdAt.getTime());
+  }
+
+  // Per-image image-gen round trips, as recorded on the usage ledger
+  const usage = await prisma.usageRecord.findMany({
+    where: { imageId: { in: imageIds }, apiLatencyMs: { not: null } },
+    select: { apiLatencyMs: true },
+  });
+  for (const record of usage) recorder.record("image.image_gen", record.apiLatencyMs!);
+
+  return recorder.report("batch", wallMs, images);
+}
+
+// =============================================================================
+// REPORTING
+// =============================================================================
+
+function printReport(report: PhaseReport): void {
+  const fmt = (ms: number) => (Number.isFinite(ms) ? ms.toFixed(1) : "-").padStart(9);
+
+  console.log(`\n  ${report.name}`);
+  console.log(
+    `  ${"stage".padEnd(22)}${"count".padStart(7)}${"p50".padStart(9)}${"p95".padStart(9)}` +
+      `${"p99".padStart(9)}${"mean".padStart(9)}${"max".padStart(9)}   (ms)`
+  );
+  for (const [stage, s] of Object.entries(report.stages)) {
+    console.log(
+      `  ${stage.padEnd(22)}${String(s.count).padStart(7)}` +
+        `${fmt(s.p50)}${fmt(s.p95)}${fmt(s.p99)}${fmt(s.mean)}${fmt(s.max)}`
+    );
+  }
+  console.log(
+    `  ${report.succeeded} ok, ${report.failed} failed in ${(report.wallMs / 1000).toFixed(1)}s ` +
+      `→ ${report.imagesPerSecond.toFixed(2)} images/s`
+  );
+  for (const [error, count] of Object.entries(report.errors)) {
+    console.log(`    ${count}× ${error}`);
+  }
+}
+
+// =============================================================================
+// MAIN
+// =============================================================================
+
+async function main() {
+  const options = parseArgs();
+
+  if (!process.env.DATABASE_URL) {
+    throw new Error("DATABASE_URL must point at a disposable database");
+  }
+
+  const stubs = await startStubs(options);
+  const services = await loadServices();
+  const runId = randomUUID().slice(0, 8);
+
+  console.log("\n📈 Generation benchmark");
+  console.log("=".repeat(50));
+  console.log(`Run:       ${runId}`);
+  console.log(`Image-gen: ${stubs.imageGen.url} (${options.genLatencyMs}ms, ${options.pngKb}KB PNGs)`);
+  console.log(`Gateway:   ${stubs.gateway.url} (${options.gatewayLatencyMs}ms)`);
+  console.log(`Store:     ${options.ingest ? stubs.s3.url : "disabled"}`);
+
+  const userIds = await createUsers(services, runId, options.users);
+  const reports: PhaseReport[] = [];
+
+  try {
+    if (options.ingest) services.startImageIngestWorker();
+
+    if (options.mode !== "batch") {
+      const { report, imageIds } = await benchSingle(services, options, userIds);
+      reports.push(report);
+      printReport(report);
+
+      if (options.ingest && imageIds.length > 0) {
+        const ingestReport = await benchIngest(services, options, imageIds);
+        reports.push(ingestReport);
+        printReport(ingestReport);
+      }
+    }
+
+    if (options.mode !== "single") {
+      services.startBatchWorker();
+      const report = await benchBatch(services, options, userIds);
+      reports.push(report);
+      printReport(report);
+    }
+
+    const extras = {
+      upstreams: services.getUpstreamStats(),
+      promptEnhancement: services.getPromptEnhancementStats(),
+      stubs: {
+        imageGen: stubs.imageGen.stats(),
+        gateway: stubs.gateway.stats(),
+        s3: stubs.s3.stats(),
+      },
+    };
+    console.log("\n  Stand-ins:", JSON.stringify(extras.stubs));
+
+    if (options.jsonPath) {
+      writeFileSync(options.jsonPath, JSON.stringify({ runId, options, reports, ...extras }, null, 2));
+      console.log(`\n📝 Report written to ${options.jsonPath}`);
+    }
+  } finally {
+    services.stopImageIngestWorker();
+    await services.stopBatchWorker();
+
+    if (!options.keepData) {
+      await deleteUsers(services, userIds);
+    }
+
+    await services.prisma.$disconnect();
+    await Promise.all([stubs.imageGen.close(), stubs.gateway.close(), stubs.s3.close()]);
+  }
+}
+
+main()
+  .then(() => process.exit(0))
+  .catch((error) => {
+    console.error("\n❌ Benchmark failed:", error);
+    process.exit(1);
+  });
@@ -0,0 +1,33 @@
+/**
+ * Small helpers shared by the benchmark stand-ins and runner
+ */
+
+import type { IncomingMessage } from "http";
+
+export function readBody(req: IncomingMessage): Promise<Buffer> {
+  return new Promise((resolve, reject) => {
+    const chunks: Buffer[] = [];
+    req.on("data", (chunk: Buffer) => chunks.push(chunk));
+    req.on("end", () => resolve(Buffer.concat(chunks)));
+    req.on("error", reject);
+  });
+}
+
+export function sleep(ms: number): Promise<void> {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+/**
+ * `ms` +/- `jitter` (a fraction of ms), never negative
+ */
+export function withJitter(ms: number, jitter: number): number {
+  return Math.max(0, ms * (1 + (Math.random() * 2 - 1) * jitter));
+}
+
+/**
+ * Nearest-rank percentile of an ascending-sorted array
+ */
+export function percentile(sorted: number[], p: number): number {
+  if (sorted.length === 0) return NaN;
+  return sorted[Math.min(sorted.length - 1, Math.ceil(p * sorted.length) - 1)];
+}
@@ -7,26 +7,91 @@
  * Run with: npx tsx scripts/migrate-to-r2.ts
  *
  * Options:
- *   --dry-run    Preview what would be migrated without making changes
- *   --limit=N    Limit to N images (default: all)
- *   --user=ID    Only migrate images for a specific user
+ *   --dry-run          Preview what would be migrated without making changes
+ *   --limit=N          Limit to N images (default: all)
+ *   --user=ID          Only migrate images for a specific user
+ *   --concurrency=N    Images migrated in parallel (default: 8)
+ *   --rate=N           Max images started per second (default: 20); the
+ *                      actual rate backs off when the source or R2 throttles
+ *   --batch-size=N     Rows read from the database per page (default: 200)
+ *   --checkpoint=PATH  Checkpoint file (default: .r2-migration-checkpoint.json)
+ *   --resume           Continue from the checkpoint instead of starting over
+ *
+ * Rows are streamed in id order (keyset pagination), so memory stays bounded
+ * regardless of how many images are left. Progress is checkpointed every few
+ * seconds and on Ctrl+C. Failed images are listed at the end; a fresh run
+ * (without --resume) retries them.
+ *
+ * Keys are derived from each image's generatedAt, so a rerun finds earlier
+ * uploads. Migrated images get the same renditions, blur placeholder and
+ * content hash as new ones (lib/image-derivatives worker pool).
  */
 
-import { PrismaClient } from "@prisma/client";
+import { existsSync, readFileSync, renameSync, writeFileSync } from "fs";
+import type { Prisma } from "@prisma/client";
+import { prisma } from "../lib/prisma";
 import {
   uploadToR2,
   generateImageKey,
-  fetchImageBuffer,
-  generateThumbnail,
+  existsInR2,
+  getR2PublicUrl,
   isR2Available,
 } from "../lib/r2";
+import {
+  createImageDerivatives,
+  DERIVATIVE_MAX_SOURCE_BYTES,
+  type ImageDerivatives,
+} from "../lib/image-derivatives";
+import { pickVariant, THUMBNAIL_VARIANT_WIDTH } from "../lib/image-variants";
 
-const prisma = new PrismaClient();
+const CHECKPOINT_INTERVAL_MS = 5_000;
+const PROGRESS_INTERVAL_MS = 2_000;
+const THROUGHPUT_WINDOW_MS = 30_000;
+const MAX_REPORTED_ERRORS = 100;
+const SOURCE_FETCH_TIMEOUT_MS = 60_000; // Headers and body
 
 interface MigrationOptions {
   dryRun: boolean;
   limit: number | null;
   userId: string | null;
+  concurrency: number;
+  rate: number;
+  batchSize: number;
+  checkpointPath: string;
+  resume: boolean;
+}
+
+interface Candidate {
+  id: string;
+  userId: string;
+  imageUrl: string;
+  thumbnailUrl: string | null;
+  generatedAt: Date;
+}
+
+interface MigrationStats {
+  migrated: number;
+  skipped: number; // Already in R2, only the row was updated
+  failed: number;
+}
+
+interface Checkpoint {
+  userId: string | null;
+  // Every candidate with id <= cursor has been processed
+  cursor: string | null;
+  stats: MigrationStats;
+  errors: Array<{ id: string; error: string }>;
+  updatedAt: string;
+}
+
+/**
+ * Source or R2 is overloaded; the rate limiter backs off on these
+ */
+class ThrottledError extends Error {
+  constructor(message: string) {
+    super(message);
+    this.name = "ThrottledError";
+  }
 }
 
 function parseArgs(): MigrationOptions {
@@ -35,21 +100,121 @@ function parseArgs(): MigrationOptions {
     dryRun: false,
     limit: null,
     userId: null,
+    concurrency: 8,
+    rate: 20,
+    batchSize: 200,
+    checkpointPath: ".r2-migration-checkpoint.json",
+    resume: false,
   };
 
   for (const arg of args) {
     if (arg === "--dry-run") {
       options.dryRun = true;
+    } else if (arg === "--resume") {
+      options.resume = true;
     } else if (arg.startsWith("--limit=")) {
       options.limit = parseInt(arg.split("=")[1], 10);
     } else if (arg.startsWith("--user=")) {
       options.userId = arg.split("=")[1];
+    } else if (arg.startsWith("--concurrency=")) {
+      options.concurrency = Math.max(1, parseInt(arg.split("=")[1], 10));
+    } else if (arg.startsWith("--rate=")) {
+      options.rate = Math.max(1, parseFloat(arg.split("=")[1]));
+    } else if (arg.startsWith("--batch-size=")) {
+      options.batchSize = Math.max(1, parseInt(arg.split("=")[1], 10));
+    } else if (arg.startsWith("--checkpoint=")) {
+      options.checkpointPath = arg.split("=")[1];
     }
   }
 
   return options;
 }
 
+// =============================================================================
+// RATE LIMITING
+// =============================================================================
+
+/**
+ * Spaces out starts to at most `rate` per second. The rate grows slowly while
+ * requests succeed and halves whenever the source or R2 throttles (AIMD).
+ */
+class AdaptiveRateLimiter {
+  private rate: number;
+  private nextSlotAt = 0;
+
+  constructor(
+    private maxRate: number,
+    private minRate = 0.5
+  ) {
+    this.rate = maxRate;
+  }
+
+  get currentRate(): number {
+    return this.rate;
+  }
+
+  async acquire(): Promise<void> {
+    const now = Date.now();
+    const slot = Math.max(now, this.nextSlotAt);
+    this.nextSlotAt = slot + 1000 / this.rate;
+    if (slot > now) await sleep(slot - now);
+  }
+
+  onSuccess(): void {
+    this.rate = Math.min(this.maxRate, this.rate + 0.1);
+  }
+
+  onThrottle(): void {
+    this.rate = Math.max(this.minRate, this.rate / 2);
+    // Let requests already scheduled at the old rate drain first
+    this.nextSlotAt = Math.max(this.nextSlotAt, Date.now() + 1000 / this.rate);
+  }
+}
+
+// =============================================================================
+// CHECKPOINTING
+// =============================================================================
+
+/**
+ * Tracks the low-water mark of completed work. Images finish out of order,
+ * so the checkpoint only advances past an id once everything before it is
+ * done; on resume at most `concurrency` images are redone.
+ */
+class ProgressTracker {
+  private inFlight: Array<{ id: string; done: boolean }> = [];
+
+  constructor(public cursor: string | null) {}
+
+  start(id: string): { id: string; done: boolean } {
+    const entry = { id, done: false };
+    this.inFlight.push(entry);
+    return entry;
+  }
+
+  finish(entry: { id: string; done: boolean }): void {
+    entry.done = true;
+    while (this.inFlight.length > 0 && this.inFlight[0].done) {
+      this.cursor = this.inFlight.shift()!.id;
+    }
+  }
+}
+
+function loadCheckpoint(path: string): Checkpoint | null {
+  if (!existsSync(path)) return null;
+  return JSON.parse(readFileSync(path, "utf8")) as Checkpoint;
+}
+
+function saveCheckpoint(path: string, checkpoint: Checkpoint): void {
+  // Write-then-rename so a crash mid-write never corrupts the checkpoint
+  const tmpPath = `${path}.tmp`;
+  writeFileSync(tmpPath, JSON.stringify(checkpoint, null, 2));
+  renameSync(tmpPath, path);
+}
+
+// =============================================================================
+// MIGRATION
+// =============================================================================
+
 async function migrateImagesToR2(options: MigrationOptions) {
   console.log("========================================");
   console.log("R2 Migration Script");
@@ -57,6 +222,8 @@ async function migrateImagesToR2(options: MigrationOptions) {
   console.log(`Mode: ${options.dryRun ? "DRY RUN (no changes)" : "LIVE"}`);
   console.log(`Limit: ${options.limit || "None"}`);
   console.log(`User Filter: ${options.userId || "All users"}`);
+  console.log(`Concurrency: ${options.concurrency} (max ${options.rate}/s)`);
+  console.log(`Checkpoint: ${options.checkpointPath}${options.resume ? " (resuming)" : ""}`);
   console.log("========================================\n");
 
   // Check if R2 is configured
@@ -65,8 +232,21 @@ async function migrateImagesToR2(options: MigrationOptions) {
     process.exit(1);
   }
 
+  // Resume from the checkpoint if asked
+  const checkpoint = options.resume ? loadCheckpoint(options.checkpointPath) : null;
+  if (options.resume && !checkpoint) {
+    console.warn("No checkpoint found, starting from the beginning\n");
+  }
+  if (checkpoint && checkpoint.userId !== options.userId) {
+    console.error(
+      `ERROR: Checkpoint was written for user filter "${checkpoint.userId || "All users"}". ` +
+        "Use the same --user or start over without --resume."
+    );
+    process.exit(1);
+  }
+
   // Build query conditions
-  const whereConditions: Record<string, unknown> = {
+  const whereConditions: Prisma.ImageWhereInput = {
     imageUrl: {
       contains: "image-gen.xencolabs.com",
     },
@@ -77,142 +257,176 @@ async function migrateImagesToR2(options: MigrationOptions) {
     whereConditions.userId = options.userId;
   }
 
-  // Fetch images with Gemini URLs
-  const images = await prisma.image.findMany({
-    where: whereConditions,
-    orderBy: {
-      createdAt: "desc",
-    },
-    take: options.limit || undefined,
-    include: {
-      user: {
-        select: {
-          id: true,
-          email: true,
-        },
-      },
-    },
+  const startCursor = checkpoint?.cursor ?? null;
+  const remaining = await prisma.image.count({
+    where: { ...whereConditions, ...(startCursor && { id: { gt: startCursor } }) },
   });
+  const total = options.limit ? Math.min(options.limit, remaining) : remaining;
 
-  console.log(`Found ${images.length} images to migrate\n`);
+  console.log(`Found ${remaining} images to migrate\n`);
 
-  if (images.length === 0) {
+  if (total === 0) {
     console.log("No images to migrate. All images are already on R2 or no Gemini URLs found.");
     return;
   }
 
   if (options.dryRun) {
+    const preview = await prisma.image.findMany({
+      where: { ...whereConditions, ...(startCursor && { id: { gt: startCursor } }) },
+      orderBy: { id: "asc" },
+      take: 20,
+      select: { id: true, userId: true, imageUrl: true, createdAt: true },
+    });
+
     console.log("DRY RUN - Would migrate the following images:\n");
-    for (const image of images.slice(0, 20)) {
-      console.log(`  - ${image.id} (${image.user?.email || image.userId})`);
+    for (const image of preview) {
+      console.log(`  - ${image.id} (${image.userId})`);
       console.log(`    URL: ${image.imageUrl.slice(0, 60)}...`);
       console.log(`    Created: ${image.createdAt}`);
       console.log("");
     }
-    if (images.length > 20) {
-      console.log(`  ... and ${images.length - 20} more images`);
+    if (total > preview.length) {
+      console.log(`  ... and ${total - preview.length} more images`);
     }
     console.log("\nRun without --dry-run to perform the migration.");
     return;
   }
 
-  let migrated = 0;
-  let failed = 0;
-  const errors: Array<{ id: string; error: string }> = [];
-
-  const startTime = Date.now();
+  const stats: MigrationStats = checkpoint?.stats ?? { migrated: 0, skipped: 0, failed: 0 };
+  const errors = checkpoint?.errors ?? [];
+  const tracker = new ProgressTracker(startCursor);
+  const limiter = new AdaptiveRateLimiter(options.rate);
 
-  for (let i = 0; i < images.length; i++) {
-    const image = images[i];
-    const progress = `[${i + 1}/${images.length}]`;
+  const writeCheckpoint = () =>
+    saveCheckpoint(options.checkpointPath, {
+      userId: options.userId,
+      cursor: tracker.cursor,
+      stats,
+      errors: errors.slice(-MAX_REPORTED_ERRORS),
+      updatedAt: new Date().toISOString(),
+    });
 
-    try {
-      console.log(`${progress} Migrating image ${image.id}...`);
+  // Stop dispatching on Ctrl+C; in-flight images finish and are checkpointed
+  let stopping = false;
+  process.on("SIGINT", () => {
+    if (stopping) process.exit(130);
+    stopping = true;
+    console.log("\nStopping after in-flight images (Ctrl+C again to abort)...");
+  });
 
-      // Fetch image from Gemini
-      const imageData = await fetchImageBuffer(image.imageUrl);
-      if (!imageData) {
-        throw new Error("Failed to fetch image from Gemini");
-      }
+  // Keyset-paginated source: at most one page is buffered at a time
+  const queue: Candidate[] = [];
+  let pageCursor = startCursor;
+  let exhausted = false;
+  let refilling: Promise<void> | null = null;
+  let dispatched = 0;
 
-      // Upload to R2
-      const imageKey = generateImageKey(image.userId, image.id, "png");
-      const uploadResult = await uploadToR2({
-        buffer: imageData.buffer,
-        key: imageKey,
-        contentType: imageData.contentType,
-        metadata: {
-          userId: image.userId,
-          migratedFrom: "gemini",
-          migratedAt: new Date().toISOString(),
+  const refill = () =>
+    (refilling ??= (async () => {
+      const page = await prisma.image.findMany({
+        where: { ...whereConditions, ...(pageCursor && { id: { gt: pageCursor } }) },
+        orderBy: { id: "asc" },
+        take: options.batchSize,
+        select: {
+          id: true,
+          userId: true,
+          imageUrl: true,
+          thumbnailUrl: true,
+          generatedAt: true,
         },
       });
+      if (page.length < options.batchSize) exhausted = true;
+      if (page.length > 0) pageCursor = page[page.length - 1].id;
+      queue.push(...page);
+    })().finally(() => {
+      refilling = null;
+    }));
 
-      if (!uploadResult.success) {
-        throw new Error(uploadResult.error || "Upload failed");
+  const nextCandidate = async (): Promise<Candidate | null> => {
+    while (true) {
+      if (stopping || (options.limit && dispatched >= options.limit)) return null;
+      if (queue.length > 0) {
+        // Prefetch the next page while this one drains
+        if (queue.length < options.batchSize / 2 && !exhausted) void refill();
+        dispatched++;
+        return queue.shift()!;
       }
+      if (exhausted) return null;
+      await refill();
+    }
+  };
 
-      // Generate thumbnail if enabled
-      let thumbnailUrl = image.thumbnailUrl;
-      const shouldGenerateThumbnail =
-        process.env.R2_GENERATE_THUMBNAILS !== "false";
-
-      if (shouldGenerateThumbnail) {
-        try {
-          const thumbBuffer = await generateThumbnail(imageData.buffer);
-          const thumbKey = generateImageKey(
-            image.userId,
-            `${image.id}-thumb`,
-            "jpg"
-          );
-          const thumbResult = await uploadToR2({
-            buffer: thumbBuffer,
-            key: thumbKey,
-            contentType: "image/jpeg",
-          });
-
-          if (thumbResult.success) {
-            thumbnailUrl = thumbResult.url!;
-          }
-        } catch (thumbError) {
-          console.warn(`  Warning: Thumbnail generation failed for ${image.id}`);
-        }
-      }
+  // Live progress
+  const startTime = Date.now();
+  const samples: Array<{ at: number; done: number }> = [{ at: startTime, done: 0 }];
+  let processed = 0;
 
-      // Update database with R2 URLs
-      await prisma.image.update({
-        where: { id: image.id },
-        data: {
-          imageUrl: uploadResult.url!,
-          thumbnailUrl,
-        },
-      });
+  const progressTimer = setInterval(() => {
+    const now = Date.now();
+    samples.push({ at: now, done: processed });
+    while (samples.length > 2 && samples[0].at < now - THROUGHPUT_WINDOW_MS) samples.shift();
+
+    const window = samples[samples.length - 1];
+    const elapsed = (window.at - samples[0].at) / 1000;
+    const perSecond = elapsed > 0 ? (window.done - samples[0].done) / elapsed : 0;
+    const eta = perSecond > 0 ? formatDuration((total - processed) / perSecond) : "--";
+
+    console.log(
+      `[${processed}/${total}] ${perSecond.toFixed(1)} img/s, ETA ${eta} ` +
+        `(migrated ${stats.migrated}, skipped ${stats.skipped}, failed ${stats.failed}, ` +
+        `rate limit ${limiter.currentRate.toFixed(1)}/s)`
+    );
+  }, PROGRESS_INTERVAL_MS);
 
-      migrated++;
-      console.log(`${progress} ✓ Migrated to ${uploadResult.url}`);
-
-      // Rate limit: sleep 100ms between uploads to avoid overwhelming R2
-      await new Promise((resolve) => setTimeout(resolve, 100));
-    } catch (error) {
-      const errorMessage =
-        error instanceof Error ? error.message : "Unknown error";
-      console.error(`${progress} ✗ Failed: ${errorMessage}`);
-      errors.push({ id: image.id, error: errorMessage });
-      failed++;
+  const checkpointTimer = setInterval(writeCheckpoint, CHECKPOINT_INTERVAL_MS);
+
+  const worker = async () => {
+    for (let image = await nextCandidate(); image; image = await nextCandidate()) {
+      const entry = tracker.start(image.id);
+      await limiter.acquire();
+
+      try {
+        const result = await migrateImage(image);
+        stats[result]++;
+        limiter.onSuccess();
+      } catch (error) {
+        const errorMessage = error instanceof Error ? error.message : "Unknown error";
+        if (error instanceof ThrottledError) limiter.onThrottle();
+        errors.push({ id: image.id, error: errorMessage });
+        if (errors.length > MAX_REPORTED_ERRORS) errors.shift();
+        stats.failed++;
+      } finally {
+        processed++;
+        tracker.finish(entry);
+      }
     }
+  };
+
+  try {
+    await Promise.all(Array.from({ length: options.concurrency }, worker));
+  } finally {
+    clearInterval(progressTimer);
+    clearInterval(checkpointTimer);
+    writeCheckpoint();
   }
 
   const duration = Math.round((Date.now() - startTime) / 1000);
 
   console.log("\n========================================");
-  console.log("Migration Complete");
+  console.log(stopping ? "Migration Stopped" : "Migration Complete");
   console.log("========================================");
-  console.log(`Total Images: ${images.length}`);
-  console.log(`Migrated: ${migrated}`);
-  console.log(`Failed: ${failed}`);
+  console.log(`Processed: ${processed}`);
+  console.log(`Migrated: ${stats.migrated}`);
+  console.log(`Already in R2: ${stats.skipped}`);
+  console.log(`Failed: ${stats.failed}`);
   console.log(`Duration: ${duration} seconds`);
+  console.log(`Throughput: ${duration > 0 ? (processed / duration).toFixed(1) : processed} img/s`);
   console.log("========================================");
 
+  if (stopping) {
+    console.log(`\nResume with: npx tsx scripts/migrate-to-r2.ts --resume`);
+  }
+
   if (errors.length > 0) {
     console.log("\nFailed Images:");
     for (const { id, error } of errors.slice(0, 10)) {
@@ -224,6 +438,124 @@ async function migrateImagesToR2(options: MigrationOptions) {
   }
 }
 
+/**
+ * Copy one image to R2, build its renditions, and point the row at them
+ */
+async function migrateImage(image: Candidate): Promise<"migrated" | "skipped"> {
+  // Keyed by the image's date (not today's) so reruns find earlier uploads
+  const imageKey = generateImageKey(image.userId, image.id, "png", image.generatedAt);
+  const shouldGenerateDerivatives = process.env.R2_GENERATE_THUMBNAILS !== "false";
+
+  // A previous (interrupted) run may have uploaded it already
+  const imageExists = await existsInR2(imageKey);
+
+  let derivatives: ImageDerivatives | null = null;
+
+  if (!imageExists || shouldGenerateDerivatives) {
+    // Fetch image from Gemini
+    const imageData = await fetchSourceImage(image.imageUrl);
+
+    if (!imageExists) {
+      const uploadResult = await uploadToR2({
+        buffer: imageData.buffer,
+        key: imageKey,
+        contentType: imageData.contentType,
+        metadata: {
+          userId: image.userId,
+          migratedFrom: "gemini",
+          migratedAt: new Date().toISOString(),
+        },
+      });
+
+      if (!uploadResult.success) {
+        throw new ThrottledError(uploadResult.error || "Upload failed");
+      }
+    }
+
+    // Renditions are content-addressed, so a rerun reuses or overwrites them
+    if (shouldGenerateDerivatives && imageData.buffer.length <= DERIVATIVE_MAX_SOURCE_BYTES) {
+      try {
+        derivatives = await createImageDerivatives(imageData.buffer);
+      } catch (error) {
+        console.warn(
+          `  Warning: Renditions failed for ${image.id}: ${
+            error instanceof Error ? error.message : "unknown error"
+          }`
+        );
+      }
+    }
+  }
+
+  // Update database with R2 URLs. The old thumbnail is a temporary upstream
+  // URL, so without renditions there is no thumbnail (clients use the original).
+  await prisma.image.update({
+    where: { id: image.id },
+    data: {
+      imageUrl: getR2PublicUrl(imageKey),
+      thumbnailUrl: derivatives
+        ? (pickVariant(derivatives.variants, THUMBNAIL_VARIANT_WIDTH)?.url ?? null)
+        : null,
+      ...(derivatives && {
+        contentHash: derivatives.contentHash,
+        variants: derivatives.variants as unknown as Prisma.InputJsonValue,
+        blurDataUrl: derivatives.blurDataUrl,
+      }),
+    },
+  });
+
+  return imageExists ? "skipped" : "migrated";
+}
+
+/**
+ * Fetch the source image, classifying overload responses (and timeouts) for
+ * the rate limiter
+ */
+async function fetchSourceImage(
+  url: string
+): Promise<{ buffer: Buffer; contentType: string }> {
+  // One deadline for the headers and the body
+  const signal = AbortSignal.timeout(SOURCE_FETCH_TIMEOUT_MS);
+
+  let response: Response;
+  try {
+    response = await fetch(url, { signal });
+  } catch (error) {
+    throw new ThrottledError(
+      `Failed to fetch image: ${error instanceof Error ? error.message : "network error"}`
+    );
+  }
+
+  if (!response.ok) {
+    const message = `Failed to fetch image: ${response.status}`;
+    if (response.status === 429 || response.status >= 500) {
+      throw new ThrottledError(message);
+    }
+    throw new Error(message);
+  }
+
+  try {
+    return {
+      buffer: Buffer.from(await response.arrayBuffer()),
+      contentType: response.headers.get("Content-Type") || "image/png",
+    };
+  } catch (error) {
+    throw new ThrottledError(
+      `Failed to read image: ${error instanceof Error ? error.message : "network error"}`
+    );
+  }
+}
+
+function sleep(ms: number): Promise<void> {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+function formatDuration(seconds: number): string {
+  const s = Math.round(seconds);
+  const h = Math.floor(s / 3600);
+  const m = Math.floor((s % 3600) / 60);
+  return h > 0 ? `${h}h${String(m).padStart(2, "0")}m` : `${m}m${String(s % 60).padStart(2, "0")}s`;
+}
+
 // Run the migration
 migrateImagesToR2(parseArgs())
   .catch((error) => {